@@ -53,22 +53,25 @@ def plotData(freq, mag):
 
 
 def measureFilterData(filter, VNA):
-    plt.figure()
-    for i, (iH, rH, iL, rL) in enumerate(product(range(5), range(16), range(5), range(16))):
-        fileName = dataFileName([iH, rH], [iL, rL])
-        filter.set_HPF_setting([iH, rH], apply=False)
-        filter.set_LPF_setting([iL, rL], apply=True)
-
-        time.sleep(VNA.sweep_time()*2)
+    prev_settle_mode = filter.settle_mode()
+    filter.settle_mode('none') # the wait for the VNA sweeps below covers the settling of the filter
+    try:
+        plt.figure()
+        for i, (iH, rH, iL, rL) in enumerate(product(range(5), range(16), range(5), range(16))):
+            fileName = dataFileName([iH, rH], [iL, rL])
+            filter.set_filter_state([iH, rH, iL, rL])
 
-        freqData = VNA.getfdata()
-        magData = VNA.gettrace()[0]
+            time.sleep(VNA.sweep_time()*2)
 
-        plt.plot(freqData, magData)
-        plt.pause(0.1)
+            freqData = VNA.getfdata()
+            magData = VNA.gettrace()[0]
 
-        saveData(dataPath, fileName, freqData, magData, overWrite=1)
+            plt.plot(freqData, magData)
+            plt.pause(0.1)
 
+            saveData(dataPath, fileName, freqData, magData, overWrite=1)
+    finally:
+        filter.settle_mode(prev_settle_mode)
 
 if __name__ == "__main__":
     # filter = AnalogDevices_ADMV8818("filter", filter_ID)
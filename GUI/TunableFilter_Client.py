@@ -405,10 +405,8 @@ class Main_Window(QMainWindow):
 
 		filter = self.filter_dict[Serial_Number]
 
-		High_Pass_Filter_Switch = filter.get_HPF_setting()[0]  # Get the values for blue curve
-		High_Pass_Filter_Register = filter.get_HPF_setting()[1]
-		Low_Pass_Filter_Switch = filter.get_LPF_setting()[0]
-		Low_Pass_Filter_Register = filter.get_LPF_setting()[1]
+		# Get the values for blue curve
+		High_Pass_Filter_Switch, High_Pass_Filter_Register, Low_Pass_Filter_Switch, Low_Pass_Filter_Register = filter.get_filter_state()
 
 		data_path = DATAPATH.format(Serial_Number)
 
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Pure python stand-in for the ACE remote control client (AnalogDevices.Csa.Remoting.Clients request client),
+for running the AnalogDevices_ADMV8818 driver without the ACE software, pythonnet or a board.
+
+An instance can be passed to the driver through its `client` argument, e.g.
+    filter1 = AnalogDevices_ADMV8818("filter1", client=FakeACEClient())
+
+Like ACE, parameter setters only change the software copy of the settings; ApplySettings writes them to the
+(fake) board and ReadSettings reads the board back into the software copy.
+call_latency/apply_latency/settle_latency (seconds) emulate the IPC cost of a call, the duration of
+ApplySettings and the time after ApplySettings before the board reads back the new state.
+Every call is recorded in `calls` as (method name, args).
+
+ReadRegister/WriteRegister access the board directly, the switch/filter word registers are mapped onto the
+board settings (see AnalogDevices_ADMV8818_regmap). Like ACE, register writes don't update the software copy.
+
+Every hardware ID is added as its own subsystem (Subsystem_1, Subsystem_2, ...) with its own settings, and the
+calls act on the board of the subsystem in the current context path, so several boards can share one client.
+"""
+import time
+
+from Hatlab_QCoDes_Drivers.AnalogDevices_ADMV8818_regmap import (WORD_REGISTERS, encode_registers, decode_registers,
+                                                                format_hex, parse_register)
+
+HARDWARE_IDS = ("456&B660&97B1B",)
+
+
+def default_settings():
+    settings = {}
+    for i in range(5):
+        settings[f"SW_IN_WR{i}"] = str(i)
+        settings[f"SW_OUT_WR{i}"] = str(i)
+        settings[f"SW_IN_SET_WR{i}"] = "True" if i == 0 else "False"
+        settings[f"SW_OUT_SET_WR{i}"] = "True" if i == 0 else "False"
+        settings[f"LPF_WR{i}"] = "0"
+        settings[f"HPF_WR{i}"] = "0"
+    return settings
+
+
+class FakeACEClient:
+    def __init__(self, hardware_ids=HARDWARE_IDS, call_latency=0.0, apply_latency=0.0, settle_latency=0.0):
+        self.hardware_ids = list(hardware_ids)
+        self.call_latency = call_latency
+        self.apply_latency = apply_latency
+        self.settle_latency = settle_latency
+        self.calls = []
+        self.context_path = None
+        self.subsystems = {}  # {hardware ID: subsystem name}
+        self.subsystem = None  # subsystem of the current context path
+        self._boards = {}  # state of the boards of the other subsystems, {subsystem name: _board_state()}
+        self.software, self.board, self._applied, self.registers = self._board_state()
+
+    @staticmethod
+    def _board_state():
+        # software copy, board, (time of the last ApplySettings, board state before it),
+        # registers other than the word registers {address: value}
+        settings = default_settings()
+        return dict(settings), dict(settings), (0.0, dict(settings)), {}
+
+    def _select(self, subsystem):
+        """Switches the software copy and board state to those of subsystem."""
+        if subsystem == self.subsystem:
+            return
+        self._boards[self.subsystem] = (self.software, self.board, self._applied, self.registers)
+        self.subsystem = subsystem
+        state = self._boards.pop(subsystem, None) or self._board_state()
+        self.software, self.board, self._applied, self.registers = state
+
+    def board_settings(self, hardware_id):
+        """Board settings of the board with hardware_id"""
+        subsystem = self.subsystems[hardware_id]
+        return dict(self.board if subsystem == self.subsystem else self._boards[subsystem][1])
+
+    def _record(self, name, *args):
+        self.calls.append((name, args))
+        time.sleep(self.call_latency)
+
+    def count(self, name=None):
+        """Number of recorded calls, of one method if name is given"""
+        return len(self.calls) if name is None else sum(1 for call in self.calls if call[0] == name)
+
+    def clear_calls(self):
+        self.calls = []
+
+    # ------------------------------------ session ------------------------------------
+    def ListHardwareIds(self):
+        self._record("ListHardwareIds")
+        return "".join(f"{hw_id}\n" for hw_id in self.hardware_ids + ["Virtual SDP-S"])
+
+    def AddHardwarePlugin(self, name):
+        self._record("AddHardwarePlugin", name)
+
+    def AddByHardwareId(self, hardware_id):
+        self._record("AddByHardwareId", hardware_id)
+        if hardware_id not in self.subsystems:
+            self.subsystems[hardware_id] = f"Subsystem_{len(self.subsystems) + 1}"
+            self._boards[self.subsystems[hardware_id]] = self._board_state()
+        return self.subsystems[hardware_id] + "\n"
+
+    def set_ContextPath(self, path):
+        self._record("set_ContextPath", path)
+        self.context_path = path
+        parts = path.split("\\")
+        if len(parts) > 2 and parts[1] == "System":
+            self._select(parts[2])
+
+    def NavigateToPath(self, path):
+        self._record("NavigateToPath", path)
+
+    # ----------------------------------- parameters -----------------------------------
+    def _set(self, method, name, value, index):
+        self._record(method, name, value, index)
+        if name not in self.software:
+            raise KeyError(f"unknown parameter {name}")
+        self.software[name] = value
+
+    def _get(self, method, name):
+        self._record(method, name)
+        if name not in self.software:
+            raise KeyError(f"unknown parameter {name}")
+        return self.software[name] + "\n"
+
+    def SetBoolParameter(self, name, value, index):
+        self._set("SetBoolParameter", name, value, index)
+
+    def SetIntParameter(self, name, value, index):
+        self._set("SetIntParameter", name, value, index)
+
+    def SetByteParameter(self, name, value, index):
+        self._set("SetByteParameter", name, value, index)
+
+    def GetBoolParameter(self, name):
+        return self._get("GetBoolParameter", name)
+
+    def GetIntParameter(self, name):
+        return self._get("GetIntParameter", name)
+
+    def GetByteParameter(self, name):
+        return self._get("GetByteParameter", name)
+
+    # ------------------------------------- board -------------------------------------
+    def ApplySettings(self):
+        self._record("ApplySettings")
+        time.sleep(self.apply_latency)
+        self._applied = (time.perf_counter(), dict(self.board))
+        self.board = dict(self.software)
+
+    def ReadSettings(self):
+        self._record("ReadSettings")
+        applied_at, previous = self._applied
+        settled = time.perf_counter() - applied_at >= self.settle_latency
+        self.software = dict(self.board if settled else previous)
+
+    def Reset(self):
+        self._record("Reset")
+        self.software = default_settings()
+        self.board = default_settings()
+        self.registers = {}
+
+    # ----------------------------------- registers -----------------------------------
+    def ReadRegister(self, address):
+        self._record("ReadRegister", address)
+        address = parse_register(address)
+        if address in WORD_REGISTERS:
+            return format_hex(encode_registers(self.board)[address]) + "\n"
+        return format_hex(self.registers.get(address, 0)) + "\n"
+
+    def WriteRegister(self, address, value):
+        self._record("WriteRegister", address, value)
+        address, value = parse_register(address), parse_register(value)
+        if address not in WORD_REGISTERS:
+            self.registers[address] = value
+            return
+        registers = encode_registers(self.board)
+        registers[address] = value
+        self.board.update({name: str(setting) for name, setting in decode_registers(registers).items()})
+        applied_at, previous = self._applied
+        self._applied = (applied_at, dict(self.board))  # register writes take effect immediately
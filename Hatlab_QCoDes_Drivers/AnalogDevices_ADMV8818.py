@@ -32,34 +32,166 @@ More device info:
     https://www.analog.com/en/products/admv8818.html#product-overview
     and here
     https://www.analog.com/en/design-center/evaluation-hardware-and-software/evaluation-boards-kits/eval-admv8818.html#eb-overview
+
+
+Several boards on one ACE server:
+    ACE keeps one current context path, so boards sharing a server take turns on it. Every board instance of
+    a server shares one ACENavigator, which serializes the driver operations with a lock and skips the
+    navigation when the server is already on the page of the board. ipc_report() shows the IPC calls per operation.
+    The navigator only knows about the navigations of this process: if the ACE GUI or another script moves the
+    server to another page, the next settings would be written to the board of that page. After using the board
+    from elsewhere, call refresh_mirror() or verify_mirror() (which navigate again) before setting the filters.
+
+
+Write modes:
+    'parameters' (default): settings are set in the ACE parameter tree and written to the board with ApplySettings.
+    'registers': the staged settings are written straight to the switch/filter word registers with WriteRegister,
+        only the registers that change (see AnalogDevices_ADMV8818_regmap). This skips the parameter tree and
+        ApplySettings, the tree is reloaded from the board (ReadSettings) before it is used again.
 """
 
+import functools
 import logging
+import threading
+from collections import deque
 from typing import Union
 from qcodes import Instrument
-from qcodes.utils.validators import Enum, Lists, Ints
+from qcodes.utils.validators import Enum, Lists, Ints, Numbers
 import logging
-import clr
 import sys
 import time
 from typing import Dict, Optional
 
+import numpy as np
+
+from Hatlab_QCoDes_Drivers.AnalogDevices_ADMV8818_regmap import (WORD_REGISTERS, encode_registers, decode_registers,
+                                                                format_hex, parse_register)
+
 IPCPORT = "2357"
-sys.path.append(r'C:\Program Files (x86)\Analog Devices\ACE\Client')
-clr.AddReference('AnalogDevices.Csa.Remoting.Clients')
-import AnalogDevices.Csa.Remoting.Clients as adrc
+# ACE parameters of the switch bits and registers of both filters, as mirrored by the driver
+MIRRORED_SETTINGS = [f"{prefix}{i}" for prefix in ("SW_IN_SET_WR", "SW_OUT_SET_WR", "HPF_WR", "LPF_WR")
+                     for i in range(5)]
+try:
+    import clr
+    sys.path.append(r'C:\Program Files (x86)\Analog Devices\ACE\Client')
+    clr.AddReference('AnalogDevices.Csa.Remoting.Clients')
+    import AnalogDevices.Csa.Remoting.Clients as adrc
+    ACE = True
+except ImportError:
+    # without pythonnet/ACE the driver can only be used with a client passed in, e.g. AnalogDevices_ACE_fake
+    ACE = False
+
+
+def _create_client(IPC_port=IPCPORT):
+    if not ACE:
+        raise ImportError("pythonnet and the ACE client are needed to connect to the ACE software")
+    clientManager = adrc.ClientManager.Create()
+    return clientManager.CreateRequestClient(f'localhost:{IPC_port}')
+
+
+class ACENavigator:
+    """
+    Navigation state of one ACE server, shared by all the board instances using that server.
+
+    lock serializes the driver operations of the boards, so one board can't move the server to its page
+    while another one is setting parameters. path is the context path the server is on (None if unknown),
+    ipc_calls counts every call made by the drivers to the server.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.lock = threading.RLock()
+        self.path = None
+        self.ipc_calls = 0
+        self.navigations = 0
+        self.skipped_navigations = 0
+
+    def navigate(self, client, context_path, navigate_path):
+        """Moves the server to a device page, unless it is already on it. Returns True if it navigated."""
+        with self.lock:
+            if self.path == context_path:
+                self.skipped_navigations += 1
+                return False
+            self.path = None  # unknown if one of the calls fails
+            client.set_ContextPath(context_path)
+            client.NavigateToPath(navigate_path)
+            self.path = context_path
+            self.navigations += 1
+            return True
+
+    def invalidate(self):
+        """Forgets the current page, e.g. after loading hardware or a reset, the next navigation is always done."""
+        with self.lock:
+            self.path = None
+
+
+_navigators = {}
+_navigators_lock = threading.Lock()
+
+
+def get_navigator(server):
+    """
+    Returns the ACENavigator shared by all the boards on an ACE server.
 
+    :param server: the server address ('localhost:<IPC_port>'), or the client object for clients passed to the driver
+    """
+    with _navigators_lock:
+        navigator = _navigators.get(server)
+        if navigator is None:
+            navigator = _navigators[server] = ACENavigator(server)
+        return navigator
+
+
+class _CountingClient:
+    """Forwards every call to an ACE client and counts it on the navigator of its server."""
+    def __init__(self, client, navigator):
+        self._client = client
+        self._navigator = navigator
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
 
-def getHardwareIds(IPC_port=IPCPORT):
+        def call(*args):
+            self._navigator.ipc_calls += 1
+            return attr(*args)
+        return call
+
+
+def _ace_operation(func):
+    """
+    Runs a driver method with the server lock held and records the number of IPC calls it made.
+    Calls nested in another operation are counted in the outer one.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        navigator = self._navigator
+        with navigator.lock:
+            if self._operation_depth > 0:
+                return func(self, *args, **kwargs)
+            self._operation_depth += 1
+            calls0 = navigator.ipc_calls
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self._operation_depth -= 1
+                stats = self._ipc_stats.setdefault(func.__name__, [0, 0])
+                stats[0] += 1
+                stats[1] += navigator.ipc_calls - calls0
+    return wrapper
+
+
+def getHardwareIds(IPC_port=IPCPORT, client=None):
     """
     Get a list of Hardware IDs for the boards that are connected to this PC. To get the ID of a specific board,
     connect only that one board to the PC and run this function.
 
     :param IPC_port: port number of the ACE software IPC server.
+    :param client: ACE client to use instead of connecting a new one to IPC_port.
     :return: List of hardware IDs connected.
     """
-    clientManager = adrc.ClientManager.Create()
-    client = clientManager.CreateRequestClient(f'localhost:{IPC_port}')
+    if client is None:
+        client = _create_client(IPC_port)
     all_ids = client.ListHardwareIds().split("\n")
     real_ids = []
     for id in all_ids:
@@ -71,7 +203,7 @@ def getHardwareIds(IPC_port=IPCPORT):
 
 
 class AnalogDevices_ADMV8818(Instrument):
-    def __init__(self, name, hardwareID=None, IPC_port=IPCPORT, reset=False, **kwargs):
+    def __init__(self, name, hardwareID=None, IPC_port=IPCPORT, reset=False, client=None, **kwargs):
         '''
         Initializes the AnalogDevices_ADMV8818 digital tunable HPF+LPF filter.
 
@@ -81,38 +213,53 @@ class AnalogDevices_ADMV8818(Instrument):
                                 Otherwise, check the doc sting above to see how to identify hardwareID.
           IPC_port(string) : port number of the ACE software IPC server.
           reset (bool)     : resets to bypass mode.
+          client           : ACE client to use instead of connecting to the ACE software, e.g. a
+                             AnalogDevices_ACE_fake.FakeACEClient
 
         '''
         super().__init__(name, **kwargs)
         logging.info(__name__ + ' : Initializing')
 
         # create a ACE client.
-        clientManager = adrc.ClientManager.Create()
-        client = clientManager.CreateRequestClient(f'localhost:{IPC_port}')
-        self.__client = client
-
-        # find hardware by ID
-        id_list = getHardwareIds(IPC_port)
-        if hardwareID is None:
-            if len(id_list) == 1: # only one board is connected
-                self.hardwareID = id_list[0]
-            else:
-                raise ValueError(f"multiple boards are detected: {id_list}. hardwareID must be specified to initialize a specific device")
+        if client is None:
+            client = _create_client(IPC_port)
+            self._navigator = get_navigator(f'localhost:{IPC_port}')
         else:
-            if hardwareID in id_list:
-                self.hardwareID = hardwareID
+            self._navigator = get_navigator(client)
+        client = _CountingClient(client, self._navigator)
+        self.__client = client
+        self._operation_depth = 0
+        self._ipc_stats = {}  # {operation name: [number of calls, IPC calls made]}
+        self._pending = {}  # settings set since the last ApplySettings, {ACE parameter name: expected value}
+        self._settle_estimate = 0.0  # running estimate of the time the board takes to read back new settings
+        self._retune_latencies = deque(maxlen=10000)
+        self._mirror = None  # client side copy of the board settings, {ACE parameter name: value}
+        self._tree_stale = False  # registers were written since the ACE parameter tree was last read from the board
+
+        with self._navigator.lock:
+            # find hardware by ID
+            id_list = getHardwareIds(IPC_port, client)
+            if hardwareID is None:
+                if len(id_list) == 1: # only one board is connected
+                    self.hardwareID = id_list[0]
+                else:
+                    raise ValueError(f"multiple boards are detected: {id_list}. hardwareID must be specified to initialize a specific device")
             else:
-                raise ValueError(f"can't find board with ID {hardwareID}, available IDs are {id_list}")
-        self._address = self.hardwareID
+                if hardwareID in id_list:
+                    self.hardwareID = hardwareID
+                else:
+                    raise ValueError(f"can't find board with ID {hardwareID}, available IDs are {id_list}")
+            self._address = self.hardwareID
 
-        # Load hardware with ID
-        client.AddHardwarePlugin('ADMV8818 Board')
-        self.subsystem = client.AddByHardwareId(self.hardwareID)[:-1]
+            # Load hardware with ID
+            client.AddHardwarePlugin('ADMV8818 Board')
+            self.subsystem = client.AddByHardwareId(self.hardwareID)[:-1]
+            self._navigator.invalidate()  # ACE may show the new hardware
 
-        self._move_to_device_page()
+            self._move_to_device_page()
 
-        # initialize the switch positions
-        self._set_WRs()
+            # initialize the switch positions
+            self._set_WRs()
         # add params
         # self.add_parameter('LPF_switch',
         #                    label='LPF_switch',
@@ -188,14 +335,67 @@ class AnalogDevices_ADMV8818(Instrument):
                                      "The register value can be 0-15, which uniformly divides the cut-freq of the HPF in its tunable range."
                            )
 
+        self.add_parameter('filter_state',
+                           label='filter_state',
+                           get_cmd=self.get_filter_state,
+                           set_cmd=self.set_filter_state,
+                           vals=Lists(Ints()),
+                           docstring="[HPF switch, HPF register, LPF switch, LPF register], see HPF_setting and "\
+                                     "LPF_setting. Setting it changes both filters with a single ApplySettings, "\
+                                     "sending only the ACE parameters that differ from the current state."
+                           )
+
+        self.add_parameter('settle_mode',
+                           label='settle_mode',
+                           set_cmd=None,
+                           initial_value='readback',
+                           vals=Enum('readback', 'none'),
+                           docstring="how a setting is confirmed after ApplySettings. "\
+                                     "'readback': read the settings back from the board until they match, "\
+                                     "bounded by settle_timeout; "\
+                                     "'none': return right after ApplySettings, when the measurement that follows "\
+                                     "already waits long enough."
+                           )
+
+        self.add_parameter('settle_timeout',
+                           label='settle_timeout',
+                           set_cmd=None,
+                           initial_value=0.5,
+                           unit='s',
+                           vals=Numbers(min_value=0),
+                           docstring="longest time to wait for the board to read back a new setting."
+                           )
+
+        self.add_parameter('write_mode',
+                           label='write_mode',
+                           set_cmd=self._set_write_mode,
+                           initial_value='parameters',
+                           vals=Enum('parameters', 'registers'),
+                           docstring="how settings are written to the board. "\
+                                     "'parameters': ACE parameter tree + ApplySettings; "\
+                                     "'registers': SPI writes of only the word registers that change."
+                           )
+
         if reset:
             self.reset()
 
 
     def _move_to_device_page(self):
-        self.__client.set_ContextPath(fr'\System\{self.subsystem}\ADMV8818 Board\ADMV8818')
-        self.__client.NavigateToPath(f'Root::System.{self.subsystem}.ADMV8818 Board.ADMV8818')
+        self._navigator.navigate(self.__client, fr'\System\{self.subsystem}\ADMV8818 Board\ADMV8818',
+                                 f'Root::System.{self.subsystem}.ADMV8818 Board.ADMV8818')
 
+    def ipc_report(self):
+        """
+        IPC calls made to the ACE server per driver operation, since the driver was created or reset_ipc_stats,
+        {operation: {"count": calls of the operation, "ipc_calls": total IPC calls, "per_call": mean IPC calls}}
+        """
+        return {name: {"count": count, "ipc_calls": ipc_calls, "per_call": ipc_calls / count}
+                for name, (count, ipc_calls) in self._ipc_stats.items()}
+
+    def reset_ipc_stats(self):
+        self._ipc_stats = {}
+
+    @_ace_operation
     def _set_WRs(self):
         """
         sets the switch positions for where the HPF/LPF state bits are assigned,
@@ -214,130 +414,334 @@ class AnalogDevices_ADMV8818(Instrument):
             raise ValueError("second element of filter selection variable controls the filter register, it must be an integer between 0 to 15")
 
 
-    def get_LPF_switch(self):
+    def _read_setting(self, name):
+        if name.startswith("SW_"):
+            return self.__client.GetBoolParameter(name).strip() == "True"
+        return int(self.__client.GetByteParameter(name).strip())
+
+    def _set_write_mode(self, mode):
+        if len(self._pending) > 0:
+            raise RuntimeError(f"{self.name}: apply the staged settings {self._pending} before changing write_mode")
+
+    def _sync_tree(self):
+        """Reloads the ACE parameter tree from the board if registers were written since it was last read."""
+        if self._tree_stale:
+            self._move_to_device_page()
+            self.__client.ReadSettings()
+            self._tree_stale = False
+
+    def _read_tree(self, names):
+        self.__client.ReadSettings()
+        self._tree_stale = False
+        return {name: self._read_setting(name) for name in names}
+
+    def _read_registers(self, addresses):
         self._move_to_device_page()
-        self.__client.ReadSettings() # read settings from the board
+        return {addr: parse_register(self.__client.ReadRegister(format_hex(addr))) for addr in addresses}
+
+    def _stage(self, name, value):
+        """
+        Sets an ACE parameter (in the software copy of the settings) and remembers it for the readback.
+        In 'registers' write mode the setting is only remembered, it is written by _apply.
+        """
+        if self.write_mode() == 'registers':
+            self._pending[name] = value
+            return
+        self._sync_tree()
+        if name.startswith("SW_"):
+            self.__client.SetBoolParameter(name, str(bool(value)), "-1")
+        else:
+            self.__client.SetByteParameter(name, f"{value}", "-1")
+        self._pending[name] = value
+
+    def _apply(self):
+        """
+        Writes the staged settings to the board and, in 'readback' settle mode, waits until the board reads them back.
+        The first readback is done after the typical settle time seen so far, then the interval doubles from 1 ms,
+        with a last readback at settle_timeout. The mirror is updated with the applied settings.
+        """
+        if self.write_mode() == 'registers':
+            return self._apply_registers()
+        t0 = time.perf_counter()
+        self._sync_tree()
+        self.__client.ApplySettings()
+        expected, self._pending = self._pending, {}
+        if self.settle_mode() == 'readback' and len(expected) > 0:
+            self._settle(t0, expected, self._read_tree)
+        if self._mirror is not None:
+            self._mirror.update(expected)
+        self._retune_latencies.append(time.perf_counter() - t0)
+
+    def _apply_registers(self):
+        """
+        Writes the staged settings with one WriteRegister per word register that changes, the filter registers
+        first and the switch registers that select a word last. In 'readback' settle mode the written registers
+        are read back.
+        """
+        t0 = time.perf_counter()
+        mirror = self._mirrored()
+        expected, self._pending = self._pending, {}
+        current = encode_registers(mirror)
+        target = encode_registers({**mirror, **expected})
+        writes = {addr: value for addr, value in target.items() if current[addr] != value}
+        if len(writes) > 0:
+            self._move_to_device_page()
+            self._tree_stale = True
+            for addr in sorted(writes, key=lambda addr: (addr in WORD_REGISTERS[::2], writes[addr] & 0xC0 != 0)):
+                self.__client.WriteRegister(format_hex(addr), format_hex(writes[addr]))
+            if self.settle_mode() == 'readback':
+                self._settle(t0, writes, self._read_registers)
+        self._mirror.update(expected)
+        self._retune_latencies.append(time.perf_counter() - t0)
+
+    def _settle(self, t0, expected, read):
+        """
+        Reads the board with read(keys of expected) until it matches expected, see _apply.
+        The settle estimate is updated with the middle of the interval between the last read that did not
+        match (or ApplySettings) and the first one that did, and is kept below half of settle_timeout.
+        """
+        timeout = self.settle_timeout()
+        deadline = t0 + timeout
+        time.sleep(max(t0 + self._settle_estimate - time.perf_counter(), 0))
+        last_unsettled, interval = t0, 1e-3
+        while True:
+            t_read = time.perf_counter()
+            board = read(expected)
+            wrong = {key: value for key, value in expected.items() if board[key] != value}
+            if len(wrong) == 0:
+                settle_time = 0.5 * (last_unsettled + t_read) - t0
+                self._settle_estimate = min(0.8 * self._settle_estimate + 0.2 * settle_time, 0.5 * timeout)
+                return
+            now = time.perf_counter()
+            if now >= deadline:
+                self._mirror = None  # the board state is unknown now
+                raise TimeoutError(f"{self.name}: board did not read back {wrong} within {timeout}s")
+            last_unsettled = t_read
+            time.sleep(min(interval, deadline - now))
+            interval *= 2
+
+    def latency_report(self):
+        """
+        Statistics of the time (s) from ApplySettings to a confirmed setting, over the recent retunes
+        """
+        latencies = np.array(self._retune_latencies)
+        if len(latencies) == 0:
+            return {"count": 0}
+        return {"count": len(latencies),
+                "mean": float(np.mean(latencies)),
+                "median": float(np.median(latencies)),
+                "p99": float(np.percentile(latencies, 99)),
+                "max": float(np.max(latencies))}
+
+    def _read_board(self):
+        """
+        Reads every switch bit and register of both filters from the board, after one ReadSettings,
+        or from the word registers in 'registers' write mode.
+        """
+        if self.write_mode() == 'registers':
+            settings = decode_registers(self._read_registers(WORD_REGISTERS))
+            return {name: settings[name] for name in MIRRORED_SETTINGS}
+        self._move_to_device_page()
+        self._pending = {}  # ReadSettings replaces anything staged but not applied
+        return self._read_tree(MIRRORED_SETTINGS)
+
+    @_ace_operation
+    def refresh_mirror(self):
+        """
+        Reloads the client side copy of the board settings, which all the getters are served from.
+        Settings only change through this driver's setters (which keep the copy up to date) unless
+        the board is also controlled from the ACE software or another client. The server is navigated to the
+        board's page again, as the ACE software or another client may also have moved it to another page.
+        """
+        self._navigator.invalidate()
+        self._mirror = self._read_board()
+        return dict(self._mirror)
+
+    @_ace_operation
+    def verify_mirror(self):
+        """
+        Compares the client side copy of the settings with the board and reloads it.
+
+        :return: {ACE parameter name: (mirrored value, board value)} for every setting that differed
+        """
+        self._navigator.invalidate()
+        board = self._read_board()
+        mirror = self._mirror or {}
+        mismatches = {name: (mirror.get(name), value) for name, value in board.items() if mirror.get(name) != value}
+        if len(mismatches) > 0:
+            logging.warning(__name__ + f' : {self.name} mirror differed from the board: {mismatches}')
+        self._mirror = board
+        return mismatches
+
+    def _mirrored(self, verify=False):
+        if verify or self._mirror is None:
+            self.refresh_mirror()
+        return self._mirror
+
+    def _switch(self, sw_name, verify=False):
+        mirror = self._mirrored(verify)
         for i in range(5):
-            if self.__client.GetBoolParameter(f"SW_OUT_SET_WR{i}") == "True\n":
+            if mirror[f"{sw_name}{i}"]:
                 return i
         return 0
 
+    @_ace_operation
+    def get_LPF_switch(self, verify=False):
+        return self._switch("SW_OUT_SET_WR", verify)
+
+    @_ace_operation
     def set_LPF_switch(self, val, apply=True):
         self._move_to_device_page()
         for i in range(val):
-            self.__client.SetBoolParameter(f"SW_OUT_SET_WR{i}", "False", "-1")
-        self.__client.SetBoolParameter(f"SW_OUT_SET_WR{val}", "True", "-1")
+            self._stage(f"SW_OUT_SET_WR{i}", False)
+        self._stage(f"SW_OUT_SET_WR{val}", True)
         if apply:
-            self.__client.ApplySettings()
-            time.sleep(0.5)
+            self._apply()
 
-    def get_HPF_switch(self):
-        self._move_to_device_page()
-        self.__client.ReadSettings() # read settings from the board
-        for i in range(5):
-            if self.__client.GetBoolParameter(f"SW_IN_SET_WR{i}") == "True\n":
-                return i
-        return 0
+    @_ace_operation
+    def get_HPF_switch(self, verify=False):
+        return self._switch("SW_IN_SET_WR", verify)
 
 
+    @_ace_operation
     def set_HPF_switch(self, val, apply=True):
         self._move_to_device_page()
         for i in range(val):
-            self.__client.SetBoolParameter(f"SW_IN_SET_WR{i}", "False", "-1")
-        self.__client.SetBoolParameter(f"SW_IN_SET_WR{val}", "True", "-1")
+            self._stage(f"SW_IN_SET_WR{i}", False)
+        self._stage(f"SW_IN_SET_WR{val}", True)
         if apply:
-            self.__client.ApplySettings()
-            time.sleep(0.5)
+            self._apply()
 
 
 
-    def get_LPF_register(self):
-        self._move_to_device_page()
-        sw = self.get_LPF_switch()
-        val = int(self.__client.GetByteParameter(f"LPF_WR{sw}")[:-1])
-        return val
+    @_ace_operation
+    def get_LPF_register(self, verify=False):
+        sw = self.get_LPF_switch(verify)
+        return self._mirror[f"LPF_WR{sw}"]
 
 
+    @_ace_operation
     def set_LPF_register(self, val, apply=True):
         self._move_to_device_page()
         sw = self.get_LPF_switch()
-        self.__client.SetByteParameter(f"LPF_WR{sw}", f"{val}", "-1")
+        self._stage(f"LPF_WR{sw}", val)
         if apply:
-            self.__client.ApplySettings()
-            time.sleep(0.5)
+            self._apply()
 
-    def get_HPF_register(self):
-        self._move_to_device_page()
-        sw = self.get_HPF_switch()
-        val = int(self.__client.GetByteParameter(f"HPF_WR{sw}")[:-1])
-        return val
+    @_ace_operation
+    def get_HPF_register(self, verify=False):
+        sw = self.get_HPF_switch(verify)
+        return self._mirror[f"HPF_WR{sw}"]
 
 
+    @_ace_operation
     def set_HPF_register(self, val, apply=True):
         self._move_to_device_page()
         sw = self.get_HPF_switch()
-        self.__client.SetByteParameter(f"HPF_WR{sw}", f"{val}", "-1")
+        self._stage(f"HPF_WR{sw}", val)
         if apply:
-            self.__client.ApplySettings()
-            time.sleep(0.5)
+            self._apply()
 
 
 
-    def get_LPF_setting(self):
-        self._move_to_device_page()
-        self.__client.ReadSettings() # read settings from the board
-        sw=0
-        for i in range(5):
-            if self.__client.GetBoolParameter(f"SW_OUT_SET_WR{i}") == "True\n":
-                sw=i
-                break
-        reg = int(self.__client.GetByteParameter(f"LPF_WR{sw}")[:-1])
-        return [sw, reg]
+    @_ace_operation
+    def get_LPF_setting(self, verify=False):
+        sw = self.get_LPF_switch(verify)
+        return [sw, self._mirror[f"LPF_WR{sw}"]]
 
 
+    @_ace_operation
     def set_LPF_setting(self, val, apply=True):
         self._move_to_device_page()
         self._validate_setting(val)
         self.set_LPF_switch(val[0], apply=False)
-        self.__client.SetByteParameter(f"LPF_WR{val[0]}", f"{val[1]}", "-1")
+        self._stage(f"LPF_WR{val[0]}", val[1])
         if apply:
-            self.__client.ApplySettings()
-            time.sleep(0.5)
+            self._apply()
 
 
-    def get_HPF_setting(self):
-        self._move_to_device_page()
-        self.__client.ReadSettings() # read settings from the board
-        sw=0
-        for i in range(5):
-            if self.__client.GetBoolParameter(f"SW_In_SET_WR{i}") == "True\n":
-                sw=i
-                break
-        reg = int(self.__client.GetByteParameter(f"HPF_WR{sw}")[:-1])
-        return [sw, reg]
+    @_ace_operation
+    def get_HPF_setting(self, verify=False):
+        sw = self.get_HPF_switch(verify)
+        return [sw, self._mirror[f"HPF_WR{sw}"]]
 
 
+    @_ace_operation
     def set_HPF_setting(self, val, apply=True):
         self._move_to_device_page()
         self._validate_setting(val)
         self.set_HPF_switch(val[0], apply=False)
-        self.__client.SetByteParameter(f"HPF_WR{val[0]}", f"{val[1]}", "-1")
+        self._stage(f"HPF_WR{val[0]}", val[1])
         if apply:
-            self.__client.ApplySettings()
-            time.sleep(0.5)
+            self._apply()
 
+    @_ace_operation
+    def get_filter_state(self, verify=False):
+        """
+        [HPF switch, HPF register, LPF switch, LPF register]
+        """
+        return self.get_HPF_setting(verify) + self.get_LPF_setting()
+
+    @_ace_operation
+    def set_filter_state(self, val, apply=True):
+        """
+        Sets both filters to val = [HPF switch, HPF register, LPF switch, LPF register].
+        Only the switch and register parameters that differ from the mirrored board state are sent to ACE,
+        and both filters are applied together.
+        """
+        if len(val) != 4:
+            raise ValueError("filter state must be a length 4 list [HPF switch, HPF register, LPF switch, LPF register]")
+        self._validate_setting(val[:2])
+        self._validate_setting(val[2:])
+        mirror = self._mirrored()
+        target = {}
+        for (sw, reg), sw_name, reg_name in ((val[:2], "SW_IN_SET_WR", "HPF_WR"), (val[2:], "SW_OUT_SET_WR", "LPF_WR")):
+            for i in range(5):
+                target[f"{sw_name}{i}"] = (i == sw)
+            target[f"{reg_name}{sw}"] = reg
+        changed = {name: value for name, value in target.items()
+                   if mirror[name] != value or self._pending.get(name, value) != value}
+        if len(changed) > 0:
+            self._move_to_device_page()
+            for name, value in changed.items():
+                self._stage(name, value)
+        if apply and len(self._pending) > 0:
+            self._apply()
+
+    @_ace_operation
     def apply_settings(self):
         self._move_to_device_page()
-        self.__client.ApplySettings()
+        self._apply()
+
+    @_ace_operation
+    def read_register(self, address):
+        """Reads one ADMV8818 register over SPI"""
+        return self._read_registers([address])[address]
+
+    @_ace_operation
+    def write_register(self, address, value):
+        """
+        Writes one ADMV8818 register over SPI, outside of the mirror and the staged settings.
+        The mirror and the ACE parameter tree are reloaded from the board before they are used again.
+        """
+        self._move_to_device_page()
+        self.__client.WriteRegister(format_hex(address), format_hex(value))
+        self._mirror = None
+        self._tree_stale = True
 
     def _get_client(self):
         # not supported for instrument server
         return self.__client
 
+    @_ace_operation
     def reset(self):
         """Reset the board to bypass filter mode"""
         self._move_to_device_page()
         self.__client.Reset()
+        self._navigator.invalidate()
+        self._pending = {}
+        self._tree_stale = False
+        self._mirror = None
         self._set_WRs()
 
 
@@ -349,6 +753,58 @@ class AnalogDevices_ADMV8818(Instrument):
             }
         return IDN
 
+def benchmark_retune(filter, n=100, combined=True):
+    """
+    Retunes HPF and LPF together n times (like the filter calibration does) and prints the per-retune latency
+    report. Run it on a filter created with a FakeACEClient to measure the driver overhead without hardware, e.g.
+        filter = AnalogDevices_ADMV8818("filter", client=FakeACEClient(call_latency=1e-3, settle_latency=5e-3))
+
+    :param combined: retune with set_filter_state, otherwise with set_HPF_setting + set_LPF_setting
+    """
+    filter._retune_latencies.clear()
+    state = filter.get_filter_state()
+    try:
+        calls0 = filter._navigator.ipc_calls
+        t0 = time.perf_counter()
+        for i in range(n):
+            hpf = [1 + i % 4, i % 16]
+            lpf = [1 + (i + 1) % 4, (i * 7) % 16]
+            if combined:
+                filter.set_filter_state(hpf + lpf)
+            else:
+                filter.set_HPF_setting(hpf, apply=False)
+                filter.set_LPF_setting(lpf, apply=True)
+        total = time.perf_counter() - t0
+        report = filter.latency_report()
+        report["ipc_per_retune"] = (filter._navigator.ipc_calls - calls0) / n
+    finally:
+        filter.set_filter_state(state)
+    print(f"{n} retunes in {total:.3f}s ({total / n * 1e3:.2f} ms per retune, "
+          f"{report['ipc_per_retune']:.1f} IPC calls per retune), "
+          f"apply to confirmed: median {report['median'] * 1e3:.2f} ms, max {report['max'] * 1e3:.2f} ms")
+    return report
+
+
+def compare_write_modes(filter, n=100):
+    """
+    Runs benchmark_retune in the 'parameters' and the 'registers' write mode, and returns both reports
+    {write mode: report}. The write mode and the filter state are restored afterwards.
+    """
+    mode = filter.write_mode()
+    state = filter.get_filter_state()
+    reports = {}
+    try:
+        for write_mode in ('parameters', 'registers'):
+            filter.write_mode(write_mode)
+            filter.refresh_mirror()
+            print(f"{write_mode}: ", end="")
+            reports[write_mode] = benchmark_retune(filter, n)
+    finally:
+        filter.write_mode(mode)
+        filter.set_filter_state(state)
+    return reports
+
+
 if __name__ == "__main__":
     # getHardwareIds()
     filter1 = AnalogDevices_ADMV8818("filter1", '456&B660&97B1B', IPC_port="2357")
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Register map of the ADMV8818 switch/filter words, for setting the filters with SPI register writes
+(ACE ReadRegister/WriteRegister) instead of the ACE parameter tree.
+
+Each of the 5 words WR0-4 takes two registers (see the register summary in the ADMV8818 datasheet):
+    WRi_SW     (0x020 + 2i): bit 7 SW_IN_SET_WRi, bit 6 SW_OUT_SET_WRi, bits 5:3 SW_IN_WRi, bits 2:0 SW_OUT_WRi
+    WRi_FILTER (0x021 + 2i): bits 7:4 HPF_WRi, bits 3:0 LPF_WRi
+
+Settings are given by their ACE parameter names, e.g. {"SW_IN_SET_WR1": True, "HPF_WR1": 5, ...}.
+"""
+from typing import Dict
+
+NUM_WORDS = 5
+REG_WR0_SW = 0x020
+REG_WR0_FILTER = 0x021
+
+SW_IN_SET = 0x80
+SW_OUT_SET = 0x40
+
+
+def sw_register(word: int) -> int:
+    return REG_WR0_SW + 2 * word
+
+
+def filter_register(word: int) -> int:
+    return REG_WR0_FILTER + 2 * word
+
+
+WORD_REGISTERS = [addr for word in range(NUM_WORDS) for addr in (sw_register(word), filter_register(word))]
+
+
+def _as_bool(value) -> bool:
+    # ACE returns bools as "True"/"False" strings
+    return value if isinstance(value, bool) else str(value).strip() == "True"
+
+
+def encode_registers(settings) -> Dict[int, int]:
+    """
+    {register address: value} of the word registers for a full set of settings.
+    SW_IN_WRi/SW_OUT_WRi default to i, which is how the driver assigns the switch positions to the words.
+    """
+    registers = {}
+    for i in range(NUM_WORDS):
+        registers[sw_register(i)] = (SW_IN_SET if _as_bool(settings[f"SW_IN_SET_WR{i}"]) else 0) \
+                                    | (SW_OUT_SET if _as_bool(settings[f"SW_OUT_SET_WR{i}"]) else 0) \
+                                    | ((int(settings.get(f"SW_IN_WR{i}", i)) & 0x7) << 3) \
+                                    | (int(settings.get(f"SW_OUT_WR{i}", i)) & 0x7)
+        registers[filter_register(i)] = ((int(settings[f"HPF_WR{i}"]) & 0xF) << 4) \
+                                        | (int(settings[f"LPF_WR{i}"]) & 0xF)
+    return registers
+
+
+def decode_registers(registers: Dict[int, int]) -> dict:
+    """Settings held by the word registers, the inverse of encode_registers"""
+    settings = {}
+    for i in range(NUM_WORDS):
+        sw, filt = registers[sw_register(i)], registers[filter_register(i)]
+        settings[f"SW_IN_SET_WR{i}"] = bool(sw & SW_IN_SET)
+        settings[f"SW_OUT_SET_WR{i}"] = bool(sw & SW_OUT_SET)
+        settings[f"SW_IN_WR{i}"] = (sw >> 3) & 0x7
+        settings[f"SW_OUT_WR{i}"] = sw & 0x7
+        settings[f"HPF_WR{i}"] = (filt >> 4) & 0xF
+        settings[f"LPF_WR{i}"] = filt & 0xF
+    return settings
+
+
+def format_hex(value: int) -> str:
+    """register address/value in the hex string format used by the ACE register calls"""
+    return f"0x{value:02X}"
+
+
+def parse_register(text: str) -> int:
+    """register value returned by ACE ReadRegister, hex with or without the 0x prefix"""
+    return int(text.strip(), 16)
@@ -6,6 +6,8 @@ Created on Tue Dec  8 16:49:14 2020
 import numpy as np
 import logging
 import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 import pyvisa as visa
 import types
@@ -19,9 +21,16 @@ from plottr.data import datadict_storage as dds, datadict as dd
 from data_processing.fitting.QFit import fit, plotRes, getData_from_datadict, reflectionFunc, rounder
 import inspect
 from instrument_drivers.helpers.fileSavingDialog import fileNamefromMenu
+from Hatlab_QCoDes_Drivers.VNA_Segments import as_segments, segment_stimulus
 #from pyvisa.visa_exceptions import VisaIOError
 #triggered=[False]*159 
 
+# FORM:DATA argument and binary datatype for every supported transfer format.
+# Binary blocks are requested little-endian (FORM:BORD SWAP) to match the host.
+DATA_FORMATS = {'ASCII': ('ASC', None),
+                'REAL32': ('REAL32', 'f'),
+                'REAL64': ('REAL', 'd')}
+
 class Agilent_ENA_5071C(VisaInstrument):
     '''
     This is the driver for the Agilent E5071C Vector Netowrk Analyzer
@@ -31,12 +40,13 @@ class Agilent_ENA_5071C(VisaInstrument):
     address='<GBIP address>, reset=<bool>')
     '''
     
-    def __init__(self, name, address = None, **kwargs):
+    def __init__(self, name, address = None, data_format = 'REAL64', **kwargs):
         '''
         Initializes the Agilent_E5071C, and communicates with the wrapper.
         Input:
           name (string)    : name of the instrument
           address (string) : GPIB address
+          data_format (string) : trace transfer format, 'ASCII', 'REAL32' or 'REAL64'
           reset (bool)     : resets to default values, default=False
         '''
         if address == None: 
@@ -201,7 +211,74 @@ class Agilent_ENA_5071C(VisaInstrument):
                            get_parser = float,
                            unit = 's'
                            )
+        self.add_parameter('data_format',
+                           get_cmd = self._get_data_format,
+                           set_cmd = self._set_data_format,
+                           vals = vals.Enum(*DATA_FORMATS.keys()),
+                           docstring = "format used to transfer trace and stimulus data. "
+                                       "'REAL64'/'REAL32' use IEEE 488.2 binary blocks, "
+                                       "'ASCII' uses comma separated text."
+                           )
+        self.data_format(data_format)
         self.connect_message()
+
+    def _set_data_format(self, fmt):
+        self.write(f':FORM:DATA {DATA_FORMATS[fmt][0]}')
+        if DATA_FORMATS[fmt][1] is not None:
+            self.write(':FORM:BORD SWAP')
+        self._data_format = fmt
+
+    def _get_data_format(self):
+        return self._data_format
+
+    def _ask_values(self, cmd):
+        '''
+        Queries a list of numbers in the current data format, returns array
+
+        Binary formats are decoded from the block with np.frombuffer (through
+        pyvisa), ASCII is parsed in C with np.fromstring.
+        '''
+        datatype = DATA_FORMATS[self._data_format][1]
+        if datatype is None:
+            return np.fromstring(str(self.ask(cmd)), sep=',')
+        return self.visa_handle.query_binary_values(cmd, datatype=datatype,
+                                                    is_big_endian=False,
+                                                    container=np.array)
+
+    def set_segments(self, segments):
+        '''
+        Replaces the segment table of channel 1 with one :SENS1:SEGM:DATA block
+        (in the current data_format) and switches to a segmented sweep.
+
+        Input:
+            segments : list of (start, stop, points, ifbw, power), see VNA_Segments,
+                       e.g. built with VNA_Segments.segments_around
+        Output:
+            stimulus frequencies (Hz) of the segmented sweep
+        '''
+        segments = as_segments(segments)
+        per_ifbw = any(seg.ifbw is not None for seg in segments)
+        per_power = any(seg.power is not None for seg in segments)
+        ifbw = self.ifbw() if per_ifbw else None
+        power = self.power() if per_power else None
+        # header: format version 5, start/stop stimulus, ifbw/power/delay/sweep mode/sweep time columns, count
+        block = [5, 0, int(per_ifbw), int(per_power), 0, 0, 0, len(segments)]
+        for seg in segments:
+            block += [float(seg.start), float(seg.stop), int(seg.points)]
+            if per_ifbw:
+                block.append(float(ifbw if seg.ifbw is None else seg.ifbw))
+            if per_power:
+                block.append(float(power if seg.power is None else seg.power))
+        # the segment block is read in the current FORM:DATA format
+        datatype = DATA_FORMATS[self._data_format][1]
+        if datatype is None:
+            self.write(':SENS1:SEGM:DATA ' + ','.join(str(v) for v in block))
+        else:
+            self.visa_handle.write_binary_values(':SENS1:SEGM:DATA ', block, datatype=datatype,
+                                                 is_big_endian=False)
+        self.sweep_type('SEGM')
+        return segment_stimulus(segments)
+
     def gettrace(self):
         '''
         Gets amp/phase stimulus data, returns 2 arrays
@@ -211,11 +288,8 @@ class Agilent_ENA_5071C(VisaInstrument):
         Output:
             [[mags (dB)], [phases (rad)]]
         '''
-        strdata= str(self.ask(':CALC:DATA:FDATA?'))
-        data= np.array(list(map(float,strdata.split(','))))
-        data=data.reshape((int(np.size(data)/2)),2)
-        
-        return data.transpose()
+        data = self._ask_values(':CALC:DATA:FDATA?')
+        return data.reshape(-1, 2).transpose()
     
     # def getSweepData(self):
     #     '''
@@ -240,6 +314,7 @@ class Hat_ENA5071C(Agilent_ENA_5071C):
     def __init__(self,name: str, address: str = None, terminator: str = "\n", **kwargs):
         if address == None:
             raise Exception('TCPIP Address needed')
+        self._avg_executor = None # worker thread waiting for averaging to complete
         super().__init__(name, address, terminator = terminator, **kwargs)
 
     def average_restart(self):
@@ -255,8 +330,7 @@ class Hat_ENA5071C(Agilent_ENA_5071C):
             freqvalues array (Hz)
         '''
         logging.info(__name__ + ' : get f stim data')
-        strdata= str(self.ask(':SENS1:FREQ:DATA?'))
-        return np.array(list(map(float,strdata.split(','))))
+        return self._ask_values(':SENS1:FREQ:DATA?')
     def getpdata(self):
         '''
         Get the probe power sweep range
@@ -270,7 +344,7 @@ class Hat_ENA5071C(Agilent_ENA_5071C):
         return np.linspace(self.power_start(), self.power_stop(), self.num_points())
     
     def getSweepData(self):
-        if self.sweep_type() == 'LIN': 
+        if self.sweep_type() in ('LIN', 'SEGM'): 
             return self.getfdata()
         elif self.sweep_type() == 'POW': 
             return self.getpdata()
@@ -283,46 +357,111 @@ class Hat_ENA5071C(Agilent_ENA_5071C):
         '''
         logging.debug(__name__+": data to mem called")
         self.write(":CALC1:MATH:MEM")
-    def average(self, number, tracetype = 'PLOG'): 
-        #setting averaging timeout, it takes 52.02s for 100 traces to average with 1601 points and 2kHz IFBW
+    def start_average(self, number, tracetype = 'PLOG', progress = None, max_poll = 0.5):
         '''
-        Sets the number of averages taken, waits until the averaging is done, then gets the trace
+        Sets the number of averages taken and triggers them, returns a
+        concurrent.futures.Future that resolves to the averaged trace as soon
+        as the VNA reports the operation complete.
+
+        The instrument is configured in the calling thread, the completion is
+        polled in a background thread, so other instruments can be driven
+        while the VNA averages. Don't talk to this VNA until the future is done.
+
+        Input:
+            number (int) : number of averages
+            tracetype (string) : trform used for the returned trace
+            progress (callable) : called as progress(fraction, elapsed_s) while waiting,
+                                  the fraction is estimated from the sweep time
+            max_poll (float) : longest interval (s) between two status polls
+        Output:
+            Future of [[mags (dB)], [phases (rad)]]
         '''
         assert number > 0
         
-        prev_trform = self.trform()
         self.trform(tracetype)
         self.trigger_source('BUS')
-        
-        buffer_time = 2 #s
         if number == 1:
-           
             self.averaging(0)
             self.average_trigger(0)
-            s_per_trace = self.sweep_time()
-            self.timeout(number*s_per_trace+buffer_time)
-            self.trigger()
-            return self.gettrace()
-        else: 
-            #wait just a little longer for safety #TODO: find a way to make this better
-            
+        else:
             self.averaging(1)
             self.average_trigger(1)
             self.avgnum(number)
-            prev_timeout = self.timeout()
-            s_per_trace = self.sweep_time()
-            self.timeout(number*s_per_trace+buffer_time)
-            print("Waiting {:.3f} seconds for {} averages...".format(self.timeout(), number))
-            self.write(':TRIG:SING')
-            # print('triggered')
-            #the next command will hang the kernel until the averaging is done
-            print(self.ask('*OPC?'))
-            # print('timeout check')
-            return self.gettrace()
+        expected_time = number*self.sweep_time()
+        print("Expecting {:.3f} seconds for {} averages...".format(expected_time, number))
+        # *OPC sets bit 0 of the event status register once the triggered sweeps are done
+        self.write('*CLS')
+        self.write(':TRIG:SING')
+        self.write('*OPC')
+        if self._avg_executor is None:
+            self._avg_executor = ThreadPoolExecutor(max_workers = 1)
+        return self._avg_executor.submit(self._finish_average, expected_time, progress, max_poll)
+
+    def _finish_average(self, expected_time, progress, max_poll):
+        self.wait_for_operation(expected_time, progress = progress, max_poll = max_poll)
+        return self.gettrace()
+
+    def wait_for_operation(self, expected_time, progress = None, max_poll = 0.5, timeout = None):
+        '''
+        Polls *ESR? until the operation complete bit set by a preceding *OPC is
+        seen. The poll interval starts short and doubles up to max_poll, so the
+        call returns within max_poll of completion without flooding the bus.
+
+        Input:
+            expected_time (float) : expected duration (s), used for progress
+                                    and the default timeout
+            progress (callable) : called as progress(fraction, elapsed_s)
+            timeout (float) : give up after this many seconds, default 2*expected_time + 10
+        '''
+        if timeout is None:
+            timeout = 2*expected_time + 10
+        t0 = time.perf_counter()
+        interval = min(0.01, max_poll)
+        while True:
+            elapsed = time.perf_counter() - t0
+            if int(self.ask('*ESR?')) & 1:
+                break
+            if elapsed > timeout:
+                raise TimeoutError(f'{self.name}: operation not complete after {elapsed:.1f}s')
+            if progress is not None:
+                progress(min(elapsed/expected_time, 0.99) if expected_time > 0 else 0.99, elapsed)
+            time.sleep(interval)
+            interval = min(2*interval, max_poll)
+        if progress is not None:
+            progress(1.0, time.perf_counter() - t0)
+
+    def average(self, number, tracetype = 'PLOG', progress = None): 
+        '''
+        Sets the number of averages taken, waits until the averaging is done, then gets the trace
+        '''
+        return self.start_average(number, tracetype = tracetype, progress = progress).result()
+
+    async def average_async(self, number, tracetype = 'PLOG', progress = None):
+        '''
+        Awaitable version of average, for use in an asyncio event loop
+        '''
+        return await asyncio.wrap_future(self.start_average(number, tracetype = tracetype, progress = progress))
+
+    def close(self):
+        if self._avg_executor is not None:
+            self._avg_executor.shutdown(wait = True)
+            self._avg_executor = None
+        super().close()
     
     #DO NOT CHANGE THE DEFAULT KEYWORD ARGUMENTS HERE, CHANGE THEM WHEN YOU CALL THE FUNCTION WITH THE KEYWORD ARGUMENT
     #ex: VNA.savetrace(avgnum = 200)
-    def savetrace(self, directory, name, avgnum=10):
+    def savetrace(self, directory=None, name=None, avgnum=10, writer=None):
+        '''
+        Averages a trace and saves it to a new DDH5 file in directory, or, if a
+        VNA_TraceWriter.TraceSessionWriter is given, appends it to that
+        writer's open file as a record called name (trace_<index> if name is None)
+        '''
+        if writer is not None:
+            freqs = self.getSweepData()
+            vnadata = np.array(self.average(avgnum))
+            index = writer.add_trace(name, freqs, vnadata[0], vnadata[1])
+            self.set_to_manual()
+            return index
 
         data = dd.DataDict(
             frequency=dict(unit='Hz'),
@@ -399,15 +538,9 @@ class Hat_ENA5071C(Agilent_ENA_5071C):
         self.average_trigger(0)
         self.trform(trform)
         self.trigger_source('INT')
-    def renormalize(self, num_avgs): 
-        self.averaging(1)
-        self.average_restart()
-        self.average_trigger(0)
-        self.avgnum(num_avgs)
-        s_per_trace = self.sweep_time()
-        wait_time = s_per_trace*num_avgs + 2
-        print(f'Renormalizing, waiting {wait_time} seconds for averaging...')
-        time.sleep(wait_time)
+    def renormalize(self, num_avgs, progress = None): 
+        print(f'Renormalizing, averaging {num_avgs} traces...')
+        self.average(num_avgs, tracetype = 'MLOG', progress = progress)
         self.data_to_mem()
         self.math('DIV')
         self.set_to_manual(trform = 'MLOG')
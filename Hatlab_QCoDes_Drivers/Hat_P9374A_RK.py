@@ -6,10 +6,11 @@ Created on Tue Dec  8 16:31:55 2020
 
 purpose: add additional functionality to PNA driver without adding bulk to base driver
 """
-from Hatlab_QCoDes_Drivers.Keysight_P9374A import Keysight_P9374A
+from Hatlab_QCoDes_Drivers.Keysight_P9374A import Keysight_P9374A, SIM_FILE
 import numpy as np
 import easygui
 import time
+from concurrent.futures import ThreadPoolExecutor
 from plottr.data import datadict_storage as dds, datadict as dd
 # from data_processing.fitting.QFit import fit, plotRes, getData_from_datadict, reflectionFunc, rounder
 # import inspect
@@ -35,28 +36,33 @@ class Hat_P9374A(Keysight_P9374A):
         '''
         assert number > 0
         prev_trform = self.trform()
-        self.trform('POL')
-        time.sleep(self.del_time)
-        self.average_type("POIN")
-        time.sleep(self.del_time)
-        self.trigger_source("MAN")
-        time.sleep(self.del_time)
+        with self.batch():
+            self.trform('POL')
+            self.average_type("POIN")
+            self.trigger_source("MAN")
+            self.avgnum(number)
         total_time = self.sweep_time()*number+10
         #200ms window, if you need data faster talk to YR
-        time.sleep(self.del_time)
-        self.avgnum(number)
-        time.sleep(self.del_time)
         self.timeout(total_time)
-        time.sleep(self.del_time)
         print(f"Waiting {np.round(total_time, 1)}s for {number} averages...")
-        self.last_msmt_msg = self.ask('ABORT; INITIATE:IMMEDIATE; *OPC?')
-        time.sleep(self.del_time)
+        self.last_msmt_msg = self.ask('ABORT;INITIATE:IMMEDIATE;*OPC?')
         if not avg_over_freq: 
             return self.gettrace()
         else: 
             return np.average(self.gettrace(), axis = 1).reshape((2,1))
     
-    def savetrace(self, avgnum = 10, savedir = None, name = None): 
+    def savetrace(self, avgnum = 10, savedir = None, name = None, writer = None): 
+        '''
+        Averages a trace and saves it to a new DDH5 file in savedir, or, if a
+        VNA_TraceWriter.TraceSessionWriter is given, appends it to that
+        writer's open file as a record called name (trace_<index> if name is None)
+        '''
+        if writer is not None:
+            freqs = self.getSweepData()
+            vnadata = np.array(self.average(avgnum))
+            index = writer.add_trace(name, freqs, vnadata[0], vnadata[1])
+            self.set_to_manual()
+            return index
         if savedir == None:
             savedir = easygui.diropenbox("Choose file location: ")
             assert savedir != None
@@ -134,24 +140,31 @@ class Hat_P9374A(Keysight_P9374A):
         self.write(':TRIG:SING')
         return None
     def set_to_manual(self): 
-        self.rfout(1)
-        self.averaging(1)
-        self.avgnum(3)
-        self.trform('MLOG')
-        self.trigger_source('IMM')
-        self.average_type('SWE')
+        with self.batch():
+            self.rfout(1)
+            self.averaging(1)
+            self.avgnum(3)
+            self.trform('MLOG')
+            self.trigger_source('IMM')
+            self.average_type('SWE')
         
         
     def renormalize(self, num_avgs, pwr_bump = 0): 
-        self.power(self.power()+pwr_bump)
+        prev_power = self.power()
+        self.power(prev_power+pwr_bump)
         self.average(num_avgs)
-        self.data_to_mem()
-        self.math('DIV')
-        self.electrical_delay(0)
-        self.power(self.power()-pwr_bump)
-        self.set_to_manual()
+        with self.batch():
+            self.data_to_mem()
+            self.math('DIV')
+            self.electrical_delay(0)
+            self.power(prev_power)
+            self.set_to_manual()
         
-    def scattering_mtx_pair(self, datadir, fcenter1, fcenter2, fspan, SWT_info, avgnum = 5, MX = ''): 
+    def scattering_mtx_pair(self, datadir, fcenter1, fcenter2, fspan, SWT_info, avgnum = 5, MX = '', writer = None): 
+        '''
+        Saves S11, S22, S12 and S21 through the switch matrix, each to its own
+        file in datadir, or as records of writer if one is given
+        '''
         [SWT, name1in, name2in, name1out, name2out] = SWT_info
         
         #S11
@@ -160,7 +173,7 @@ class Hat_P9374A(Keysight_P9374A):
         self.fcenter(fcenter1)
         self.fspan(fspan)
         
-        self.savetrace(savedir = datadir, name = 'S11', avgnum = avgnum)
+        self.savetrace(savedir = datadir, name = 'S11', avgnum = avgnum, writer = writer)
         
         #S22
         SWT.set_mode_dict(name2in)
@@ -168,7 +181,7 @@ class Hat_P9374A(Keysight_P9374A):
         self.fcenter(fcenter2)
         self.fspan(fspan)
         
-        self.savetrace(savedir = datadir, name = 'S22', avgnum = avgnum)
+        self.savetrace(savedir = datadir, name = 'S22', avgnum = avgnum, writer = writer)
         
         #S12
         SWT.set_mode_dict(name2in)
@@ -177,7 +190,7 @@ class Hat_P9374A(Keysight_P9374A):
         self.fcenter(fcenter2)
         self.fspan(fspan)
         
-        self.savetrace(savedir = datadir, name = 'S12', avgnum = avgnum)
+        self.savetrace(savedir = datadir, name = 'S12', avgnum = avgnum, writer = writer)
         
         #S21
         SWT.set_mode_dict(name1in)
@@ -186,7 +199,30 @@ class Hat_P9374A(Keysight_P9374A):
         self.fcenter(fcenter1)
         self.fspan(fspan)
         
-        self.savetrace(savedir = datadir, name = 'S21', avgnum = avgnum)
+        self.savetrace(savedir = datadir, name = 'S21', avgnum = avgnum, writer = writer)
+
+    def save_sparams(self, datadir, name, sparams = ('S11', 'S21', 'S12', 'S22'), avgnum = 5):
+        '''
+        Measures all sparams in one sweep (see define_measurements) and saves
+        them to one file, instead of a savetrace cycle per S-parameter
+        '''
+        self.define_measurements(list(sparams))
+        msmt = self.measure_sparams(avgnum = avgnum)
+        fields = dict(frequency = dict(unit='Hz'))
+        for sparam in sparams:
+            fields[f'{sparam}_power'] = dict(axes=['frequency'], unit = 'dB')
+            fields[f'{sparam}_phase'] = dict(axes=['frequency'], unit = 'rad')
+        data = dd.DataDict(**fields)
+        values = dict(frequency = msmt['frequency'])
+        for sparam in sparams:
+            values[f'{sparam}_power'] = 20*np.log10(np.abs(msmt[sparam]))
+            values[f'{sparam}_phase'] = np.angle(msmt[sparam])
+        with dds.DDH5Writer(datadir, data, name=name) as writer:
+            writer.add_data(**values)
+            self.filepath = writer.file_path
+        self.set_to_manual()
+        return self.filepath
+
     def print_setup(self): 
         return self.fstart(), self.fstop()
     
@@ -214,8 +250,32 @@ class Hat_P9374A(Keysight_P9374A):
         self.set_to_manual()
         return 10*np.log10(G), f/1e9, np.abs(2*bw/1e6), popt, gain_func
     
-    def scan(self, start, stop, step, ifbw = 3000, avgnum = 1, savedir = None, name = None): 
-        
+    def scan_stimulus(self, start, stop, step):
+        '''
+        Stimulus of every window of a stitched scan, computed from the current
+        span and number of points without touching the sweep
+
+        Output:
+            center_points (n_windows), freqs (n_windows x num_points)
+        '''
+        center_points = np.arange(start, stop, step)
+        offsets = np.linspace(-self.fspan()/2, self.fspan()/2, self.num_points())
+        return center_points, center_points[:, None] + offsets[None, :]
+
+    def scan(self, start, stop, step, ifbw = None, avgnum = 1, savedir = None, name = None, overlap = True): 
+        '''
+        Steps fcenter from start to stop (exclusive) in steps of step, averages
+        a trace at every center and stitches them into one wide-band trace
+
+        Every window is written to the DDH5 file as soon as it is measured.
+        With overlap, the file write of a window runs in a background thread
+        while the next window is measured. The IF bandwidth is only changed
+        if ifbw is given.
+
+        Output:
+            file path; the stitched data is kept in self.scan_data as
+            (freqs, mags (dB), phases (rad))
+        '''
         if savedir == None:
             savedir = easygui.diropenbox("Choose file location: ")
             assert savedir != None
@@ -227,18 +287,13 @@ class Hat_P9374A(Keysight_P9374A):
             savedir = self.previous_save
             assert savedir != None
         
-        freqs_arr = []
-        mag_arr = []
-        phase_arr = []
-        center_points = np.arange(start, stop, step)
-        
-        for center in center_points: 
-            self.fcenter(center)
-            freqs = self.getSweepData()
-            mag, phase = self.average(avgnum)
-            np.append(freqs_arr, freqs)
-            np.append(mag_arr, mag)
-            np.append(phase_arr, phase)
+        if ifbw is not None:
+            self.ifbw(ifbw)
+        center_points, window_freqs = self.scan_stimulus(start, stop, step)
+        freqs_arr = window_freqs.reshape(-1)
+        mag_arr = np.zeros(freqs_arr.shape)
+        phase_arr = np.zeros(freqs_arr.shape)
+        n_pts = window_freqs.shape[1]
         
         data = dd.DataDict(
             frequency = dict(unit='Hz'),
@@ -246,13 +301,89 @@ class Hat_P9374A(Keysight_P9374A):
             phase = dict(axes=['frequency'], unit = 'Degrees'),
         )
 
+        executor = ThreadPoolExecutor(max_workers = 1) if overlap else None
+        pending = None
         with dds.DDH5Writer(savedir, data, name=name) as writer:
-            writer.add_data(
-                    frequency = freqs_arr,
-                    power = mag_arr,
-                    phase = phase_arr
-                )
+            try:
+                for i, center in enumerate(center_points): 
+                    self.fcenter(center)
+                    window = slice(i*n_pts, (i+1)*n_pts)
+                    mag_arr[window], phase_arr[window] = self.average(avgnum)
+                    values = dict(frequency = freqs_arr[window],
+                                  power = mag_arr[window],
+                                  phase = phase_arr[window])
+                    if pending is not None:
+                        pending.result()
+                    if executor is None:
+                        writer.add_data(**values)
+                    else:
+                        pending = executor.submit(writer.add_data, **values)
+                if pending is not None:
+                    pending.result()
+            finally:
+                if executor is not None:
+                    executor.shutdown(wait = True)
             self.filepath = writer.file_path
+        self.scan_data = (freqs_arr, mag_arr, phase_arr)
+        self.previous_save = savedir
         self.set_to_manual()
         
-        return self.filepath
\ No newline at end of file
+        return self.filepath
+
+
+def benchmark_scan(vna, start, stop, step, savedir, avgnum = 1):
+    '''
+    Times Hat_P9374A.scan with and without overlapping the file writes with
+    the next window. vna can be a real instrument or one opened on a
+    simulated VISA backend.
+
+    Output:
+        (seconds without overlap, seconds with overlap)
+    '''
+    t0 = time.perf_counter()
+    vna.scan(start, stop, step, avgnum = avgnum, savedir = savedir, name = 'scan_benchmark', overlap = False)
+    sequential = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    vna.scan(start, stop, step, avgnum = avgnum, savedir = savedir, name = 'scan_benchmark', overlap = True)
+    overlapped = time.perf_counter() - t0
+    n_windows = len(np.arange(start, stop, step))
+    print(f"{n_windows} windows: {sequential:.2f}s sequential, {overlapped:.2f}s with overlapped writes")
+    return sequential, overlapped
+
+
+def benchmark_batching(vna = None, repeats = 10):
+    '''
+    Times set_to_manual and renormalize with batch() sending each block as one
+    message and with every write sent on its own (vna.batching = False).
+    vna defaults to a Hat_P9374A opened on the simulated instrument (pyvisa-sim,
+    Keysight_P9374A.SIM_FILE), which is closed afterwards.
+
+    Output:
+        dict of method : {'batched': (s per call, messages per call),
+                          'unbatched': (s per call, messages per call)}
+    '''
+    own_vna = vna is None
+    if own_vna:
+        vna = Hat_P9374A('pna_batch_benchmark', 'GPIB::1::INSTR', pyvisa_sim_file = SIM_FILE, data_format = 'ASCII')
+    calls = {'set_to_manual': lambda: vna.set_to_manual(),
+             'renormalize': lambda: vna.renormalize(1)}
+    results = {}
+    prev_batching = vna.batching
+    try:
+        for method, call in calls.items():
+            results[method] = {}
+            for mode in ('batched', 'unbatched'):
+                vna.batching = mode == 'batched'
+                messages = vna.visa_messages
+                t0 = time.perf_counter()
+                for i in range(repeats):
+                    call()
+                elapsed = (time.perf_counter() - t0)/repeats
+                results[method][mode] = (elapsed, (vna.visa_messages - messages)/repeats)
+        for method, modes in results.items():
+            print(f"{method}: " + ", ".join(f"{mode} {t*1e3:.2f} ms / {n:.0f} messages" for mode, (t, n) in modes.items()))
+    finally:
+        vna.batching = prev_batching
+        if own_vna:
+            vna.close()
+    return results
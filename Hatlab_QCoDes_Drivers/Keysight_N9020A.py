@@ -7,13 +7,18 @@ A simple driver for Keysight_N9020A to be used with QCoDes, transferred from the
 """
 
 import logging
+import threading
 import warnings
 import time
+from collections import namedtuple
+from contextlib import contextmanager
 
 import numpy as np
 
 from qcodes import VisaInstrument
+from qcodes.instrument.channel import InstrumentChannel, ChannelList
 from qcodes.utils.validators import Numbers, Enum
+from pyvisa.errors import VisaIOError
 
 # list for accepted values for functions
 TRACE_MODES = ['ON', 'VIEW', 'BLANK', 'BACKGROUND']
@@ -22,17 +27,66 @@ TRACE_TYPES = ['writ', 'write', 'aver', 'average', 'maxh', 'maxhold',
 TRACE_DETECTORS = ['aver', 'average', 'neg', 'negative', 'norm', 'normal',
                    'pos', 'positive', 'samp', 'sample', 'qpe', 'qpeak',
                    'eav', 'eaverage', 'rav', 'raverage']
+NUM_TRACES = 6
+# state of one trace, as read by Keysight_N9020A.trace_states
+TraceState = namedtuple('TraceState', ['display', 'update', 'type', 'detector'])
+# result of the peak searches: one row per peak
+PEAK_DTYPE = np.dtype([('freq', float), ('amp', float)])
+# FORM:DATA argument and binary datatype for every supported transfer format.
+# Binary blocks are requested little-endian (FORM:BORD SWAP) to match the host.
+DATA_FORMATS = {'ASCII': ('ASC', None),
+                'REAL32': ('REAL,32', 'f'),
+                'REAL64': ('REAL,64', 'd')}
+
+
+class N9020A_Trace(InstrumentChannel):
+    """
+    One of the six traces of the N9020A. The parameters are read from the
+    analyzer's cached trace states, so reading all of them (e.g. in a
+    snapshot) costs a single query for all six traces.
+    """
+    def __init__(self, parent, name, trace):
+        super().__init__(parent, name)
+        self.trace = trace
+        self.add_parameter('display',
+                           label='display',
+                           get_cmd=lambda: self.parent.trace_states()[self.trace - 1].display,
+                           set_cmd=lambda value: self._set('TRAC%s:DISP %s' % (self.trace, value)),
+                           vals=Enum(0, 1))
+        self.add_parameter('update',
+                           label='update',
+                           get_cmd=lambda: self.parent.trace_states()[self.trace - 1].update,
+                           set_cmd=lambda value: self._set('TRAC%s:UPD %s' % (self.trace, value)),
+                           vals=Enum(0, 1))
+        self.add_parameter('type',
+                           label='type',
+                           get_cmd=lambda: self.parent.trace_states()[self.trace - 1].type,
+                           set_cmd=lambda value: self._set('TRAC%s:TYPE %s' % (self.trace, value)),
+                           set_parser=str.lower,
+                           vals=Enum(*TRACE_TYPES, *[t.upper() for t in TRACE_TYPES]))
+        self.add_parameter('detector',
+                           label='detector',
+                           get_cmd=lambda: self.parent.trace_states()[self.trace - 1].detector,
+                           set_cmd=lambda value: self._set('DET:TRAC%s %s' % (self.trace, value)),
+                           set_parser=str.lower,
+                           vals=Enum(*TRACE_DETECTORS, *[d.upper() for d in TRACE_DETECTORS]))
+
+    def _set(self, cmd):
+        self.parent.invalidate_trace_states()
+        self.parent.visa_handle.write(cmd)
 
 
 class Keysight_N9020A(VisaInstrument):
-    def __init__(self, name, address, reset=False, **kwargs):
+    def __init__(self, name, address, reset=False, data_format='REAL32', **kwargs):
         """
         Initializes the Keysight MXA N9020A
             Input:
                 name (string)    : name of the instrument
                 address (string) : TCP/IP address
                 reset (bool)     : resets to default values, default=False
+                data_format (string) : trace transfer format, 'ASCII', 'REAL32' or 'REAL64'
         """
+        self._sweep_duration = None
         super().__init__(name, address, terminator='\n', **kwargs)
         logging.info(__name__ + ' : Initializing Keysight N5183B')
 
@@ -153,8 +207,121 @@ class Keysight_N9020A(VisaInstrument):
                            get_cmd=':SWE:POIN?',
                            set_cmd=':SWE:POIN {}')
 
+        self._trace_states = None
+        traces = ChannelList(self, 'traces', N9020A_Trace)
+        for i in range(1, NUM_TRACES + 1):
+            trace = N9020A_Trace(self, 'trace%i' % i, i)
+            traces.append(trace)
+            self.add_submodule('trace%i' % i, trace)
+        traces.lock()
+        self.add_submodule('traces', traces)
+
+        self.add_parameter('data_format',
+                           label='data_format',
+                           get_cmd=self._get_data_format,
+                           set_cmd=self._set_data_format,
+                           vals=Enum(*DATA_FORMATS.keys()),
+                           docstring="format used to transfer trace data. 'REAL32'/'REAL64' use IEEE 488.2 "
+                                     "binary blocks, 'ASCII' uses comma separated text.")
+
         if reset:
             self.reset()
+        self.data_format(data_format)
+
+    def _set_data_format(self, fmt):
+        self.visa_handle.write('FORM:DATA %s' % DATA_FORMATS[fmt][0])
+        if DATA_FORMATS[fmt][1] is not None:
+            self.visa_handle.write('FORM:BORD SWAP')
+        self._data_format = fmt
+
+    def _get_data_format(self):
+        return self._data_format
+
+    def _ask_values(self, cmd):
+        '''
+        Queries a list of numbers in the current data format, returns array
+        '''
+        datatype = DATA_FORMATS[self._data_format][1]
+        if datatype is None:
+            return np.fromstring(self.visa_handle.query(cmd).strip().lstrip('[').rstrip(']'), sep=',')
+        return self.visa_handle.query_binary_values(cmd, datatype=datatype, is_big_endian=False,
+                                                    container=np.array)
+
+    def write_raw(self, cmd):
+        # span, bandwidths, points and averages all change the sweep duration
+        self.invalidate_sweep_duration()
+        super().write_raw(cmd)
+
+    def expected_sweep_duration(self, refresh=False):
+        '''
+        Upper estimate (s) of the time a complete measurement (all averages) takes.
+        The result is cached until a setting is written through this driver
+        (or refresh is True).
+        '''
+        if self._sweep_duration is None or refresh:
+            self._sweep_duration = self.sweep_time() * max(self.max_count(), 1)
+        return self._sweep_duration
+
+    def invalidate_sweep_duration(self):
+        self._sweep_duration = None
+
+    def wait_for_operation(self, timeout=None, max_poll=0.5):
+        '''
+        Polls *ESR? until the operation complete bit set by a preceding *OPC is
+        seen. The poll interval starts short and doubles up to max_poll.
+            Input:
+                timeout (float) : give up after this many seconds,
+                                  default 2 * expected_sweep_duration() + 5
+        '''
+        if timeout is None:
+            timeout = 2 * self.expected_sweep_duration() + 5
+        t0 = time.perf_counter()
+        interval = min(0.01, max_poll)
+        while not int(self.visa_handle.query('*ESR?')) & 1:
+            if time.perf_counter() - t0 > timeout:
+                raise TimeoutError('%s: measurement not complete after %.1fs' % (self.name, timeout))
+            time.sleep(interval)
+            interval = min(2 * interval, max_poll)
+
+    def acquire(self, timeout=None):
+        '''
+        Starts a new measurement (all averages in single mode) and waits until it is complete
+        '''
+        self.visa_handle.write('*CLS')
+        self.visa_handle.write(':INIT:IMM')
+        self.visa_handle.write('*OPC')
+        self.wait_for_operation(timeout)
+
+    def get_trace(self, trace=1, acquire=False, timeout=None):
+        '''
+        Reads the y values of one of the traces 1-6
+            Input:
+                trace (int) : trace number
+                acquire (bool) : start a new measurement and wait for it first
+                timeout (float) : bound (s) of the wait for the measurement
+            Output:
+                data (numpy array) : y values in the trace's units
+        '''
+        self.is_valid_channel(trace)
+        if acquire:
+            self.acquire(timeout)
+        return self._ask_bounded('TRAC:DATA? TRACE%s' % trace, timeout)
+
+    def _ask_bounded(self, cmd, timeout=None):
+        '''
+        Queries values, allowing the instrument up to timeout seconds to finish
+        the measurement it holds the answer for
+        '''
+        if timeout is None:
+            timeout = 2 * self.expected_sweep_duration() + 5
+        prev_timeout = self.visa_handle.timeout
+        self.visa_handle.timeout = timeout * 1000
+        try:
+            return self._ask_values(cmd)
+        except VisaIOError as e:
+            raise TimeoutError('%s: no data for %s within %.1fs' % (self.name, cmd, timeout)) from e
+        finally:
+            self.visa_handle.timeout = prev_timeout
 
     def set_max_count(self, maxval):
         '''
@@ -167,70 +334,55 @@ class Keysight_N9020A(VisaInstrument):
         warnings.warn("This function is deprecated, is is recommended to call max_count(maxval) directly",
                       DeprecationWarning)
         logging.info(__name__ + ' Setting the max hol count to %s' % maxval)
-        self.visa_handle.write('AVER:COUN %s' % maxval)
+        self.write('AVER:COUN %s' % maxval)
 
-    def get_data(self, count=0, channel=1, mute=False):
+    def get_data(self, count=0, channel=1, mute=False, timeout=None):
         '''
-        Reads the data from the current sweep (NEEDS TESTED)
+        Reads the data from the current sweep
             Input:
                 count (int) : sets max hold value between 1 and 10,000
                 0 uses the value stored in the instrument
-                channel (int):
+                channel (int): trace 1-6
+                timeout (float) : bound (s) of the wait for the measurement,
+                                  default 2 * expected_sweep_duration() + 5
             Output:
                 data (numpy 2dArray) : [x, y] values
         '''
-        data = None
-        if count is not 0:
+        if count != 0:
             if count > 10000:
                 count = 10000
                 logging.warning(__name__ +
                                 ' Count too high. set to max value 10000')
-            self.visa_handle.write('AVER:COUN %s' % count)
-        if channel < 1 or channel > 6:
-            raise ValueError('channel must be between 1 and 6')
-        else:
-            pass
-        while data is None:
-            try:
-                data = self.visa_handle.query('CALC:DATA%s?' % channel)
-            except Exception as e:
-                print('Running test.')
-                logging.info(__name__ + str(type(e)) +
-                             ' raised. Count not done')
-            else:
-                if not mute:
-                    print('Count complete')
-                logging.info(__name__ + ' Reading the trace data')
-                data = data.lstrip('[').rstrip(']').split(',')
-                data = [float(value) for value in data]
-                np_array = np.reshape(data, (-1, 2))
-                return np_array
+            self.write('AVER:COUN %s' % count)
+        self.is_valid_channel(channel)
+        data = self._ask_bounded('CALC:DATA%s?' % channel, timeout)
+        if not mute:
+            print('Count complete')
+        logging.info(__name__ + ' Reading the trace data')
+        return np.reshape(data, (-1, 2))
 
     def average(self):
         self.visa_handle.write('AVER:CLE')
 
-    def get_ydata(self, count=0, channel=1, mute=False):
+    def get_ydata(self, count=0, channel=1, mute=False, timeout=None):
         '''
-        Reads the data from the current sweep (NEEDS TESTED)
+        Reads the data from the current sweep
             Input:
-                channel (int):
+                channel (int): trace 1-6
             Output:
-                data (numpy 2dArray) : [x, y] values
+                data (numpy array) : y values
         '''
-        data = None
-        if channel < 1 or channel > 6:
-            raise ValueError('channel must be between 1 and 6')
-        data = self.visa_handle.query('TRAC? TRACE1')
-        data = data.lstrip('[').rstrip(']').split(',')
-        data = [float(value) for value in data]
-        np_array = np.array(data)
-        return np_array
+        if count != 0:
+            self.write('AVER:COUN %s' % min(count, 10000))
+        return self.get_trace(channel, timeout=timeout)
 
     def get_previous_data(self, channel=1):
         '''
         Reads the data already acquired without starting a new test
+            Output:
+                data (numpy array) : x, y values interleaved, in the current data format
         '''
-        return self.visa_handle.query('CALC:DATA%s?' % channel)
+        return self._ask_values('CALC:DATA%s?' % channel)
 
     def get_average(self):
         '''
@@ -239,7 +391,7 @@ class Keysight_N9020A(VisaInstrument):
                 average (float) :the average
         '''
         logging.info(__name__ + ' Reading the average value')
-        return self.visa_handle.query('CALC:DATA:COMP? MEAN')
+        return float(self._ask_values('CALC:DATA:COMP? MEAN')[0])
 
     def trace_type(self, trace_type, channel=1):
         '''
@@ -257,6 +409,7 @@ class Keysight_N9020A(VisaInstrument):
         logging.info(__name__ +
                      ' setting trace type to {} on channel {}'.format(trace_type,
                                                                       channel))
+        self.invalidate_trace_states()
         self.visa_handle.write('TRAC{}:TYPE {}'.format(channel,
                                                        trace_type))
 
@@ -276,79 +429,62 @@ class Keysight_N9020A(VisaInstrument):
         logging.info(__name__ +
                      ' setting the detector to {} for channel {}'.format(detector,
                                                                          channel))
+        self.invalidate_trace_states()
         self.visa_handle.write('DET:TRAC{} {}'.format(channel, detector))
 
-    def get_trace_1(self):
+    def trace_states(self, refresh=False):
         '''
-        Reads the style of trace 1
+        Reads display, update, type and detector of all six traces with one
+        query. The result is cached until a trace setting is changed through
+        this driver (or refresh is True).
             Output:
-                values (list) : [Display, Update, Type, Detector] ON = 1 OFF =2
+                list of TraceState, index 0 is trace 1
         '''
-        logging.info(__name__ + ' Reading state of trace 1')
-        return ['Disp: ' + self.visa_handle.query('TRAC1:DISP?'),
-                'Upd: ' + self.visa_handle.query('TRAC1:UPD?'),
-                'Type: ' + self.visa_handle.query('TRAC1:TYPE?'),
-                'Det: ' + self.visa_handle.query('DET:TRAC1?')]
+        if self._trace_states is None or refresh:
+            logging.info(__name__ + ' Reading state of all traces')
+            query = ';'.join(':TRAC{0}:DISP?;:TRAC{0}:UPD?;:TRAC{0}:TYPE?;:DET:TRAC{0}?'.format(i)
+                             for i in range(1, NUM_TRACES + 1))
+            fields = [field.strip() for field in self.visa_handle.query(query).split(';')]
+            self._trace_states = [TraceState(int(fields[4 * i]), int(fields[4 * i + 1]), fields[4 * i + 2],
+                                             fields[4 * i + 3]) for i in range(NUM_TRACES)]
+        return self._trace_states
 
-    def get_trace_2(self):
+    def invalidate_trace_states(self):
+        self._trace_states = None
+
+    def snapshot_base(self, update=False, params_to_skip_update=None):
+        if update:
+            self.invalidate_trace_states()
+        return super().snapshot_base(update=update, params_to_skip_update=params_to_skip_update)
+
+    def get_trace_style(self, trace=1):
         '''
-        Reads the style of trace 2
+        Reads the style of a trace
             Output:
                 values (list) : [Display, Update, Type, Detector] ON = 1 OFF =2
         '''
-        logging.info(__name__ + ' Reading state of trace 2')
-        return ['Disp: ' + self.visa_handle.query('TRAC2:DISP?'),
-                'Upd: ' + self.visa_handle.query('TRAC2:UPD?'),
-                'Type: ' + self.visa_handle.query('TRAC2:TYPE?'),
-                'Det: ' + self.visa_handle.query('DET:TRAC2?')]
+        self.is_valid_channel(trace)
+        state = self.trace_states(refresh=True)[trace - 1]
+        return ['Disp: %s' % state.display, 'Upd: %s' % state.update,
+                'Type: ' + state.type, 'Det: ' + state.detector]
+
+    def get_trace_1(self):
+        return self.get_trace_style(1)
+
+    def get_trace_2(self):
+        return self.get_trace_style(2)
 
     def get_trace_3(self):
-        '''
-        Reads the style of trace 3
-            Output:
-                values (list) : [Display, Update, Type, Detector] ON = 1 OFF =2
-        '''
-        logging.info(__name__ + ' Reading state of trace 3')
-        return ['Disp: ' + self.visa_handle.query('TRAC3:DISP?'),
-                'Upd: ' + self.visa_handle.query('TRAC3:UPD?'),
-                'Type: ' + self.visa_handle.query('TRAC3:TYPE?'),
-                'Det: ' + self.visa_handle.query('DET:TRAC3?')]
+        return self.get_trace_style(3)
 
     def get_trace_4(self):
-        '''
-        Reads the style of trace 4
-            Output:
-                values (list) : [Display, Update, Type, Detector] ON = 1 OFF =2
-        '''
-        logging.info(__name__ + ' Reading state of trace 4')
-        return ['Disp: ' + self.visa_handle.query('TRAC4:DISP?'),
-                'Upd: ' + self.visa_handle.query('TRAC4:UPD?'),
-                'Type: ' + self.visa_handle.query('TRAC4:TYPE?'),
-                'Det: ' + self.visa_handle.query('DET:TRAC4?')]
+        return self.get_trace_style(4)
 
     def get_trace_5(self):
-        '''
-        Reads the style of trace 5
-            Output:
-                values (list) : [Display, Update, Type, Detector] ON = 1 OFF =2
-        '''
-        logging.info(__name__ + ' Reading state of trace 5')
-        return ['Disp: ' + self.visa_handle.query('TRAC5:DISP?'),
-                'Upd: ' + self.visa_handle.query('TRAC5:UPD?'),
-                'Type: ' + self.visa_handle.query('TRAC5:TYPE?'),
-                'Det: ' + self.visa_handle.query('DET:TRAC5?')]
+        return self.get_trace_style(5)
 
     def get_trace_6(self):
-        '''
-        Reads the style of trace 6
-            Output:
-                values (list) : [Display, Update, Type, Detector] ON = 1 OFF =2
-        '''
-        logging.info(__name__ + ' Reading state of trace 6')
-        return ['Disp: ' + self.visa_handle.query('TRAC6:DISP?'),
-                'Upd: ' + self.visa_handle.query('TRAC6:UPD?'),
-                'Type: ' + self.visa_handle.query('TRAC6:TYPE?'),
-                'Det: ' + self.visa_handle.query('DET:TRAC6?')]
+        return self.get_trace_style(6)
 
     def get_frequency_center(self):
         '''
@@ -571,6 +707,7 @@ class Keysight_N9020A(VisaInstrument):
                 channel (int) : channel to alter [1-6]
         '''
         logging.info(__name__ + ' Setting channel %s to on' % channel)
+        self.invalidate_trace_states()
         self.visa_handle.write('TRAC%s:UPD 1' % channel)
         self.visa_handle.write('TRAC%s:DISP 1' % channel)
 
@@ -581,6 +718,7 @@ class Keysight_N9020A(VisaInstrument):
                 channel (int) : channel to alter [1-6]
         '''
         logging.info(__name__ + ' Setting channel %s to view' % channel)
+        self.invalidate_trace_states()
         self.visa_handle.write('TRAC%s:UPD 0' % channel)
         self.visa_handle.write('TRAC%s:DISP 1' % channel)
 
@@ -591,6 +729,7 @@ class Keysight_N9020A(VisaInstrument):
                 channel (int) : channel to alter [1-6]
         '''
         logging.info(__name__ + ' Setting channel %s to blank' % channel)
+        self.invalidate_trace_states()
         self.visa_handle.write('TRAC%s:UPD 0' % channel)
         self.visa_handle.write('TRAC%s:DISP 0' % channel)
 
@@ -601,6 +740,7 @@ class Keysight_N9020A(VisaInstrument):
                 channel (int) : channel to alter [1-6]
         '''
         logging.info(__name__ + ' Setting channel %s to background' % channel)
+        self.invalidate_trace_states()
         self.visa_handle.write('TRAC%s:UPD 1' % channel)
         self.visa_handle.write('TRAC%s:DISP 0' % channel)
 
@@ -709,6 +849,8 @@ class Keysight_N9020A(VisaInstrument):
         Resets the device to default state
         '''
         logging.info(__name__ + ' : resetting the device')
+        self.invalidate_trace_states()
+        self.invalidate_sweep_duration()
         self.visa_handle.write('*RST')
 
     def send_command(self, command):
@@ -717,6 +859,8 @@ class Keysight_N9020A(VisaInstrument):
             Input:
                 command (string) : command to be sent (see manual for commands)
         '''
+        self.invalidate_trace_states()
+        self.invalidate_sweep_duration()
         self.visa_handle.write(command)
 
     def retrieve_data(self, query):
@@ -835,5 +979,262 @@ class Keysight_N9020A(VisaInstrument):
         else:
             self.visa_handle.write(':INIT:CONT OFF')
 
+    def configure_peak_table(self, threshold=-90, excursion=6, state=True):
+        '''
+        Sets the peak criteria used by the marker peak searches and the
+        on-screen peak table
+            Input:
+                threshold (float) : peaks below this level (dBm) are ignored
+                excursion (float) : a peak must rise and fall by this much (dB)
+                state (bool) : show the peak table
+        '''
+        self.visa_handle.write(':CALC:MARK:PEAK:THR %s' % threshold)
+        self.visa_handle.write(':CALC:MARK:PEAK:EXC %s' % excursion)
+        self.visa_handle.write(':CALC:MARK:PEAK:TABL:STAT %s' % ('ON' if state else 'OFF'))
+
+    def get_peaks(self, trace=1, threshold=-90, excursion=6, sort='AMPL'):
+        '''
+        Lets the analyzer search all peaks of a trace and reads them with one
+        query (binary in the REAL formats)
+            Input:
+                trace (int) : trace 1-6
+                threshold (float) : peaks below this level (dBm) are ignored
+                excursion (float) : a peak must rise and fall by this much (dB)
+                sort (string) : 'AMPL' (largest first) or 'FREQ' (lowest first)
+            Output:
+                peaks (numpy structured array) : fields freq (Hz), amp (dBm)
+        '''
+        self.is_valid_channel(trace)
+        # the reply is the number of peaks followed by (amplitude, frequency) pairs
+        data = self._ask_values(':CALC:DATA%s:PEAK? %s,%s,%s' % (trace, threshold, excursion, sort))
+        n = int(data[0])
+        pairs = np.reshape(data[1:1 + 2 * n], (n, 2))
+        peaks = np.zeros(n, dtype=PEAK_DTYPE)
+        peaks['amp'] = pairs[:, 0]
+        peaks['freq'] = pairs[:, 1]
+        return peaks
+
+    def get_trace_xy(self, trace=1, acquire=False, timeout=None):
+        '''
+        Reads a trace and the frequencies of its points
+            Output:
+                freqs (numpy array), amps (numpy array)
+        '''
+        amps = self.get_trace(trace, acquire=acquire, timeout=timeout)
+        freqs = np.linspace(self.frequency_start(), self.frequency_stop(), len(amps))
+        return freqs, amps
+
+    def start_monitor(self, trace=1, depth=1024, max_rate=10.0):
+        '''
+        Starts fetching a trace continuously in a background thread, see SpectrumMonitor
+        '''
+        monitor = SpectrumMonitor(self, trace=trace, depth=depth, max_rate=max_rate)
+        monitor.start()
+        return monitor
+
+
+def find_peaks(freqs, amps, threshold=-90, excursion=6, sort='AMPL'):
+    '''
+    Vectorized peak search over a fetched trace, with the criteria of the
+    analyzer: a peak is a local maximum above threshold that rises by at least
+    excursion above the lowest point between it and the next higher peak on
+    either side (or the trace edge)
+        Input:
+            freqs, amps (numpy arrays) : trace, e.g. from Keysight_N9020A.get_trace_xy
+            threshold (float) : peaks below this level are ignored
+            excursion (float) : required rise and fall (dB)
+            sort (string) : 'AMPL' (largest first) or 'FREQ' (lowest first)
+        Output:
+            peaks (numpy structured array) : fields freq, amp
+    '''
+    amps = np.asarray(amps, dtype=float)
+    freqs = np.asarray(freqs, dtype=float)
+    diff = np.diff(amps)
+    candidates = np.flatnonzero((diff[:-1] > 0) & (diff[1:] <= 0)) + 1
+    candidates = candidates[amps[candidates] >= threshold]
+    while len(candidates) > 0:
+        # minimum between consecutive candidates (and the trace edges)
+        valleys = np.minimum.reduceat(amps, np.r_[0, candidates])
+        peak_amps = amps[candidates]
+        left_drop = peak_amps - valleys[:-1]
+        right_drop = peak_amps - valleys[1:]
+        left_higher = np.r_[False, peak_amps[:-1] >= peak_amps[1:]]
+        right_higher = np.r_[peak_amps[1:] > peak_amps[:-1], False]
+        # a candidate too close to a higher neighbour is a ripple on its flank: remove it so
+        # that the valleys of the remaining candidates are measured over the merged range
+        ripple = ((left_drop < excursion) & left_higher) | ((right_drop < excursion) & right_higher)
+        if not ripple.any():
+            break
+        candidates = candidates[~ripple]
+    if len(candidates) > 0:
+        candidates = candidates[(left_drop >= excursion) & (right_drop >= excursion)]
+    peaks = np.zeros(len(candidates), dtype=PEAK_DTYPE)
+    peaks['freq'] = freqs[candidates]
+    peaks['amp'] = amps[candidates]
+    if sort.upper().startswith('AMPL'):
+        peaks = peaks[np.argsort(-peaks['amp'], kind='stable')]
+    return peaks
+
+
+class SpectrumSubscription:
+    '''
+    A consumer of a SpectrumMonitor, created with SpectrumMonitor.subscribe
+    '''
+    def __init__(self, monitor, lossless):
+        self._monitor = monitor
+        self.lossless = lossless
+        self.dropped = 0
+        self._held = monitor.count - 1  # last frame handed out, the ones after it are unread
+
+    def next(self, timeout=None):
+        '''
+        Waits for the next frame and returns (trace, timestamp, frame number).
+
+        trace is a read-only view into the monitor's ring buffer, no copy is
+        made. For a lossless subscription the view stays valid until the next
+        call of next(): the monitor waits rather than overwrite it. A lossy
+        subscription that fell behind skips to the newest frame (counted in
+        dropped) and its view can be overwritten after depth more frames.
+
+        Returns None if no frame arrived within timeout seconds.
+        '''
+        mon = self._monitor
+        with mon._cond:
+            if not mon._cond.wait_for(lambda: mon.count > self._held + 1 or not mon.running, timeout):
+                return None
+            if mon.count <= self._held + 1:
+                return None
+            frame = self._held + 1
+            if not self.lossless and frame <= mon.count - mon.depth:
+                self.dropped += mon.count - 1 - frame
+                frame = mon.count - 1
+            self._held = frame
+            mon._cond.notify_all()
+            row = frame % mon.depth
+            view = mon._buffer[row]
+            view.flags.writeable = False
+            return view, mon._times[row], frame
+
+    def __iter__(self):
+        while True:
+            frame = self.next(timeout=1.0)
+            if frame is not None:
+                yield frame
+            elif not self._monitor.running:
+                return
+
+    def close(self):
+        self._monitor.unsubscribe(self)
+
+
+class SpectrumMonitor:
+    '''
+    Fetches one trace of a Keysight_N9020A continuously in a background thread
+    into a fixed-size ring buffer (a waterfall of the last depth traces).
+
+    The buffer and timestamps are allocated once, so the memory use stays flat
+    however long the monitor runs. Traces are fetched at most max_rate times a
+    second. Lossless subscribers apply back-pressure: the thread waits rather
+    than overwrite a frame one of them has not read yet.
+
+    The analyzer must not be used from another thread while the monitor runs,
+    except inside a `with monitor.paused():` block.
+    '''
+    def __init__(self, analyzer, trace=1, depth=1024, max_rate=10.0):
+        if depth < 2:
+            raise ValueError('depth must be at least 2')
+        analyzer.is_valid_channel(trace)
+        self.analyzer = analyzer
+        self.trace = trace
+        self.depth = depth
+        self.max_rate = max_rate
+        self.count = 0  # frames written since start
+        self.errors = 0
+        self.running = False
+        self._buffer = np.zeros((depth, int(analyzer.num_points())))
+        self._times = np.zeros(depth)
+        self._subscribers = []
+        self._cond = threading.Condition()
+        self._fetch_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name='%s_monitor' % self.analyzer.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @contextmanager
+    def paused(self):
+        '''
+        Holds the monitor between two fetches, so the analyzer can be used in the with block
+        '''
+        with self._fetch_lock:
+            yield self.analyzer
+
+    def subscribe(self, lossless=True):
+        with self._cond:
+            subscription = SpectrumSubscription(self, lossless)
+            self._subscribers.append(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._cond:
+            if subscription in self._subscribers:
+                self._subscribers.remove(subscription)
+            self._cond.notify_all()
+
+    def _can_write(self):
+        # writing frame count overwrites frame count - depth
+        return all(self.count - self.depth < sub._held for sub in self._subscribers if sub.lossless)
+
+    def waterfall(self):
+        '''
+        Copy of the buffered traces and timestamps, oldest first
+        '''
+        with self._cond:
+            n = min(self.count, self.depth)
+            rows = (np.arange(self.count - n, self.count)) % self.depth
+            return self._buffer[rows], self._times[rows]
+
+    def _run(self):
+        interval = 1.0 / self.max_rate
+        while not self._stop.is_set():
+            t0 = time.perf_counter()
+            try:
+                with self._fetch_lock:
+                    data = self.analyzer.get_trace(self.trace)
+            except Exception as e:
+                self.errors += 1
+                logging.warning(__name__ + ' : monitor fetch failed: %s' % e)
+                self._stop.wait(max(interval, 1.0))
+                continue
+            with self._cond:
+                self._cond.wait_for(lambda: self._can_write() or self._stop.is_set())
+                if self._stop.is_set():
+                    break
+                if len(data) != self._buffer.shape[1]:
+                    # the number of points changed, start a new waterfall
+                    logging.info(__name__ + ' : trace length changed to %i, clearing the monitor' % len(data))
+                    self._buffer = np.zeros((self.depth, len(data)))
+                row = self.count % self.depth
+                self._buffer[row] = data
+                self._times[row] = time.time()
+                self.count += 1
+                self._cond.notify_all()
+            self._stop.wait(max(0.0, interval - (time.perf_counter() - t0)))
+
 if __name__ == "__main__":
     MXA = Keysight_N9020A("MXA", address='TCPIP0::192.168.137.101::INSTR')
\ No newline at end of file
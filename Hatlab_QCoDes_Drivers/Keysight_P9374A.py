@@ -11,9 +11,75 @@ import types
 import logging
 import numpy as np
 import time
+from contextlib import contextmanager
 from qcodes import (Instrument, VisaInstrument,
                     ManualParameter, MultiParameter,
                     validators as vals)
+from pyvisa.util import from_ieee_block, to_ieee_block
+from Hatlab_QCoDes_Drivers.VNA_Segments import as_segments, segment_stimulus
+
+# FORM:DATA argument and binary datatype for every supported transfer format.
+# Binary blocks are requested little-endian (FORM:BORD SWAP) to match the host.
+DATA_FORMATS = {'ASCII': ('ASC,0', None),
+                'REAL32': ('REAL,32', 'f'),
+                'REAL64': ('REAL,64', 'd')}
+
+class TraceStatistics:
+    '''
+    Running mean and variance (Welford) of complex traces, updated in place.
+
+    All arrays are allocated once for num_points and reused for every sweep:
+        trace : the latest sweep
+        mean  : running mean of the sweeps so far
+        m2    : running sum of squared deviations |x - mean|^2
+    '''
+    def __init__(self, num_points):
+        self.count = 0
+        self.trace = np.zeros(num_points, dtype = complex)
+        self.mean = np.zeros(num_points, dtype = complex)
+        self.m2 = np.zeros(num_points)
+        self._delta = np.zeros(num_points, dtype = complex)
+        self._tmp = np.zeros(num_points, dtype = complex)
+        self._snr = np.zeros(num_points)
+
+    def update(self):
+        '''
+        Adds self.trace to the statistics
+        '''
+        self.count += 1
+        np.subtract(self.trace, self.mean, out = self._delta)
+        np.divide(self._delta, self.count, out = self._tmp)
+        self.mean += self._tmp
+        np.subtract(self.trace, self.mean, out = self._tmp)
+        np.conjugate(self._delta, out = self._delta)
+        np.multiply(self._delta, self._tmp, out = self._delta)
+        self.m2 += self._delta.real
+
+    def variance(self):
+        '''
+        Sample variance of a single sweep at every point
+        '''
+        if self.count < 2:
+            return np.full_like(self.m2, np.inf)
+        return self.m2/(self.count - 1)
+
+    def snr(self):
+        '''
+        Median over the trace of |mean|/(standard error of the mean)
+        '''
+        if self.count < 2:
+            return 0.0
+        np.divide(self.m2, self.count*(self.count - 1), out = self._snr)
+        np.sqrt(self._snr, out = self._snr)
+        np.divide(np.absolute(self.mean, out = self._tmp.real), self._snr, out = self._snr)
+        return float(np.median(self._snr, overwrite_input = True))
+
+    def mag_phase(self):
+        '''
+        Mean as [[mags (dB)], [phases (rad)]], like Keysight_P9374A.gettrace
+        '''
+        return np.array([20*np.log10(np.abs(self.mean)), np.angle(self.mean)])
+
 
 class Keysight_P9374A(VisaInstrument):
     '''
@@ -24,7 +90,7 @@ class Keysight_P9374A(VisaInstrument):
 
     '''
     
-    def __init__(self, name, address = None, **kwargs):
+    def __init__(self, name, address = None, data_format = 'REAL64', **kwargs):
 
         '''
         Initializes the Keysight_P9374A, and communicates with the wrapper.
@@ -32,11 +98,15 @@ class Keysight_P9374A(VisaInstrument):
         Input:
           name (string)    : name of the instrument
           address (string) : GPIB address
+          data_format (string) : trace transfer format, 'ASCII', 'REAL32' or 'REAL64'
           reset (bool)     : resets to default values, default=False
         '''
         if address == None: 
             raise Exception('TCP IP address needed')
         logging.info(__name__ + ' : Initializing instrument Keysight PNA')
+        self._batch = None # queued writes while inside batch()
+        self.batching = True # False makes batch() send every write on its own, for comparison
+        self.visa_messages = 0 # number of messages sent to the instrument
         
         super().__init__(name, address, terminator = '\n', **kwargs)
 
@@ -94,7 +164,13 @@ class Keysight_P9374A(VisaInstrument):
         self.add_parameter('trigger_source',
                            get_cmd = ':TRIG:SOUR?',
                            set_cmd = ':TRIG:SOUR {}',
-                           vals = vals.Enum('INT','EXT','MAN','BUS')
+                           vals = vals.Enum('INT','EXT','MAN','BUS','IMM')
+                           )
+
+        self.add_parameter('average_type',
+                           get_cmd = ':SENS1:AVER:MODE?',
+                           set_cmd = ':SENS1:AVER:MODE {}',
+                           vals = vals.Enum('POIN','SWE')
                            )
 
         self.add_parameter('ifbw', 
@@ -141,8 +217,8 @@ class Keysight_P9374A(VisaInstrument):
                            get_parser = float, 
                            vals = vals.Numbers())
         self.add_parameter('electrical_delay', 
-                           get_cmd = 'CALC1:CORR:EDEL:TIME?', 
-                           set_cmd = 'CALC1:CORR:EDEL:TIME {}', 
+                           get_cmd = ':CALC1:CORR:EDEL:TIME?', 
+                           set_cmd = ':CALC1:CORR:EDEL:TIME {}', 
                            unit = 's',
                            get_parser = float,
                            vals = vals.Numbers()
@@ -183,7 +259,23 @@ class Keysight_P9374A(VisaInstrument):
                            get_parser = float,
                            unit = 's'
                            )
-        self.write('CALC1:PAR:MNUM 1') #sets the active msmt to the first channel/trace
+        self.add_parameter('data_format',
+                           get_cmd = self._get_data_format,
+                           set_cmd = self._set_data_format,
+                           vals = vals.Enum(*DATA_FORMATS.keys()),
+                           docstring = "format used to transfer trace and stimulus data. "
+                                       "'REAL64'/'REAL32' use IEEE 488.2 binary blocks, "
+                                       "'ASCII' uses comma separated text."
+                           )
+        self.add_parameter('active_measurement',
+                           get_cmd = ':CALC1:PAR:MNUM?',
+                           set_cmd = ':CALC1:PAR:MNUM {}',
+                           get_parser = int,
+                           vals = vals.Ints(1)
+                           )
+        self._measurements = {} # S-parameter : measurement number, see define_measurements
+        self.data_format(data_format)
+        self.active_measurement(1) #sets the active msmt to the first channel/trace
         self.connect_message()
         
 
@@ -202,8 +294,7 @@ class Keysight_P9374A(VisaInstrument):
             sweep_values (Hz, dBm, etc...)
         '''
         logging.info(__name__ + ' : get stim data')
-        strdata= str(self.ask(':SENS1:X:VAL?'))
-        return np.array(list(map(float,strdata.split(','))))
+        return self._ask_values(':SENS1:X:VAL?')
 
     def getfdata(self):
         return self.getSweepData()
@@ -220,9 +311,8 @@ class Keysight_P9374A(VisaInstrument):
         logging.info(__name__ + ' : get amp, phase stim data')
         prev_trform = self.trform()
         self.trform('POL')
-        strdata= str(self.ask(':CALC1:DATA? FDATA'))
+        data = self._ask_values(':CALC1:DATA? FDATA')
         self.trform(prev_trform)
-        data = np.array(strdata.split(',')).astype(float)
         
         if len(data)%2 == 0:
             print('reshaping data')
@@ -239,6 +329,275 @@ class Keysight_P9374A(VisaInstrument):
             return data#.transpose() # mags, phase
         
 
+    def _set_data_format(self, fmt):
+        self.write(f':FORM:DATA {DATA_FORMATS[fmt][0]}')
+        if DATA_FORMATS[fmt][1] is not None:
+            self.write(':FORM:BORD SWAP')
+        self._data_format = fmt
+
+    def _get_data_format(self):
+        return self._data_format
+
+    def _ask_values(self, cmd):
+        '''
+        Queries a list of numbers in the current data format, returns array
+
+        Binary formats are decoded from the definite-length block directly
+        into a numpy array, without building an intermediate string.
+        '''
+        datatype = DATA_FORMATS[self._data_format][1]
+        if datatype is None:
+            return np.fromstring(str(self.ask(cmd)), sep=',')
+        self._flush_batch()
+        self.visa_messages += 1
+        return self.visa_handle.query_binary_values(cmd, datatype=datatype,
+                                                    is_big_endian=False,
+                                                    container=np.array)
+
+    def set_segments(self, segments):
+        '''
+        Replaces the segment table of channel 1 and switches to a segmented sweep.
+        The table is sent with a single SENS1:SEGM:LIST SSTOP command, whose
+        values per segment are state, points, start, stop, IFBW, dwell time and power.
+
+        Input:
+            segments : list of (start, stop, points, ifbw, power), see VNA_Segments,
+                       e.g. built with VNA_Segments.segments_around
+        Output:
+            stimulus frequencies (Hz) of the segmented sweep
+        '''
+        segments = as_segments(segments)
+        per_ifbw = any(seg.ifbw is not None for seg in segments)
+        per_power = any(seg.power is not None for seg in segments)
+        # the list holds an IFBW and power for every segment, they are only used with BWID:CONT/POW:CONT on
+        ifbw = float(self.ifbw())
+        power = float(self.power())
+        table = []
+        for seg in segments:
+            table += [1, int(seg.points), float(seg.start), float(seg.stop),
+                      float(ifbw if seg.ifbw is None else seg.ifbw), 0,
+                      float(power if seg.power is None else seg.power)]
+        with self.batch():
+            self.write(f'SENS1:SEGM:LIST SSTOP,{len(segments)},' + ','.join(str(value) for value in table))
+            self.write(f'SENS1:SEGM:BWID:CONT {int(per_ifbw)}')
+            self.write(f'SENS1:SEGM:POW:CONT {int(per_power)}')
+            self.sweep_type('SEGM')
+        return segment_stimulus(segments)
+
+    def measurement_numbers(self):
+        '''
+        Numbers of the measurements that exist on channel 1
+        '''
+        catalog = self.ask(':SYST:MEAS:CAT? 1').strip().strip('"')
+        return [int(mnum) for mnum in catalog.split(',') if mnum.strip()]
+
+    def define_measurements(self, sparams, first_mnum = None):
+        '''
+        Defines one measurement per S-parameter on channel 1, numbered from
+        first_mnum and fed to window 1, so that a single sweep measures all
+        of them (as far as the test set allows simultaneous capture)
+
+        The measurements of the previous define_measurements call are deleted
+        first. The other measurements, e.g. measurement 1 used by gettrace,
+        and the active measurement are left alone.
+
+        Input:
+            sparams (list of strings) : e.g. ['S11', 'S21', 'S12', 'S22']
+            first_mnum (int) : measurement number of the first S-parameter,
+                               default the one after the highest existing number
+        '''
+        with self.batch():
+            for mnum in self._measurements.values():
+                self.write(f'CALC1:MEAS{mnum}:DEL')
+        self._measurements = {}
+        existing = self.measurement_numbers()
+        if first_mnum is None:
+            first_mnum = max(existing, default = 0) + 1
+        mnums = range(first_mnum, first_mnum + len(sparams))
+        taken = sorted(set(mnums) & set(existing))
+        if len(taken) > 0:
+            raise ValueError(f'measurements {taken} already exist, choose another first_mnum')
+        with self.batch():
+            for mnum, sparam in zip(mnums, sparams):
+                self.write(f'CALC1:MEAS{mnum}:DEF "{sparam}"')
+                self.write(f'DISP:MEAS{mnum}:FEED 1')
+                self._measurements[sparam] = mnum
+
+    def measure_sparams(self, avgnum = 1, sparams = None):
+        '''
+        Triggers one (point averaged) sweep and reads the complex data of every
+        measurement defined with define_measurements
+
+        Input:
+            avgnum (int) : number of averages taken at each point during the sweep
+            sparams (list of strings) : subset of the defined S-parameters to read, default all
+        Output:
+            structured array with a 'frequency' field and a complex field per S-parameter
+        '''
+        if len(self._measurements) == 0:
+            raise Exception('no measurements defined, call define_measurements first')
+        sparams = list(self._measurements) if sparams is None else sparams
+        prev_trigger_source = self.trigger_source()
+        prev_averaging = int(self.averaging())
+        prev_average_type = self.average_type()
+        prev_avgnum = self.avgnum()
+        prev_timeout = self.timeout()
+        with self.batch():
+            self.trigger_source('MAN')
+            self.averaging(int(avgnum > 1))
+            if avgnum > 1:
+                self.average_type('POIN')
+                self.avgnum(avgnum)
+        self.timeout(max(prev_timeout, self.sweep_time()*avgnum + 10))
+        try:
+            self.ask('ABORT;INITIATE:IMMEDIATE;*OPC?')
+            freqs = self.getSweepData()
+            data = np.zeros(len(freqs), dtype = [('frequency', float)] + [(sparam, complex) for sparam in sparams])
+            data['frequency'] = freqs
+            for sparam in sparams:
+                raw = self._ask_values(f'CALC1:MEAS{self._measurements[sparam]}:DATA:SDATA?')
+                data[sparam].real = raw[0::2]
+                data[sparam].imag = raw[1::2]
+        finally:
+            self.timeout(prev_timeout)
+            with self.batch():
+                self.trigger_source(prev_trigger_source)
+                self.average_type(prev_average_type)
+                self.avgnum(prev_avgnum)
+                self.averaging(prev_averaging)
+        return data
+
+    def stream_sweeps(self, max_sweeps = None, snr_target = None, max_time = None):
+        '''
+        Triggers single sweeps one after the other and yields the running
+        statistics after each one, so the convergence can be watched and the
+        loop broken early. Averaging on the instrument is turned off while
+        streaming (and restored afterwards), the raw complex data (SDATA) of
+        the active measurement is used.
+
+        The yielded TraceStatistics is the same object every time: its trace,
+        mean and m2 arrays are overwritten in place after every sweep.
+
+        Input:
+            max_sweeps (int)   : stop after this many sweeps
+            snr_target (float) : stop once TraceStatistics.snr() reaches this value
+            max_time (float)   : stop once this many seconds have passed
+        Output:
+            generator of TraceStatistics
+        '''
+        stats = TraceStatistics(self.num_points())
+        raw = stats.trace.view(np.float64) # interleaved real/imag, like SDATA
+        prev_trigger_source = self.trigger_source()
+        prev_averaging = int(self.averaging())
+        prev_avgnum = self.avgnum()
+        prev_timeout = self.timeout()
+        with self.batch():
+            self.averaging(0)
+            self.trigger_source('MAN')
+        self.timeout(max(prev_timeout, 2*self.sweep_time() + 5))
+        t0 = time.perf_counter()
+        try:
+            while True:
+                self.ask('ABORT;INITIATE:IMMEDIATE;*OPC?')
+                raw[:] = self._ask_values(':CALC1:DATA? SDATA')
+                stats.update()
+                yield stats
+                if max_sweeps is not None and stats.count >= max_sweeps:
+                    break
+                if snr_target is not None and stats.snr() >= snr_target:
+                    break
+                if max_time is not None and time.perf_counter() - t0 >= max_time:
+                    break
+        finally:
+            self.timeout(prev_timeout)
+            with self.batch():
+                self.trigger_source(prev_trigger_source)
+                self.avgnum(prev_avgnum)
+                self.averaging(prev_averaging)
+            logging.info(__name__ + f' : streamed {stats.count} sweeps in {time.perf_counter() - t0:.2f}s')
+
+    def average_until(self, snr_target = None, max_time = None, max_sweeps = None):
+        '''
+        Averages single sweeps until one of the stopping rules is met, returns
+        the mean trace as [[mags (dB)], [phases (rad)]] and the statistics
+        '''
+        if snr_target is None and max_time is None and max_sweeps is None:
+            raise ValueError('at least one stopping rule is needed')
+        for stats in self.stream_sweeps(max_sweeps = max_sweeps, snr_target = snr_target, max_time = max_time):
+            pass
+        return stats.mag_phase(), stats
+
+    @contextmanager
+    def batch(self, check_errors = True):
+        '''
+        Queues every write (e.g. parameter sets) issued inside the with block and
+        sends them as one semicolon-joined message when the block exits, followed
+        by *OPC? so the exit returns once the instrument has processed them.
+
+        Any query issued inside the block first flushes the queued writes.
+        Nested batch blocks join the outer one. With self.batching = False the
+        writes are sent one by one as they are issued.
+
+        Input:
+            check_errors (bool) : also read SYST:ERR? in the same message and
+                                  raise if the instrument reports an error
+        '''
+        if self._batch is not None or not self.batching:
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+        finally:
+            cmds, self._batch = self._batch, None
+        self._send_batch(cmds, check_errors)
+
+    def _send_batch(self, cmds, check_errors = True):
+        if len(cmds) == 0:
+            return
+        # a leading colon resets the SCPI tree, so every command keeps its absolute path
+        msg = ';'.join(cmd if cmd.startswith((':', '*')) else ':' + cmd for cmd in cmds)
+        logging.debug(__name__ + f' : sending batch {msg}')
+        self.visa_messages += 1
+        if not check_errors:
+            super().ask_raw(msg + ';*OPC?')
+            return
+        reply = super().ask_raw(msg + ';*OPC?;:SYST:ERR?')
+        if ';' not in reply:
+            # backends that answer every query of a message separately (e.g. pyvisa-sim)
+            reply += ';' + self.visa_handle.read()
+        err = reply.split(';', 1)[-1].strip()
+        if int(err.split(',', 1)[0]) != 0:
+            # drain the rest of the error queue so the next batch starts clean
+            errors = [err]
+            while True:
+                self.visa_messages += 1
+                err = super().ask_raw(':SYST:ERR?').strip()
+                if int(err.split(',', 1)[0]) == 0:
+                    break
+                errors.append(err)
+            raise RuntimeError(f'{self.name} rejected batch "{msg}": ' + '; '.join(errors))
+
+    def _flush_batch(self):
+        '''
+        Sends the writes queued so far inside batch(), before a query
+        '''
+        if self._batch:
+            cmds, self._batch = self._batch, []
+            self._send_batch(cmds)
+
+    def write_raw(self, cmd):
+        if self._batch is not None:
+            self._batch.append(cmd)
+        else:
+            self.visa_messages += 1
+            super().write_raw(cmd)
+
+    def ask_raw(self, cmd):
+        self._flush_batch()
+        self.visa_messages += 1
+        return super().ask_raw(cmd)
+
     def data_to_mem(self):        
         '''
         Calls for data to be stored in memory
@@ -250,4 +609,103 @@ class Keysight_P9374A(VisaInstrument):
         self.write_raw(cmd)
 
     def querry_visa(self, cmd):
-        return self.ask_raw(cmd)
\ No newline at end of file
+        return self.ask_raw(cmd)
+
+
+SIM_FILE = 'Hatlab_QCoDes_Drivers.sims:Keysight_P9374A.yaml'
+
+
+class _TraceTransferHandle:
+    '''
+    VISA handle for benchmarks: answers the trace and stimulus queries with a
+    num_points trace in the FORM:DATA format last written (ASCII text or an
+    IEEE 488.2 definite-length block), and passes everything else to the
+    pyvisa-sim handle it wraps.
+
+    Responses are moved to the host in chunk_size reads, throttled to
+    link_rate bytes/s if given, and decoded like pyvisa does.
+    '''
+    TRACE_QUERIES = (':CALC1:DATA? FDATA', ':CALC1:DATA? SDATA', ':SENS1:X:VAL?')
+
+    def __init__(self, handle, num_points, link_rate = None, chunk_size = 20*1024):
+        self._handle = handle
+        self.link_rate = link_rate
+        self.chunk_size = chunk_size
+        self.bytes_transferred = 0
+        self._format = 'ASC,0'
+        data = np.random.default_rng(0).normal(size = 2*num_points)
+        self._responses = {'ASC,0': ','.join(f'{v:+.12E}' for v in data).encode('ascii'),
+                           'REAL,32': bytes(to_ieee_block(data.astype('<f4'), 'f', False)),
+                           'REAL,64': bytes(to_ieee_block(data, 'd', False))}
+
+    def __getattr__(self, name):
+        return getattr(self._handle, name)
+
+    @property
+    def timeout(self):
+        return self._handle.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._handle.timeout = value
+
+    def _transfer(self):
+        response = self._responses[self._format]
+        received = bytearray()
+        t0 = time.perf_counter()
+        for i in range(0, len(response), self.chunk_size):
+            received += response[i:i + self.chunk_size]
+        if self.link_rate is not None:
+            time.sleep(max(0.0, len(response)/self.link_rate - (time.perf_counter() - t0)))
+        self.bytes_transferred += len(response)
+        return bytes(received)
+
+    def write(self, cmd, *args, **kwargs):
+        if cmd.startswith(':FORM:DATA '):
+            self._format = cmd.split(' ', 1)[1]
+        return self._handle.write(cmd, *args, **kwargs)
+
+    def query(self, cmd, *args, **kwargs):
+        if cmd in self.TRACE_QUERIES:
+            return self._transfer().decode('ascii')
+        return self._handle.query(cmd, *args, **kwargs)
+
+    def query_binary_values(self, cmd, datatype = 'f', is_big_endian = False, container = list, **kwargs):
+        if cmd in self.TRACE_QUERIES:
+            return from_ieee_block(self._transfer(), datatype, is_big_endian, container)
+        return self._handle.query_binary_values(cmd, datatype = datatype, is_big_endian = is_big_endian,
+                                                container = container, **kwargs)
+
+
+def benchmark_data_formats(num_points = 100001, repeats = 20, link_rate = None):
+    '''
+    Compares reading a polar trace (2*num_points values) as ASCII, REAL32 and
+    REAL64 through Keysight_P9374A._ask_values, on a simulated instrument
+    (pyvisa-sim, see SIM_FILE) whose trace queries return blocks of
+    num_points. The time includes the transfer and the parsing.
+
+    Input:
+        link_rate (float) : emulated transfer rate in bytes/s, e.g. 100e6 for
+                            a gigabit LAN, default no limit
+    Output:
+        dict of format : (bytes per trace, MB/s read)
+    '''
+    vna = Keysight_P9374A('pna_format_benchmark', 'GPIB::1::INSTR', pyvisa_sim_file = SIM_FILE,
+                          data_format = 'ASCII')
+    results = {}
+    try:
+        vna.visa_handle = _TraceTransferHandle(vna.visa_handle, num_points, link_rate)
+        for fmt in DATA_FORMATS:
+            vna.data_format(fmt)
+            vna.visa_handle.bytes_transferred = 0
+            t0 = time.perf_counter()
+            for i in range(repeats):
+                data = vna._ask_values(':CALC1:DATA? FDATA')
+            elapsed = (time.perf_counter() - t0)/repeats
+            assert len(data) == 2*num_points
+            size = vna.visa_handle.bytes_transferred/repeats
+            results[fmt] = (size, size/elapsed/1e6)
+            print(f"{fmt}: {size/1e6:.2f} MB per trace, {elapsed*1e3:.2f} ms per trace ({size/elapsed/1e6:.1f} MB/s)")
+    finally:
+        vna.close()
+    return results
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide loader for the SignalCore DLLs.
+
+Each DLL is loaded once and shared by every driver instance (and the search_* functions).
+On first load the driver's prototype table {function name: (restype, argtypes)} is declared on
+the library, so ctypes doesn't have to guess argument conversions and 64-bit handles aren't
+truncated to int.
+
+For running the drivers without hardware/DLLs (e.g. on Linux), a fake library can be injected
+before the drivers are created:
+    from Hatlab_QCoDes_Drivers.SignalCore_stub import SC5511A_StubDLL
+    set_dll("sc5511a.dll", SC5511A_StubDLL())
+"""
+import ctypes
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional
+
+from Hatlab_QCoDes_Drivers import DLLPATH
+
+_dlls: Dict[str, Any] = {}
+_lock = threading.Lock()
+
+
+def apply_prototypes(dll, prototypes: Dict[str, tuple]):
+    """
+    Declares restype/argtypes for every function in prototypes. Does nothing for
+    libraries that are not ctypes DLLs (e.g. injected fakes).
+    """
+    if not isinstance(dll, ctypes.CDLL):
+        return
+    for func_name, (restype, argtypes) in prototypes.items():
+        try:
+            func = getattr(dll, func_name)
+        except AttributeError:
+            logging.warning(__name__ + f' : {func_name} is not exported by {dll._name}')
+            continue
+        func.restype = restype
+        func.argtypes = argtypes
+
+
+def load_dll(dll_name: str, prototypes: Optional[Dict[str, tuple]] = None, path: Optional[str] = None):
+    """
+    Returns the shared handle of a SignalCore DLL, loading it and declaring its
+    prototypes on first use.
+
+    :param dll_name: file name of the DLL in the package DLL folder, e.g. "sc5511a.dll"
+    :param prototypes: {function name: (restype, argtypes)}
+    :param path: load the DLL from this path instead of the package DLL folder
+    """
+    key = path if path is not None else dll_name
+    with _lock:
+        dll = _dlls.get(key)
+        if dll is None:
+            logging.info(__name__ + f' : Loading {key}')
+            dll = ctypes.CDLL(path if path is not None else os.path.join(DLLPATH, dll_name))
+            if prototypes is not None:
+                apply_prototypes(dll, prototypes)
+            _dlls[key] = dll
+        return dll
+
+
+def set_dll(dll_name: str, dll):
+    """Injects a (fake) library to be returned by load_dll(dll_name)."""
+    with _lock:
+        _dlls[dll_name] = dll
+
+
+def clear_dll_cache():
+    """Forgets all loaded/injected libraries, the next load_dll call loads them again."""
+    with _lock:
+        _dlls.clear()
@@ -9,13 +9,15 @@ Driver for SignalCore SC5413A to be used with QCoDes.
 """
 import ctypes as ct
 import logging
+import time
+from contextlib import contextmanager
 from typing import Any, Dict, Optional, List
 
 import numpy as np
 
 from qcodes import Instrument
 from qcodes.utils.validators import Numbers, Enum, Lists, Ints, MultiType, Bool
-from Hatlab_QCoDes_Drivers import DLLPATH
+from Hatlab_QCoDes_Drivers.SignalCore_DLL import load_dll, apply_prototypes
 
 
 class deviceInfo_t(ct.Structure):
@@ -50,6 +52,25 @@ class RfParams_t(ct.Structure):
                 ("linearDacQ", ct.c_ushort)
                 ]
 
+# restype and argtypes of every sc5413a.dll function used by this driver
+SC5413A_PROTOTYPES = {
+    "sc5413a_OpenDevice": (ct.c_ulonglong, [ct.c_char_p]),  # the handle number is actually 64-bit unsigned, not int as defualt. fk sigcore
+    "sc5413a_CloseDevice": (ct.c_int, [ct.c_void_p]),
+    "sc5413a_GetDeviceInfo": (ct.c_int, [ct.c_void_p, ct.POINTER(deviceInfo_t)]),
+    "sc5413a_GetDeviceStatus": (ct.c_int, [ct.c_void_p, ct.POINTER(deviceStatus_t)]),
+    "sc5413a_FetchRfParams": (ct.c_int, [ct.c_void_p, ct.POINTER(RfParams_t)]),
+    "sc5413a_GetTemperature": (ct.c_int, [ct.c_void_p, ct.POINTER(ct.c_float)]),
+    "sc5413a_SetFrequency": (ct.c_int, [ct.c_void_p, ct.c_ulonglong]),
+    "sc5413a_SetRfFilter": (ct.c_int, [ct.c_void_p, ct.c_char]),
+    "sc5413a_SetLoFilter": (ct.c_int, [ct.c_void_p, ct.c_char]),
+    "sc5413a_SetRfAttenuation": (ct.c_int, [ct.c_void_p, ct.c_char, ct.c_char]),
+    "sc5413a_SetDcOffsetDac": (ct.c_int, [ct.c_void_p, ct.c_char, ct.c_ushort]),
+    "sc5413a_SetLinearityDac": (ct.c_int, [ct.c_void_p, ct.c_char, ct.c_ushort]),
+    "sc5413a_SetRfAmplifier": (ct.c_int, [ct.c_void_p, ct.c_bool]),
+    "sc5413a_SetRfPath": (ct.c_int, [ct.c_void_p, ct.c_bool]),
+    "sc5413a_SetLoOut": (ct.c_int, [ct.c_void_p, ct.c_bool]),
+}
+
 RFPathMap = {"main": 0, "axu": 1}
 FilterMap = {400: 0, 500: 1, 650: 2, 1000: 3, 1400: 4, 2000: 5, 2825: 6, 3800: 7, 6000: 8}
 FilterMap_inv = {v: k for k, v in FilterMap.items()}
@@ -66,22 +87,38 @@ def OffsetDacMap(offsetVoltage: float) -> int:
 def OffsetDacMap_inv(offsetDAC: int) -> float:
     return np.round(offsetDAC / 16383 * 0.1 - 0.05, 7)
 
+# order in which staged settings are written, frequency first since it resets the automatic filters
+COMMIT_ORDER = ["frequency", "RF_filter", "LO_filter", "attenuation", "DC_offset", "linearity_voltage",
+                "amplifier_enable", "rf_path", "LO_out"]
+
 
 class SignalCore_SC5413A(Instrument):
-    def __init__(self, name: str, serial_number: str, dll=None, debug=False, initialize=False, **kwargs: Any):
+    def __init__(self, name: str, serial_number: str, dll=None, debug=False, initialize=False, cache_ttl=0.1,
+                 **kwargs: Any):
+        """
+        dll: path of sc5413a.dll to load instead of the packaged one, or an already loaded (or fake) library.
+        cache_ttl: time window (s) in which one RF parameter fetch serves the getters, and in which writes of
+            values the fetch already showed are skipped. 0 disables the cache.
+        """
         super().__init__(name, **kwargs)
         logging.info(__name__ + f' : Initializing instrument SignalCore modulator {serial_number}')
-        if dll is not None:
-            self._dll = ct.CDLL(dll)
+        if dll is None:
+            self._dll = load_dll('sc5413a.dll', SC5413A_PROTOTYPES)  # access dll file
+        elif isinstance(dll, str):
+            self._dll = load_dll('sc5413a.dll', SC5413A_PROTOTYPES, path=dll)
         else:
-            self._dll = ct.CDLL(DLLPATH + '//sc5413a.dll')  # access dll file
+            self._dll = dll
+            apply_prototypes(self._dll, SC5413A_PROTOTYPES)
 
         self._serial_number = ct.c_char_p(bytes(serial_number, 'utf-8'))
+        self._open = False
+        self._staged = None
+        self._rf_params = None
+        self._rf_params_time = None
+        self.cache_ttl = cache_ttl
         if debug:
             print(self._dll)
 
-        self._dll.sc5413a_OpenDevice.restype = ct.c_ulonglong  # the handle number is actually 64-bit unsigned, not int as defualt. fk sigcore
-
         self.add_parameter('frequency',
                            label='frequency',  # no get command for this value, not provided in dll
                            get_cmd=self.do_get_frequency,
@@ -168,23 +205,116 @@ class SignalCore_SC5413A(Instrument):
 
         self.get_idn()
         if initialize:
-            self.attenuation([0,0,0,0])
-            self.DC_offset([0, 0])
-            self.linearity_voltage([1.2, 1.2])
-            self.amplifier_enable(0)
-            self.rf_path(0)
+            self.configure(attenuation=[0, 0, 0, 0],
+                           DC_offset=[0, 0],
+                           linearity_voltage=[1.2, 1.2],
+                           amplifier_enable=0,
+                           rf_path=0)
 
 
 
     def activate_device_control(self):
-        # activate device control, get device handle
-        self._handle = ct.c_void_p(self._dll.sc5413a_OpenDevice(self._serial_number, 'utf-8'))
+        # activate device control, get device handle. Inside a session the handle is already open.
+        if self._open:
+            return
+        self._handle = ct.c_void_p(self._dll.sc5413a_OpenDevice(self._serial_number))
         if self._handle.value < 0:
             raise TypeError("SC5413A connection error, check serial number")
 
     def close_device(self):
+        if self._open:
+            return
         self._dll.sc5413a_CloseDevice(self._handle)
 
+    @contextmanager
+    def session(self):
+        """Keeps the device handle open for every call made inside the with block."""
+        if self._open:
+            yield self
+            return
+        self.activate_device_control()
+        self._open = True
+        try:
+            yield self
+        finally:
+            self._open = False
+            self.close_device()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Stages every setting made inside the with block, then commits them all in one open
+        device session and reads the result back with a single FetchRfParams, e.g.
+            with Mod.transaction():
+                Mod.attenuation([0, 0, 3, 3])
+                Mod.DC_offset([0.001, -0.002])
+                Mod.RF_filter(2000)
+        Nothing is written if the block raises.
+        """
+        if self._staged is not None:  # nested transaction, commit with the outer one
+            yield self
+            return
+        self._staged = {}
+        try:
+            yield self
+            staged = self._staged
+        finally:
+            self._staged = None
+        self._commit(staged, readback=True)
+
+    def configure(self, **settings):
+        """
+        Sets several modulator parameters in one transaction, e.g.
+            Mod.configure(attenuation=[0, 0, 3, 3], DC_offset=[0.001, -0.002])
+        :return: the decoded RF parameters read back after the commit
+        """
+        with self.transaction():
+            for key, value in settings.items():
+                self.parameters[key](value)
+        return self._rf_params
+
+    def invalidate_cache(self):
+        """Forces the next get to fetch the RF parameters from the device."""
+        self._rf_params = None
+
+    def snapshot_base(self, update: Optional[bool] = False, params_to_skip_update=None):
+        if update:
+            self.invalidate_cache()
+        with self.session():
+            return super().snapshot_base(update=update, params_to_skip_update=params_to_skip_update)
+
+    def _set(self, key, value):
+        if self._staged is not None:
+            self._staged[key] = value
+            return 0
+        return self._commit({key: value})
+
+    def _commit(self, settings, readback=False):
+        err = 0
+        with self.session():
+            for key in COMMIT_ORDER:
+                if key in settings:
+                    err = getattr(self, f"_write_{key}")(settings[key]) or err
+            self.invalidate_cache()
+            if readback:
+                self.get_RF_parameters()
+        return err
+
+    def _cache_expired(self):
+        return self._rf_params is None or time.monotonic() - self._rf_params_time > self.cache_ttl
+
+    def _cached_rf_params(self):
+        if self._cache_expired():
+            self.get_RF_parameters()
+        return self._rf_params
+
+    def _known_rf_params(self):
+        """
+        RF parameters fetched within cache_ttl, or None. The device can also be changed from its front
+        panel or another process, so writes are only skipped when the fetched values are that recent.
+        """
+        return None if self._cache_expired() else self._rf_params
+
     def get_idn(self) -> Dict[str, Optional[str]]:
         logging.info(__name__ + " : Getting device info")
         self.activate_device_control()
@@ -225,6 +355,7 @@ class SignalCore_SC5413A(Instrument):
 
 
     def get_RF_parameters(self):
+        """Fetches and decodes the RF parameters from the device, and refreshes the cache used by the getters."""
         self.activate_device_control()
         rfParams_c = RfParams_t(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
         self._dll.sc5413a_FetchRfParams(self._handle, ct.byref(rfParams_c))
@@ -238,96 +369,115 @@ class SignalCore_SC5413A(Instrument):
         rfParams["offsetValueQ"] = OffsetDacMap_inv(rfParams_c.offsetDacQ)
         rfParams["linearValueI"] = LinDacMap_inv(rfParams_c.linearDacI) # decode linearity voltage values
         rfParams["linearValueQ"] = LinDacMap_inv(rfParams_c.linearDacQ)
+        self._rf_params = rfParams
+        self._rf_params_time = time.monotonic()
         return rfParams
 
-    def do_set_frequency(self, freq):
+    def _write_frequency(self, freq):
         logging.info(__name__ + ' : Setting frequency for filtering to %s' % freq)
-        c_freq = ct.c_ulonglong(freq)
-        self.activate_device_control()
-        completed = self._dll.sc5413a_SetFrequency(self._handle, c_freq)
-        self.close_device()
-        return completed
+        return self._dll.sc5413a_SetFrequency(self._handle, ct.c_ulonglong(freq))
+
+    def _write_RF_filter(self, cutoffFreq):
+        logging.info(__name__ + f' : Setting RF filter cutoff frequency to {cutoffFreq}')
+        return self._dll.sc5413a_SetRfFilter(self._handle, ct.c_char(FilterMap[cutoffFreq]))
+
+    def _write_LO_filter(self, cutoffFreq):
+        logging.info(__name__ + f' : Setting LO filter cutoff frequency to {cutoffFreq}')
+        return self._dll.sc5413a_SetLoFilter(self._handle, ct.c_char(FilterMap[cutoffFreq]))
+
+    def _write_attenuation(self, attenuations):
+        logging.info(__name__ + f' : Setting attenuators 0-3 to {attenuations}')
+        err = 0
+        known = self._known_rf_params()
+        for i, atten in enumerate(attenuations):
+            if known is not None and known[f"atten{i}"] == atten:
+                continue  # already set, skip the USB write
+            err = self._dll.sc5413a_SetRfAttenuation(self._handle, ct.c_char(i), ct.c_char(atten))
+        return err
+
+    def _write_DC_offset(self, offsetIQ):
+        logging.info(__name__ + f' : Setting DC_offset I,Q to {offsetIQ}')
+        err = 0
+        known = self._known_rf_params()
+        for i, offset in enumerate(offsetIQ):
+            if known is not None and known["offsetValue" + "IQ"[i]] == OffsetDacMap_inv(OffsetDacMap(offset)):
+                continue
+            err = self._dll.sc5413a_SetDcOffsetDac(self._handle, ct.c_char(i), ct.c_ushort(OffsetDacMap(offset)))
+        return err
+
+    def _write_linearity_voltage(self, lvIQ):
+        logging.info(__name__ + f' : Setting linearity voltage I,Q to {lvIQ}')
+        err = 0
+        known = self._known_rf_params()
+        for i, vol in enumerate(lvIQ):
+            if known is not None and known["linearValue" + "IQ"[i]] == LinDacMap_inv(LinDacMap(vol)):
+                continue
+            err = self._dll.sc5413a_SetLinearityDac(self._handle, ct.c_char(i), ct.c_ushort(LinDacMap(vol)))
+        return err
+
+    def _write_amplifier_enable(self, enable):
+        return self._dll.sc5413a_SetRfAmplifier(self._handle, ct.c_bool(enable))
+
+    def _write_rf_path(self, path):
+        try:
+            path = RFPathMap[path]
+        except KeyError:
+            pass
+        return self._dll.sc5413a_SetRfPath(self._handle, ct.c_bool(path))
+
+    def _write_LO_out(self, enable):
+        return self._dll.sc5413a_SetLoOut(self._handle, ct.c_bool(enable))
+
+    def do_set_frequency(self, freq):
+        return self._set("frequency", freq)
 
     def do_get_frequency(self):
-        rfParams = self.get_RF_parameters()
-        return rfParams["frequency"]
+        return self._cached_rf_params()["frequency"]
 
     def do_set_RF_filter(self, cutoffFreq):
-        logging.info(__name__ + f' : Setting RF filter cutoff frequency to {cutoffFreq}')
-        c_freq_sel = ct.c_char(FilterMap[cutoffFreq])
-        self.activate_device_control()
-        completed = self._dll.sc5413a_SetRfFilter(self._handle, c_freq_sel)
-        self.close_device()
-        return completed
+        return self._set("RF_filter", cutoffFreq)
 
     def do_get_RF_filter(self):
-        rfParams = self.get_RF_parameters()
-        return rfParams["rfFilter"]
+        return self._cached_rf_params()["rfFilter"]
 
     def do_set_LO_filter(self, cutoffFreq):
-        logging.info(__name__ + f' : Setting LO filter cutoff frequency to {cutoffFreq}')
-        c_freq_sel = ct.c_char(FilterMap[cutoffFreq])
-        self.activate_device_control()
-        completed = self._dll.sc5413a_SetLoFilter(self._handle, c_freq_sel)
-        self.close_device()
-        return completed
+        return self._set("LO_filter", cutoffFreq)
 
     def do_get_LO_filter(self):
-        rfParams = self.get_RF_parameters()
-        return rfParams["loFilter"]
+        return self._cached_rf_params()["loFilter"]
 
     def do_set_attenuation(self, attenuations: List[int]):
         if len(attenuations) != 4:
             raise ValueError("list of attenuation values must be length 4")
-        logging.info(__name__ + f' : Setting attenuators 0-3 to {attenuations}')
-        self.activate_device_control()
-        for i, atten in enumerate(attenuations):
-            err = self._dll.sc5413a_SetRfAttenuation(self._handle, ct.c_char(i), ct.c_char(atten))
-        self.close_device()
-        return err
+        return self._set("attenuation", attenuations)
 
     def do_get_attenuation(self):
-        rfParams = self.get_RF_parameters()
+        rfParams = self._cached_rf_params()
         attens = [rfParams[f"atten{i}"] for i in range(4)]
         return attens
 
     def do_set_DC_offset(self, offsetIQ: List[float]):
         if len(offsetIQ) != 2:
             raise ValueError("list of DC offset values must be length 2 ([I,Q])")
-        logging.info(__name__ + f' : Setting DC_offset I,Q to {offsetIQ}')
-        self.activate_device_control()
-        for i, offset in enumerate(offsetIQ):
-            offset_DAC = OffsetDacMap(offset)
-            err = self._dll.sc5413a_SetDcOffsetDac(self._handle, ct.c_char(i), ct.c_ushort(offset_DAC))
-        self.close_device()
-        return err
+        return self._set("DC_offset", offsetIQ)
 
     def do_get_DC_offset(self):
-        rfParams = self.get_RF_parameters()
+        rfParams = self._cached_rf_params()
         offsetIQ = [rfParams["offsetValueI"], rfParams["offsetValueQ"]]
         return offsetIQ
 
     def do_set_linearity_voltage(self, lvIQ: List[float]):
         if len(lvIQ) != 2:
             raise ValueError("list of linearity voltage values must be length 2 ([I,Q])")
-        logging.info(__name__ + f' : Setting linearity voltage I,Q to {lvIQ}')
-        self.activate_device_control()
-        for i, vol in enumerate(lvIQ):
-            lv_DAC = LinDacMap(vol)
-            err = self._dll.sc5413a_SetLinearityDac(self._handle, ct.c_char(i), ct.c_ushort(lv_DAC))
-        self.close_device()
-        return err
+        return self._set("linearity_voltage", lvIQ)
 
     def do_get_linearity_voltage(self):
-        rfParams = self.get_RF_parameters()
+        rfParams = self._cached_rf_params()
         offsetIQ = [rfParams["linearValueI"], rfParams["linearValueQ"]]
         return offsetIQ
 
     def do_set_rf_amplifier_enable(self, enable):
-        self.activate_device_control()
-        err = self._dll.sc5413a_SetRfAmplifier(self._handle, ct.c_bool(enable))
-        self.close_device()
-        return err
+        return self._set("amplifier_enable", enable)
 
     def do_get_rf_amplifier_enable(self):
         status = self.get_device_status()
@@ -335,14 +485,7 @@ class SignalCore_SC5413A(Instrument):
         return ampOn
 
     def do_set_rf_path(self, path):
-        try:
-            path = RFPathMap[path]
-        except KeyError:
-            pass
-        self.activate_device_control()
-        err = self._dll.sc5413a_SetRfPath(self._handle, ct.c_bool(path))
-        self.close_device()
-        return err
+        return self._set("rf_path", path)
 
     def do_get_rf_path(self):
         status = self.get_device_status()
@@ -350,10 +493,7 @@ class SignalCore_SC5413A(Instrument):
         return path
 
     def do_set_LO_out(self, enable):
-        self.activate_device_control()
-        err = self._dll.sc5413a_SetLoOut(self._handle, ct.c_bool(enable))
-        self.close_device()
-        return err
+        return self._set("LO_out", enable)
 
     def do_get_LO_out(self):
         status = self.get_device_status()
@@ -9,21 +9,30 @@ A simple driver for SignalCore SC5511A to be used with QCoDes, transferred from
 
 import ctypes
 import logging
-from typing import Any, Dict, Optional
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Union
 import yaml
 
+import numpy as np
 from qcodes import Instrument
-from qcodes.utils.validators import Numbers, Enum
-from Hatlab_QCoDes_Drivers import DLLPATH
+from qcodes.utils.validators import Numbers, Enum, Arrays
+from Hatlab_QCoDes_Drivers.SignalCore_DLL import load_dll, apply_prototypes
 import Hatlab_QCoDes_Drivers
 
-ChainedSigCores = yaml.safe_load(open(Hatlab_QCoDes_Drivers.__path__[0]+"\\..\\DeviceInfo\\ChainedSigCores.yaml"))
+SWEEP_DWELL_UNIT = 500e-6 # list/sweep dwell time is programmed in units of 500 us
+RF_MODES = {"single": 0, "list": 1}
+
+with open(os.path.join(Hatlab_QCoDes_Drivers.__path__[0], "..", "DeviceInfo", "ChainedSigCores.yaml")) as f:
+    ChainedSigCores = {k: v or [] for k, v in yaml.safe_load(f).items()}
 
 def search_5511(max_connection = 20):
     """
     param max_connection: maximum number of connected device
     """
-    dll_5511 = ctypes.CDLL(DLLPATH + '//sc5511a.dll')
+    dll_5511 = load_dll('sc5511a.dll', SC5511A_PROTOTYPES)
     sn_buffers = [ctypes.create_string_buffer(8) for i in range(max_connection)]  # buffer to store list of serial numbers
     pointers = (ctypes.c_char_p * max_connection)(*map(ctypes.addressof, sn_buffers))  # pointer list for the buffers
     n_5511 = dll_5511.sc5511a_search_devices(ctypes.byref(pointers))
@@ -108,19 +117,54 @@ class Device_info_t(ctypes.Structure):
                 ]
 
 # End of Structures------------------------------------------------------------                
+
+# restype and argtypes of every sc5511a.dll function used by this driver
+SC5511A_PROTOTYPES = {
+    "sc5511a_search_devices": (ctypes.c_int, [ctypes.c_void_p]),
+    "sc5511a_open_device": (ctypes.c_uint64, [ctypes.c_char_p]),
+    "sc5511a_close_device": (ctypes.c_int, [ctypes.c_void_p]),
+    "sc5511a_get_device_status": (ctypes.c_int, [ctypes.c_void_p, ctypes.POINTER(Device_status_t)]),
+    "sc5511a_get_rf_parameters": (ctypes.c_int, [ctypes.c_void_p, ctypes.POINTER(Device_rf_params_t)]),
+    "sc5511a_get_temperature": (ctypes.c_int, [ctypes.c_void_p, ctypes.POINTER(Device_temperature_t)]),
+    "sc5511a_get_device_info": (ctypes.c_int, [ctypes.c_void_p, ctypes.POINTER(Device_info_t)]),
+    "sc5511a_set_freq": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_ulonglong]),
+    "sc5511a_set_level": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_float]),
+    "sc5511a_set_output": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_ubyte]),
+    "sc5511a_set_clock_reference": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_ubyte, ctypes.c_ubyte]),
+    "sc5511a_set_auto_level_disable": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_ubyte]),
+    "sc5511a_set_rf_mode": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_ubyte]),
+    "sc5511a_list_mode_config": (ctypes.c_int, [ctypes.c_void_p, ctypes.POINTER(List_mode_t)]),
+    "sc5511a_list_start_freq": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_ulonglong]),
+    "sc5511a_list_stop_freq": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_ulonglong]),
+    "sc5511a_list_step_freq": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_ulonglong]),
+    "sc5511a_list_dwell_time": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_uint]),
+    "sc5511a_list_cycle_count": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_uint]),
+    "sc5511a_list_buffer_points": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_uint]),
+    "sc5511a_list_buffer_write": (ctypes.c_int, [ctypes.c_void_p, ctypes.POINTER(ctypes.c_ulonglong), ctypes.c_uint]),
+    "sc5511a_list_soft_trigger": (ctypes.c_int, [ctypes.c_void_p]),
+}
+
 class SignalCore_SC5511A(Instrument):
-    def __init__(self, name: str, serial_number: str, dll = None, debug = False, **kwargs: Any):
+    def __init__(self, name: str, serial_number: str, dll = None, debug = False, keep_open = False,
+                 cache_ttl = 0.1, **kwargs: Any):
+        """
+        keep_open: keep the USB handle open between calls (session mode) instead of
+            opening and closing the device around every get/set. Can also be
+            toggled later with set_open, or scoped with the session() context manager.
+        cache_ttl: time window (s) in which one device status / rf parameter fetch
+            serves all the parameters read from it. 0 disables the cache.
+        """
         super().__init__(name, **kwargs)
         logging.info(__name__ + f' : Initializing instrument SignalCore generator {serial_number}')
         if dll is not None:
             self._dll = dll
+            apply_prototypes(self._dll, SC5511A_PROTOTYPES)
         else:
-            self._dll = ctypes.CDLL(DLLPATH + '//sc5511a.dll')
+            self._dll = load_dll('sc5511a.dll', SC5511A_PROTOTYPES)
 
         if debug:
             print(self._dll)
 
-        self._dll.sc5511a_open_device.restype = ctypes.c_uint64
         self._handle = ctypes.c_void_p(
             self._dll.sc5511a_open_device(ctypes.c_char_p(bytes(serial_number, 'utf-8'))))
         self._serial_number = ctypes.c_char_p(bytes(serial_number, 'utf-8'))
@@ -132,6 +176,10 @@ class SignalCore_SC5511A(Instrument):
         self._pll_status = Pll_status_t()
         self._list_mode = List_mode_t()
         self._device_status = Device_status_t(self._list_mode, self._status, self._pll_status)
+        self.cache_ttl = cache_ttl
+        self._status_time = None
+        self._rf_params_time = None
+        self._hold_cache = False
         if debug:
             print(serial_number, self._handle)
             self._dll.sc5511a_get_device_status(self._handle, ctypes.byref(self._device_status))
@@ -207,10 +255,52 @@ class SignalCore_SC5511A(Instrument):
                            unit="C",
                            vals=Numbers(min_value=0, max_value=200))
 
+        self.add_parameter('rf_mode',
+                           label='rf_mode',
+                           get_cmd=self.do_get_rf_mode,
+                           set_cmd=self.do_set_rf_mode,
+                           docstring="'single': fixed tone at frequency(); "
+                                     "'list': run the sweep/list programmed with configure_sweep or sweep_frequencies",
+                           vals=Enum(*RF_MODES.keys()))
+
+        self.add_parameter('sweep_dwell_time',
+                           label='sweep_dwell_time',
+                           get_cmd=self.do_get_sweep_dwell_time,
+                           get_parser=float,
+                           set_cmd=self.do_set_sweep_dwell_time,
+                           set_parser=float,
+                           unit='s',
+                           docstring="time spent on each point of the sweep/list, in steps of 500 us",
+                           vals=Numbers(min_value=SWEEP_DWELL_UNIT, max_value=SWEEP_DWELL_UNIT * (2**32 - 1)))
+
+        self.add_parameter('sweep_cycles',
+                           label='sweep_cycles',
+                           get_cmd=self.do_get_sweep_cycles,
+                           get_parser=int,
+                           set_cmd=self.do_set_sweep_cycles,
+                           set_parser=int,
+                           docstring="number of times the sweep/list is repeated after a trigger, 0 = run forever",
+                           vals=Numbers(min_value=0, max_value=2**32 - 1))
+
+        self.add_parameter('sweep_frequencies',
+                           label='sweep_frequencies',
+                           get_cmd=self.do_get_sweep_frequencies,
+                           set_cmd=self.do_set_sweep_frequencies,
+                           unit='Hz',
+                           docstring="frequency points of the hardware sweep. Setting an array uploads it to the "
+                                     "list buffer in one configuration call; getting returns the points of the "
+                                     "current list or start/stop/step sweep.",
+                           snapshot_value=False,
+                           vals=Arrays(min_value=0, max_value=20e9))
+        self._sweep_frequencies = None
+
 
         if self._device_status.operate_status_t.ext_ref_lock_enable == 0:
             self.do_set_reference_source(1)
 
+        if keep_open:
+            self.set_open(1)
+
 
     def set_open(self, open):
         if open and not self._open:
@@ -221,13 +311,90 @@ class SignalCore_SC5511A(Instrument):
             self._open = False
         return True
 
+    @contextmanager
+    def session(self):
+        """
+        Keeps the device handle open for every call made inside the with block,
+        e.g.
+            with SC.session():
+                SC.frequency(5e9)
+                SC.power(-10)
+        The handle is closed again on exit unless the driver was already in
+        session mode (keep_open=True or set_open(1)).
+        """
+        was_open = self._open
+        self.set_open(1)
+        try:
+            yield self
+        finally:
+            if not was_open:
+                self.set_open(0)
+
+    def _call(self, func, *args):
+        """
+        Calls a DLL function that takes the device handle as its first argument.
+        In session mode the open handle is reused, and reopened once if the call
+        reports an error (e.g. the USB handle went stale). Otherwise the device
+        is opened and closed around the call.
+        """
+        if self._open:
+            err = func(self._handle, *args)
+            if err:
+                logging.warning(__name__ + f' : {func.__name__} returned {err}, reopening device handle')
+                self.set_open(0)
+                self.set_open(1)
+                err = func(self._handle, *args)
+            return err
+        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
+        try:
+            return func(self._handle, *args)
+        finally:
+            self._dll.sc5511a_close_device(self._handle)
+
     def close(self):
         self.set_open(0)
 
+    def invalidate_cache(self):
+        """Forces the next get to fetch the device status and rf parameters from the device."""
+        self._status_time = None
+        self._rf_params_time = None
+
+    def _cache_expired(self, fetch_time):
+        if fetch_time is None:
+            return True
+        if self._hold_cache:
+            return False
+        return time.monotonic() - fetch_time > self.cache_ttl
+
+    def _cached_device_status(self):
+        if self._cache_expired(self._status_time):
+            self._call(self._dll.sc5511a_get_device_status, ctypes.byref(self._device_status))
+            self._status_time = time.monotonic()
+        return self._device_status
+
+    def _cached_rf_params(self):
+        if self._cache_expired(self._rf_params_time):
+            self._call(self._dll.sc5511a_get_rf_parameters, ctypes.byref(self._rf_params))
+            self._rf_params_time = time.monotonic()
+        return self._rf_params
+
+    def snapshot_base(self, update: Optional[bool] = False, params_to_skip_update=None):
+        """
+        Snapshot with a single bulk read: the device status and rf parameters are
+        fetched once (in one open session) and shared by every parameter.
+        """
+        if update:
+            self.invalidate_cache()
+        self._hold_cache = True
+        try:
+            with self.session():
+                return super().snapshot_base(update=update, params_to_skip_update=params_to_skip_update)
+        finally:
+            self._hold_cache = False
+
     def get_device_status(self):
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        self._dll.sc5511a_get_device_status(self._handle, ctypes.byref(self._device_status))
-        self._dll.sc5511a_close_device(self._handle)
+        self._call(self._dll.sc5511a_get_device_status, ctypes.byref(self._device_status))
+        self._status_time = time.monotonic()
         return self._device_status
 
     def do_set_output_status(self, enable):
@@ -238,10 +405,8 @@ class SignalCore_SC5511A(Instrument):
         """
         logging.info(__name__ + ' : Setting output to %s' % enable)
         c_enable = ctypes.c_ubyte(enable)
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        completed = self._dll.sc5511a_set_output(self._handle, c_enable)
-        self._dll.sc5511a_close_device(self._handle)
-        return completed
+        self.invalidate_cache()
+        return self._call(self._dll.sc5511a_set_output, c_enable)
 
     def do_get_output_status(self):
         '''
@@ -250,11 +415,7 @@ class SignalCore_SC5511A(Instrument):
                 status (int) : OFF = 0 ; ON = 1
         '''
         logging.info(__name__ + ' : Getting output')
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        self._dll.sc5511a_get_device_status(self._handle, ctypes.byref(self._device_status))
-        status = self._device_status.operate_status_t.rf1_out_enable
-        self._dll.sc5511a_close_device(self._handle)
-        return status
+        return self._cached_device_status().operate_status_t.rf1_out_enable
                     
     def do_set_frequency(self, frequency):
         """
@@ -264,40 +425,25 @@ class SignalCore_SC5511A(Instrument):
         """
         c_freq = ctypes.c_ulonglong(int(frequency))
         logging.info(__name__ + ' : Setting frequency to %s' % frequency)
-        close = False
-        if not self._open:
-            self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-            close = True
-        if_set = self._dll.sc5511a_set_freq(self._handle, c_freq)
-        if close:
-            self._dll.sc5511a_close_device(self._handle)
-        return if_set
+        self.invalidate_cache()
+        return self._call(self._dll.sc5511a_set_freq, c_freq)
         
     def do_get_frequency(self):
         logging.info(__name__ + ' : Getting frequency')
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        self._dll.sc5511a_get_rf_parameters(self._handle, ctypes.byref(self._rf_params))
-        frequency = self._rf_params.rf1_freq
-        self._dll.sc5511a_close_device(self._handle)
-        return frequency
+        return self._cached_rf_params().rf1_freq
     
     def do_set_reference_source(self, lock_to_external):
         logging.info(__name__ + ' : Setting reference source to %s' % lock_to_external)
         ref_out_freq = self.do_get_ref_out_freq()
         ref_out_sel = ctypes.c_ubyte(0 if ref_out_freq==10 else 1)
         lock = ctypes.c_ubyte(lock_to_external)
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        source = self._dll.sc5511a_set_clock_reference(self._handle, ref_out_sel, lock)
-        self._dll.sc5511a_close_device(self._handle)
-        return source
+        self.invalidate_cache()
+        return self._call(self._dll.sc5511a_set_clock_reference, ref_out_sel, lock)
     
     def do_get_reference_source(self):
         logging.info(__name__ + ' : Getting reference source')
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        self._dll.sc5511a_get_device_status(self._handle, ctypes.byref(self._device_status))
-        enabled =  self._device_status.operate_status_t.ext_ref_lock_enable and self._device_status.operate_status_t.ext_ref_detect
-        self._dll.sc5511a_close_device(self._handle)
-        return enabled
+        operate_status = self._cached_device_status().operate_status_t
+        return operate_status.ext_ref_lock_enable and operate_status.ext_ref_detect
 
     def do_set_ref_out_freq(self, freq):
         logging.info(__name__ + ' : Setting reference out freq to %s' % freq)
@@ -308,39 +454,23 @@ class SignalCore_SC5511A(Instrument):
 
         ref_out_sel = ctypes.c_ubyte(ref_out_sel)
         lock = ctypes.c_ubyte(self.do_get_reference_source())
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        source = self._dll.sc5511a_set_clock_reference(self._handle, ref_out_sel, lock)
-        self._dll.sc5511a_close_device(self._handle)
-        return source
+        self.invalidate_cache()
+        return self._call(self._dll.sc5511a_set_clock_reference, ref_out_sel, lock)
 
     def do_get_ref_out_freq(self):
         logging.info(__name__ + ' : Getting reference source')
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        self._dll.sc5511a_get_device_status(self._handle, ctypes.byref(self._device_status))
-        ref_out_sel = self._device_status.operate_status_t.ref_out_select
-        freq = 100 if ref_out_sel else 10
-        self._dll.sc5511a_close_device(self._handle)
-        return freq
+        ref_out_sel = self._cached_device_status().operate_status_t.ref_out_select
+        return 100 if ref_out_sel else 10
 
     def do_set_power(self, power):
         logging.info(__name__ + ' : Setting power to %s' % power)
         c_power = ctypes.c_float(power)
-        close = False
-        if not self._open:
-            self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-            close = True
-        completed = self._dll.sc5511a_set_level(self._handle, c_power)
-        if close:
-            self._dll.sc5511a_close_device(self._handle)
-        return completed
+        self.invalidate_cache()
+        return self._call(self._dll.sc5511a_set_level, c_power)
     
     def do_get_power(self):
         logging.info(__name__ + ' : Getting Power')
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        self._dll.sc5511a_get_rf_parameters(self._handle, ctypes.byref(self._rf_params))
-        rf_level = self._rf_params.rf_level
-        self._dll.sc5511a_close_device(self._handle)
-        return rf_level
+        return self._cached_rf_params().rf_level
 
     def do_set_auto_level_disable(self, enable):
         logging.info(__name__ + ' : Settingalc auto to %s' % enable)
@@ -349,17 +479,12 @@ class SignalCore_SC5511A(Instrument):
         elif enable == 0:
             enable = 1
         c_enable = ctypes.c_ubyte(enable)
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        completed = self._dll.sc5511a_set_auto_level_disable(self._handle, c_enable)
-        self._dll.sc5511a_close_device(self._handle)
-        return completed
+        self.invalidate_cache()
+        return self._call(self._dll.sc5511a_set_auto_level_disable, c_enable)
 
     def do_get_auto_level_disable(self):
         logging.info(__name__ + ' : Getting alc auto status')
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        self._dll.sc5511a_get_device_status(self._handle, ctypes.byref(self._device_status))
-        enabled = self._device_status.operate_status_t.auto_pwr_disable
-        self._dll.sc5511a_close_device(self._handle)
+        enabled = self._cached_device_status().operate_status_t.auto_pwr_disable
         if enabled == 1:
             enabled = 0
         elif enabled == 0:
@@ -368,18 +493,127 @@ class SignalCore_SC5511A(Instrument):
 
     def do_get_device_temp(self):
         logging.info(__name__ + " : Getting device temperature")
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        self._dll.sc5511a_get_temperature(self._handle, ctypes.byref(self._temperature))
-        device_temp = self._temperature.device_temp
-        self._dll.sc5511a_close_device(self._handle)
-        return device_temp
+        self._call(self._dll.sc5511a_get_temperature, ctypes.byref(self._temperature))
+        return self._temperature.device_temp
+
+    def do_set_rf_mode(self, mode):
+        logging.info(__name__ + f' : Setting rf mode to {mode}')
+        self.invalidate_cache()
+        return self._call(self._dll.sc5511a_set_rf_mode, ctypes.c_ubyte(RF_MODES[mode]))
+
+    def do_get_rf_mode(self):
+        rf1_mode = self._cached_device_status().operate_status_t.rf1_mode
+        return "list" if rf1_mode else "single"
+
+    def do_set_sweep_dwell_time(self, dwell_time):
+        self.invalidate_cache()
+        return self._call(self._dll.sc5511a_list_dwell_time, ctypes.c_uint(int(round(dwell_time / SWEEP_DWELL_UNIT))))
+
+    def do_get_sweep_dwell_time(self):
+        return self._cached_rf_params().sweep_dwell_time * SWEEP_DWELL_UNIT
+
+    def do_set_sweep_cycles(self, cycles):
+        self.invalidate_cache()
+        return self._call(self._dll.sc5511a_list_cycle_count, ctypes.c_uint(cycles))
+
+    def do_get_sweep_cycles(self):
+        return self._cached_rf_params().sweep_cycles
+
+    def do_set_sweep_frequencies(self, frequencies):
+        self.configure_list(frequencies)
+
+    def do_get_sweep_frequencies(self):
+        list_mode = self._cached_device_status().list_mode
+        if list_mode.sss_mode == 0 and self._sweep_frequencies is not None:
+            return self._sweep_frequencies
+        rf_params = self._cached_rf_params()
+        step = rf_params.step_freq
+        if step == 0:
+            return np.array([rf_params.start_freq], dtype=float)
+        if list_mode.sweep_dir:
+            # reverse sweeps run from stop_freq down to start_freq
+            return np.arange(rf_params.stop_freq, rf_params.start_freq - step / 2, -step, dtype=float)
+        return np.arange(rf_params.start_freq, rf_params.stop_freq + step / 2, step, dtype=float)
+
+    def _configure_list_mode(self, sss_mode, hw_trigger, step_on_hw_trig, return_to_start, trig_out, sweep_dir=0):
+        list_mode = List_mode_t(sss_mode=sss_mode,
+                                sweep_dir=sweep_dir,
+                                tri_waveform=0,
+                                hw_trigger=int(hw_trigger),
+                                step_on_hw_trig=int(step_on_hw_trig),
+                                return_to_start=int(return_to_start),
+                                trig_out_enable=int(trig_out),
+                                trig_out_on_cycle=0)
+        return self._call(self._dll.sc5511a_list_mode_config, ctypes.byref(list_mode))
+
+    def configure_sweep(self, start, stop, step, dwell_time=None, cycles=None, hw_trigger=False,
+                        step_on_hw_trig=False, return_to_start=True, trig_out=False, arm=True):
+        """
+        Programs a start/stop/step hardware sweep, all in one open device session.
+
+            Args:
+                start, stop, step (float): sweep frequencies in Hz. stop < start sweeps downwards: the
+                    hardware takes start_freq < stop_freq, so they are uploaded swapped with sweep_dir = 1.
+                dwell_time (float): time on each point in s (multiple of 500 us). None keeps the current value.
+                cycles (int): number of sweeps per trigger, 0 = forever. None keeps the current value.
+                hw_trigger (bool): wait for the hardware trigger input instead of trigger_sweep()
+                step_on_hw_trig (bool): advance one point per hardware trigger instead of one sweep per trigger
+                return_to_start (bool): return to the start frequency when the sweep is done
+                trig_out (bool): pulse the trigger output on every point
+                arm (bool): switch rf_mode to 'list' so the sweep runs on the next trigger
+        """
+        logging.info(__name__ + f' : Configuring sweep {start}-{stop} Hz, step {step} Hz')
+        sweep_dir = int(stop < start)
+        low, high = min(start, stop), max(start, stop)
+        with self.session():
+            self._configure_list_mode(1, hw_trigger, step_on_hw_trig, return_to_start, trig_out, sweep_dir)
+            self._call(self._dll.sc5511a_list_start_freq, ctypes.c_ulonglong(int(low)))
+            self._call(self._dll.sc5511a_list_stop_freq, ctypes.c_ulonglong(int(high)))
+            self._call(self._dll.sc5511a_list_step_freq, ctypes.c_ulonglong(int(abs(step))))
+            if dwell_time is not None:
+                self.do_set_sweep_dwell_time(dwell_time)
+            if cycles is not None:
+                self.do_set_sweep_cycles(cycles)
+            if arm:
+                self.do_set_rf_mode("list")
+        self._sweep_frequencies = None
+        self.invalidate_cache()
+
+    def configure_list(self, frequencies, dwell_time=None, cycles=None, hw_trigger=False,
+                       step_on_hw_trig=False, return_to_start=True, trig_out=False, arm=True):
+        """
+        Uploads an arbitrary list of frequencies to the list buffer and programs the list mode,
+        all in one open device session. See configure_sweep for the other arguments.
+
+            Args:
+                frequencies (array): frequency points in Hz
+        """
+        frequencies = np.asarray(frequencies, dtype=float)
+        logging.info(__name__ + f' : Uploading {len(frequencies)} point frequency list')
+        freq_buffer = (ctypes.c_ulonglong * len(frequencies))(*frequencies.astype(np.uint64))
+        with self.session():
+            self._configure_list_mode(0, hw_trigger, step_on_hw_trig, return_to_start, trig_out)
+            self._call(self._dll.sc5511a_list_buffer_points, ctypes.c_uint(len(frequencies)))
+            self._call(self._dll.sc5511a_list_buffer_write, freq_buffer, ctypes.c_uint(len(frequencies)))
+            if dwell_time is not None:
+                self.do_set_sweep_dwell_time(dwell_time)
+            if cycles is not None:
+                self.do_set_sweep_cycles(cycles)
+            if arm:
+                self.do_set_rf_mode("list")
+        self._sweep_frequencies = frequencies
+        self.invalidate_cache()
+
+    def trigger_sweep(self):
+        """Software trigger for the armed sweep/list (when hw_trigger is off)."""
+        logging.info(__name__ + ' : Triggering sweep')
+        self.invalidate_cache()
+        return self._call(self._dll.sc5511a_list_soft_trigger)
 
     def get_idn(self) -> Dict[str, Optional[str]]:
         logging.info(__name__ + " : Getting device info")
-        self._handle = ctypes.c_void_p(self._dll.sc5511a_open_device(self._serial_number))
-        self._dll.sc5511a_get_device_info(self._handle, ctypes.byref(self._device_info))
+        self._call(self._dll.sc5511a_get_device_info, ctypes.byref(self._device_info))
         device_info = self._device_info
-        self._dll.sc5511a_close_device(self._handle)
         def date_decode(date_int:int):
             date_str = f"{date_int:032b}"
             yr = f"20{int(date_str[:8],2)}"
@@ -396,6 +630,119 @@ class SignalCore_SC5511A(Instrument):
             }
         return IDN
 
+def benchmark_session(gen: SignalCore_SC5511A, n_calls: int = 100):
+    """
+    Measures the per-call latency of gen.frequency() with the device opened and
+    closed around every call and with the handle kept open. Works with a real
+    generator or with one created on a stub dll.
+
+    :return: (per-call seconds without session, per-call seconds in session)
+    """
+    was_open = gen._open
+    gen.set_open(0)
+    t0 = time.perf_counter()
+    for i in range(n_calls):
+        gen.frequency()
+    t_single = (time.perf_counter() - t0) / n_calls
+    with gen.session():
+        t0 = time.perf_counter()
+        for i in range(n_calls):
+            gen.frequency()
+        t_session = (time.perf_counter() - t0) / n_calls
+    gen.set_open(was_open)
+    print(f"open/close per call: {t_single*1e3:.3f} ms, session: {t_session*1e3:.3f} ms")
+    return t_single, t_session
+
+
+class SignalCoreGroupError(RuntimeError):
+    """Raised by SignalCore_SC5511A_Group when the operation failed on some of the generators."""
+    def __init__(self, errors: Dict[str, Exception], results: Dict[str, Any]):
+        self.errors = errors
+        self.results = results
+        msg = "; ".join(f"{name}: {type(e).__name__}: {e}" for name, e in errors.items())
+        super().__init__(f"{len(errors)} generator(s) failed: {msg}")
+
+
+class SignalCore_SC5511A_Group:
+    """
+    Applies or reads frequency, power and output of several SC5511A generators
+    concurrently. Each generator is handled by its own worker thread (the DLL
+    calls release the GIL), so the wall clock of e.g. set(...) scales with the
+    slowest device instead of the sum over all devices.
+
+    Values passed to set() can be a single value for all generators, or a dict
+    {generator name: value} for only some of them. If any generator fails, the
+    others still complete and a SignalCoreGroupError listing every failure is
+    raised.
+
+    e.g.
+        gens = SignalCore_SC5511A_Group([SC1, SC2, SC3])
+        gens.set(output_status=0)
+        gens.set(frequency={"SC1": 5e9, "SC2": 6e9}, power=-10)
+        gens.get()
+    """
+    def __init__(self, generators: List[SignalCore_SC5511A], max_workers: Optional[int] = None):
+        self.generators = {gen.name: gen for gen in generators}
+        self._pool = ThreadPoolExecutor(max_workers=max_workers or len(self.generators),
+                                        thread_name_prefix="SC5511A_group")
+
+    def _map(self, func: Callable[[SignalCore_SC5511A], Any], names=None) -> Dict[str, Any]:
+        names = list(self.generators.keys()) if names is None else list(names)
+        futures = {name: self._pool.submit(func, self.generators[name]) for name in names}
+        results, errors = {}, {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.error(__name__ + f' : {name} failed: {e}')
+                errors[name] = e
+        if errors:
+            raise SignalCoreGroupError(errors, results)
+        return results
+
+    def _per_generator(self, value) -> Dict[str, Any]:
+        if isinstance(value, dict):
+            unknown = set(value.keys()) - set(self.generators.keys())
+            if unknown:
+                raise KeyError(f"unknown generators {unknown}")
+            return value
+        return {name: value for name in self.generators}
+
+    def set(self, frequency: Union[float, Dict[str, float]] = None, power: Union[float, Dict[str, float]] = None,
+            output_status: Union[int, Dict[str, int]] = None):
+        """
+        Sets frequency, power and/or output_status on all (or the given) generators concurrently.
+        Every generator applies its settings in one open device session.
+        """
+        settings = {}
+        for param, value in (("frequency", frequency), ("power", power), ("output_status", output_status)):
+            if value is None:
+                continue
+            for name, v in self._per_generator(value).items():
+                settings.setdefault(name, []).append((param, v))
+
+        def apply(gen):
+            with gen.session():
+                for param, v in settings[gen.name]:
+                    gen.parameters[param](v)
+
+        self._map(apply, settings.keys())
+
+    def get(self) -> Dict[str, Dict[str, Any]]:
+        """Reads frequency, power and output_status of all generators concurrently."""
+        def read(gen):
+            with gen.session():
+                return {"frequency": gen.frequency(), "power": gen.power(), "output_status": gen.output_status()}
+        return self._map(read)
+
+    def snapshot(self, update: bool = True) -> Dict[str, Any]:
+        """Combined snapshot of all generators, taken concurrently."""
+        return self._map(lambda gen: gen.snapshot(update=update))
+
+    def close(self):
+        self._pool.shutdown()
+
+
 if __name__ == "__main__":
     SC3 = SignalCore_SC5511A("SC3", "1000184F")
 
@@ -6,11 +6,14 @@ Created on Thu Aug 18 15:45:51 2019
 """
 import ctypes as ct
 import logging
-from typing import Any, Dict, Optional
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
 
 from qcodes import Instrument
 from qcodes.utils.validators import Numbers
-from Hatlab_QCoDes_Drivers import DLLPATH
+from Hatlab_QCoDes_Drivers.SignalCore_DLL import load_dll, apply_prototypes
 
 def search_5506(max_connection = 20):
     '''
@@ -19,7 +22,7 @@ def search_5506(max_connection = 20):
 
     param max_connection: maximum number of connected device
     '''
-    dll_5506 = ct.CDLL(DLLPATH + '//sc5506a_usb.dll')
+    dll_5506 = load_dll('sc5506a_usb.dll', SC5506A_PROTOTYPES)
     sn_buffers_1 = [ct.create_string_buffer(8) for i in range(max_connection)]  # buffer to store list of serial numbers
     pointers = (ct.c_char_p * max_connection)(*map(ct.addressof, sn_buffers_1))
     n_5506 = ct.c_uint()
@@ -43,13 +46,175 @@ class Device_info_t(ct.Structure):
                 ("manufacture_date", ct.c_uint32)
                 ]
 
+# restype and argtypes of every sc5506a_usb.dll function used by this driver.
+# RegRead writes registers of different widths, so its output argument is left as a void pointer.
+SC5506A_PROTOTYPES = {
+    "sc5506a_SearchDevices": (ct.c_int, [ct.c_void_p, ct.POINTER(ct.c_uint)]),
+    "sc5506a_OpenDevice": (ct.c_int, [ct.c_char_p, ct.POINTER(ct.c_void_p)]),
+    "sc5506a_CloseDevice": (ct.c_int, [ct.c_void_p]),
+    "sc5506a_RegWrite": (ct.c_int, [ct.c_void_p, ct.c_ubyte, ct.c_ulonglong]),
+    "sc5506a_RegRead": (ct.c_int, [ct.c_void_p, ct.c_ubyte, ct.c_ulonglong, ct.c_void_p]),
+    "sc5506a_SetFrequency": (ct.c_int, [ct.c_void_p, ct.c_uint, ct.c_ulonglong]),
+    "sc5506a_SetPowerLevel": (ct.c_int, [ct.c_void_p, ct.c_uint, ct.c_float]),
+    "sc5506a_DisableAutoLevel": (ct.c_int, [ct.c_void_p, ct.c_uint, ct.c_bool]),
+    "sc5506a_GetTemperature": (ct.c_int, [ct.c_void_p, ct.POINTER(ct.c_float)]),
+    "sc5506a_GetDeviceInfo": (ct.c_int, [ct.c_void_p, ct.POINTER(Device_info_t)]),
+}
+
+class SC5506A_Status:
+    """
+    Decoded snapshot of the status register (0x18) and the rf parameter registers (0x25) of an SC5506A.
+    Fields that exist per channel are lists indexed by channel - 1.
+    """
+    def __init__(self, status_reg: int, rf_regs: List[int]):
+        self.raw_status = status_reg
+        self.ext_ref_lock_enable = (status_reg >> 4) & 1
+        self.ext_ref_detect = (status_reg >> 5) & 1
+        self.rf_out_enable = [(status_reg >> 19) & 1, (status_reg >> 18) & 1]
+        self.standby = [(status_reg >> 17) & 1, (status_reg >> 16) & 1]
+        self.auto_level_disable = [(status_reg >> 23) & 1, (status_reg >> 22) & 1]
+        self.frequency = [rf_regs[0], rf_regs[2]]
+        self.power = [self._decode_power(rf_regs[1]), self._decode_power(rf_regs[3])]
+
+    @staticmethod
+    def _decode_power(reg):
+        # 16 bit sign-magnitude value in units of 0.01 dBm
+        reg = reg & 0xFFFF
+        if reg & 0x8000:
+            return -1 * (reg & 0b0111111111111111) / 100.0
+        return reg / 100.0
+
+    @property
+    def reference_source(self):
+        return self.ext_ref_lock_enable and self.ext_ref_detect
+
+    def output_status(self, channel):
+        return self.rf_out_enable[channel - 1] and (not self.standby[channel - 1])
+
+    def as_dict(self, channel):
+        return {"frequency": self.frequency[channel - 1],
+                "power": self.power[channel - 1],
+                "output_status": int(self.output_status(channel)),
+                "reference_source": int(self.reference_source),
+                "auto_level_disable": self.auto_level_disable[channel - 1]}
+
+
+class SC5506A_Device:
+    """
+    USB handle, lock and status cache of one physical SC5506A, shared by the drivers of its two channels.
+    Use SC5506A_Device.get(...) so that every driver created for the same serial number gets the same object,
+    and release() it when the driver is closed. The device is dropped from the registry (and its handle
+    closed) when the last driver releases it.
+    """
+    _devices: Dict[str, "SC5506A_Device"] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, dll, serial_number: str, cache_ttl: float = 0.1):
+        self._dll = dll
+        self._serial_number = ct.c_char_p(bytes(serial_number, 'utf-8'))
+        self._handle = ct.c_void_p()  # windows HANDLE
+        self._open_depth = 0
+        self.lock = threading.RLock()
+        self.cache_ttl = cache_ttl
+        self._status = None
+        self._status_time = None
+        self._users = 0
+        self.closed = False
+
+    @classmethod
+    def get(cls, dll, serial_number: str, cache_ttl: float = 0.1) -> "SC5506A_Device":
+        """
+        Returns the device of serial_number, creating it if there is none or the registered one was closed
+        or uses another dll. Every call must be matched by a release().
+        """
+        with cls._registry_lock:
+            device = cls._devices.get(serial_number)
+            if device is None or device.closed or device._dll is not dll:
+                device = cls._devices[serial_number] = cls(dll, serial_number, cache_ttl)
+            device._users += 1
+            return device
+
+    def release(self):
+        """Drops one user of the device, the last one closes it and removes it from the registry."""
+        with self._registry_lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+            serial_number = self._serial_number.value.decode("utf-8")
+            if self._devices.get(serial_number) is self:
+                del self._devices[serial_number]
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self._open_depth > 0:
+                self._dll.sc5506a_CloseDevice(self._handle)
+                self._open_depth = 0
+            self._status = None
+            self.closed = True
+
+    @contextmanager
+    def session(self):
+        """Keeps the device handle open (and locked against the other channel) for the whole with block."""
+        with self.lock:
+            if self._open_depth == 0:
+                err = self._dll.sc5506a_OpenDevice(self._serial_number, ct.byref(self._handle))
+                if err != 0:
+                    print('device connection error')
+            self._open_depth += 1
+            try:
+                yield self._handle
+            finally:
+                self._open_depth -= 1
+                if self._open_depth == 0:
+                    self._dll.sc5506a_CloseDevice(self._handle)
+
+    def call(self, func, *args):
+        """Calls a DLL function that takes the device handle as its first argument."""
+        with self.session() as handle:
+            return func(handle, *args)
+
+    def invalidate(self):
+        self._status = None
+
+    def refresh(self) -> SC5506A_Status:
+        """Reads the status register and all four rf parameter registers in one open session."""
+        status_reg = ct.c_ulonglong()
+        rf_regs = [ct.c_ulonglong() for i in range(4)]
+        with self.session() as handle:
+            self._dll.sc5506a_RegRead(handle, ct.c_ubyte(0x18), ct.c_ulonglong(0x00), ct.byref(status_reg))
+            for i, reg in enumerate(rf_regs):
+                self._dll.sc5506a_RegRead(handle, ct.c_ubyte(0x25), ct.c_ulonglong(i), ct.byref(reg))
+        self._status = SC5506A_Status(status_reg.value & 0xFFFFFFFF, [reg.value for reg in rf_regs])
+        self._status_time = time.monotonic()
+        return self._status
+
+    def status(self, max_age: Optional[float] = None) -> SC5506A_Status:
+        """Decoded status, refreshed from the device if older than max_age (default cache_ttl)."""
+        max_age = self.cache_ttl if max_age is None else max_age
+        with self.lock:
+            if self._status is None or time.monotonic() - self._status_time > max_age:
+                self.refresh()
+            return self._status
+
+
 class SignalCore_SC5506A(Instrument):
-    def __init__(self, name: str, serial_number: str, dll=None, channel=1, debug=False, **kwargs: Any):
+    def __init__(self, name: str, serial_number: str, dll=None, channel=1, debug=False, cache_ttl=0.1,
+                 **kwargs: Any):
+        """
+        dll: path of sc5506a_usb.dll to load instead of the packaged one, or an already loaded (or fake) library.
+        cache_ttl: time window (s) in which one status register refresh serves all the parameters read from it.
+            The status is shared with the driver of the other channel of the same device, each driver
+            reads it with its own cache_ttl.
+        """
         super().__init__(name, **kwargs)
-        if dll is not None:
-            self._dll = ct.CDLL(dll)
+        if dll is None:
+            self._dll = load_dll('sc5506a_usb.dll', SC5506A_PROTOTYPES)  # access dll file
+        elif isinstance(dll, str):
+            self._dll = load_dll('sc5506a_usb.dll', SC5506A_PROTOTYPES, path=dll)
         else:
-            self._dll = ct.CDLL(DLLPATH + '//sc5506a_usb.dll')  # access dll file
+            self._dll = dll
+            apply_prototypes(self._dll, SC5506A_PROTOTYPES)
 
         self._serial_number = ct.c_char_p(bytes(serial_number, 'utf-8'))
         if channel not in [1, 2]:
@@ -67,22 +232,28 @@ class SignalCore_SC5506A(Instrument):
 
         # -----------------------------------------------------------------------------
 
-        self._handle = ct.wintypes.HANDLE()
-        err = self._OpenDevice(self._serial_number,
-                               ct.byref(self._handle))  # try activate device to confrim the device is connected
-        if err == 0 and debug:
-            print('QuSigCore ' + serial_number + ' is connected')
-
-        self._CloseDevice(self._handle)
-        self._device_info = Device_info_t(0, 0, 0, 0)
-        idn = self.get_idn()
-        fw_version = idn["firmware_revision"]
-        if fw_version < 4.0:
-            raise NotImplementedError("This driver is only designed for SC5506A with firmware version >= 4.0, it seems "
-                                      f"that you have firmware version=={fw_version}. You can try to update the firmware"
-                                      f" using the kits given in firmwareUpdata/sc5506a_rev2_fw_update, remember to "
-                                      f"carefully read the readMe.txt")
-        self.do_set_auto_level_disable(0)  # setting this to 1 will lead to unstable output power
+        # both channels of one device share the handle and the status cache
+        self._device = SC5506A_Device.get(self._dll, serial_number, cache_ttl)
+        self.cache_ttl = cache_ttl
+        self._handle = self._device._handle  # windows HANDLE
+        try:
+            with self._device.session():  # try activate device to confrim the device is connected
+                if debug:
+                    print('QuSigCore ' + serial_number + ' is connected')
+            self._device_info = Device_info_t(0, 0, 0, 0)
+            idn = self.get_idn()
+            fw_version = idn["firmware_revision"]
+            if fw_version < 4.0:
+                raise NotImplementedError("This driver is only designed for SC5506A with firmware version >= 4.0, it seems "
+                                          f"that you have firmware version=={fw_version}. You can try to update the firmware"
+                                          f" using the kits given in firmwareUpdata/sc5506a_rev2_fw_update, remember to "
+                                          f"carefully read the readMe.txt")
+            self.do_set_auto_level_disable(0)  # setting this to 1 will lead to unstable output power
+        except Exception:
+            # the device is only kept by drivers that were created
+            self._device.release()
+            self._device = None
+            raise
         # ------------Params-----------------------------------------------------------------
         self.add_parameter('output_status',
                            label='output_status',
@@ -133,6 +304,21 @@ class SignalCore_SC5506A(Instrument):
                            unit="C",
                            vals=Numbers(min_value=0, max_value=200))
 
+    @classmethod
+    def both_channels(cls, name: str, serial_number: str, **kwargs: Any):
+        """
+        Creates the drivers of both channels of one device, named <name>_ch1 and <name>_ch2.
+        They share one device handle and one status cache.
+        """
+        return (cls(f"{name}_ch1", serial_number, channel=1, **kwargs),
+                cls(f"{name}_ch2", serial_number, channel=2, **kwargs))
+
+    def close(self):
+        if getattr(self, "_device", None) is not None:
+            self._device.release()
+            self._device = None
+        super().close()
+
     #
     def activate_device_control(self):
         err = self._OpenDevice(self._serial_number,
@@ -140,33 +326,36 @@ class SignalCore_SC5506A(Instrument):
         if err != 0:
             print('device connection error')
 
+    def get_status(self) -> SC5506A_Status:
+        """Decoded status of the device (both channels), fresh from the registers."""
+        return self._device.refresh()
+
+    def snapshot_base(self, update: Optional[bool] = False, params_to_skip_update=None):
+        if update:
+            self._device.invalidate()
+        with self._device.session():
+            return super().snapshot_base(update=update, params_to_skip_update=params_to_skip_update)
+
+    def _set(self, func, *args):
+        self._device.invalidate()
+        return self._device.call(func, *args)
+
     #
     #
     def do_set_output_status(self, enable):
         ch_en = 2 * (self.channel - 1) + enable
-        self.activate_device_control()
-        completed = self._RegWrite(self._handle, ct.c_ubyte(0x12), ct.c_ulonglong(ch_en))  # set output statue
-        self._CloseDevice(self._handle)  # end device control
-
-        return completed
+        return self._set(self._RegWrite, ct.c_ubyte(0x12), ct.c_ulonglong(ch_en))  # set output statue
 
     def do_set_frequency(self, frequency):
         freq = ct.c_ulonglong(int(frequency))
         ch = ct.c_uint(self.channel - 1)
-        self.activate_device_control()
-        err = self._SetFrequency(self._handle, ch, freq)
-        self._CloseDevice(self._handle)
-
-        return err
+        return self._set(self._SetFrequency, ch, freq)
 
     #
     def do_set_power(self, power):
         power = ct.c_float(power)
         ch = ct.c_uint(self.channel - 1)
-        self.activate_device_control()
-        err = self._SetPower(self._handle, ch, power)
-        self._CloseDevice(self._handle)
-        return err
+        return self._set(self._SetPower, ch, power)
 
 
     # def do_set_power(self, pwr):
@@ -184,109 +373,45 @@ class SignalCore_SC5506A(Instrument):
     def do_set_auto_level_disable(self, disable):
         disable = ct.c_bool(disable)
         ch = ct.c_uint(self.channel - 1)
-        self.activate_device_control()
-        err = self._dll.sc5506a_DisableAutoLevel(self._handle, ch, disable)
-        self._CloseDevice(self._handle)
-
-        return err
+        return self._set(self._dll.sc5506a_DisableAutoLevel, ch, disable)
 
     #
     def do_set_standby(self, stand_by_on):
         mode = 2 * (self.channel - 1) + stand_by_on
-        self.activate_device_control()
-        err = self._RegWrite(self._handle, ct.c_ubyte(0x15), ct.c_ulonglong(mode))  # set output statue
-        self._CloseDevice(self._handle)
-
-        return err
+        return self._set(self._RegWrite, ct.c_ubyte(0x15), ct.c_ulonglong(mode))  # set output statue
 
     #
     def do_set_reference_source(self, lock_to_external):
-        self.activate_device_control()
-        err = self._RegWrite(self._handle, ct.c_ubyte(0x16), ct.c_ulonglong(lock_to_external))  # set output statue
-        self._CloseDevice(self._handle)
-
-        return err
+        return self._set(self._RegWrite, ct.c_ubyte(0x16), ct.c_ulonglong(lock_to_external))  # set output statue
 
     #
     def do_get_output_status(self):
-        status = ct.c_uint()
-        self.activate_device_control()
-        self._RegRead(self._handle, ct.c_ubyte(0x18), ct.c_ulonglong(0x00), ct.byref(status))
-        self._CloseDevice(self._handle)
-        status = status.value
-        if self.channel == 1:
-            RFout_status = (status & (1 << 19)) >> 19
-            Standby_status = (status & (1 << 17)) >> 17
-        else:
-            RFout_status = (status & (1 << 18)) >> 18
-            Standby_status = (status & (1 << 16)) >> 16
-
-        return RFout_status and (not Standby_status)
+        return self._device.status(self.cache_ttl).output_status(self.channel)
 
     #
     def do_get_reference_source(self):
-        status = ct.c_uint()
-        self.activate_device_control()
-        self._RegRead(self._handle, ct.c_ubyte(0x18), ct.c_ulonglong(0x00), ct.byref(status))
-        self._CloseDevice(self._handle)
-        status = status.value
-        ref_status = (status & (1 << 4)) >> 4
-        ref_det = (status & (1 << 5)) >> 5
-
-        return (ref_status and ref_det)
+        return self._device.status(self.cache_ttl).reference_source
 
     def do_get_frequency(self):
-        freq_1 = ct.c_ulonglong()
-        self.activate_device_control()
-        if self.channel == 1:
-            self._RegRead(self._handle, ct.c_ubyte(0x25), ct.c_ulonglong(int(0)), ct.byref(freq_1))
-        else:
-            self._RegRead(self._handle, ct.c_ubyte(0x25), ct.c_ulonglong(int(2)), ct.byref(freq_1))
-        self._CloseDevice(self._handle)
-
-        return freq_1.value
+        return self._device.status(self.cache_ttl).frequency[self.channel - 1]
 
     def do_get_power(self):
-        power_1 = ct.c_short()
-        self.activate_device_control()
-        if self.channel == 1:
-            self._RegRead(self._handle, ct.c_ubyte(0x25), ct.c_ulonglong(int(1)), ct.byref(power_1))
-        else:
-            self._RegRead(self._handle, ct.c_ubyte(0x25), ct.c_ulonglong(int(3)), ct.byref(power_1))
-        self._CloseDevice(self._handle)
-
-        power = power_1.value
-        if power >> 16 < 0:
-            return -1 * (power & 0b0111111111111111) / 100.0
-        else:
-            return power_1.value / 100.0
+        return self._device.status(self.cache_ttl).power[self.channel - 1]
 
     def do_get_auto_level_disable(self):
-        status = ct.c_uint()
-        self.activate_device_control()
-        self._RegRead(self._handle, ct.c_ubyte(0x18), ct.c_ulonglong(0x00), ct.byref(status))
-        self._CloseDevice(self._handle)
-        status = status.value
-        if self.channel == 1:
-            autoleveldisable_status = (status & (1 << 23)) >> 23
-        else:
-            autoleveldisable_status = (status & (1 << 22)) >> 22
-
-        return autoleveldisable_status
+        return self._device.status(self.cache_ttl).auto_level_disable[self.channel - 1]
 
     def do_get_device_temp(self):
         temp = ct.c_float()
-        self.activate_device_control()
-        self._dll.sc5506a_GetTemperature(self._handle, ct.byref(temp))
-        self._CloseDevice(self._handle)
-
+        self._device.call(self._dll.sc5506a_GetTemperature, ct.byref(temp))
         return temp.value
 
     def get_all(self):
-        f1 = self.do_get_frequency()
-        p1 = self.do_get_power()
-        out = self.do_get_output_status()
-        ext_lock = self.do_get_reference_source()
+        status = self._device.refresh().as_dict(self.channel)
+        f1 = status["frequency"]
+        p1 = status["power"]
+        out = status["output_status"]
+        ext_lock = status["reference_source"]
         print('frequency: ', f1)
         print('power: ', p1)
         print('RFout: ', out)
@@ -296,10 +421,7 @@ class SignalCore_SC5506A(Instrument):
 
     def get_idn(self) -> Dict[str, Optional[str]]:
 
-        temp = ct.c_float()
-        self.activate_device_control()
-        self._dll.sc5506a_GetDeviceInfo(self._handle, ct.byref(self._device_info))
-        self._CloseDevice(self._handle)
+        self._device.call(self._dll.sc5506a_GetDeviceInfo, ct.byref(self._device_info))
         device_info = self._device_info
         def date_decode(date_int:int):
             date_str = f"{date_int:032b}"
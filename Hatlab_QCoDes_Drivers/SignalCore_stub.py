@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Pure python stand-ins for the SignalCore DLLs, for running the SignalCore drivers
+without hardware (or on machines that can't load the windows DLLs).
+
+An instance can be passed to the drivers through their `dll` argument, e.g.
+    SC = SignalCore_SC5511A("SC", "10001C4A", dll=SC5511A_StubDLL())
+
+open_latency/call_latency (seconds) emulate the USB cost of opening the device
+and of a single transaction, so that the benefit of keeping handles open or
+batching calls can be measured.
+
+SC5511A_CtypesStub exposes the same fake device as ctypes function pointers built
+from the driver's prototype table, so every argument goes through the ctypes
+conversions of a real DLL call (structures by pointer, 64-bit integers, ...).
+"""
+import ctypes
+import time
+
+
+class SC5511A_StubDLL:
+    def __init__(self, serial_numbers=("10001C4A",), open_latency=0.0, call_latency=0.0):
+        self.serial_numbers = list(serial_numbers)
+        self.open_latency = open_latency
+        self.call_latency = call_latency
+        self.calls = {}
+        self.open_handles = set()
+        self._next_handle = 1
+        self._devices = {sn: dict(rf1_freq=int(5e9), rf_level=0.0, rf1_out_enable=0, ext_ref_lock_enable=0,
+                                  ext_ref_detect=1, ref_out_select=0, auto_pwr_disable=0, temperature=40.0,
+                                  rf1_mode=0, list_mode=None, start_freq=0, stop_freq=0, step_freq=0,
+                                  sweep_dwell_time=1, sweep_cycles=0, list_buffer=[], list_triggers=0)
+                         for sn in self.serial_numbers}
+        self._handles = {}
+
+    @staticmethod
+    def _handle_value(handle):
+        return handle.value if isinstance(handle, ctypes.c_void_p) else handle
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _device(self, handle):
+        time.sleep(self.call_latency)
+        value = self._handle_value(handle)
+        if value not in self.open_handles:
+            return None
+        return self._devices[self._handles[value]]
+
+    def sc5511a_search_devices(self, pointers):
+        self._count("sc5511a_search_devices")
+        addresses = ctypes.cast(pointers._obj, ctypes.POINTER(ctypes.c_void_p))
+        for i, sn in enumerate(self.serial_numbers):
+            ctypes.memmove(addresses[i], sn.encode("utf-8"), len(sn))
+        return len(self.serial_numbers)
+
+    def sc5511a_open_device(self, serial_number):
+        self._count("sc5511a_open_device")
+        time.sleep(self.open_latency)
+        sn = serial_number.value.decode("utf-8") if isinstance(serial_number, ctypes.c_char_p) \
+            else serial_number.decode("utf-8")
+        if sn not in self._devices:
+            return 0
+        handle = self._next_handle
+        self._next_handle += 1
+        self._handles[handle] = sn
+        self.open_handles.add(handle)
+        return handle
+
+    def sc5511a_close_device(self, handle):
+        self._count("sc5511a_close_device")
+        self.open_handles.discard(self._handle_value(handle))
+        return 0
+
+    def sc5511a_get_device_status(self, handle, status):
+        self._count("sc5511a_get_device_status")
+        dev = self._device(handle)
+        if dev is None:
+            return 1
+        op = status._obj.operate_status_t
+        for key in ("rf1_out_enable", "ext_ref_lock_enable", "ext_ref_detect", "ref_out_select", "auto_pwr_disable",
+                    "rf1_mode"):
+            setattr(op, key, dev[key])
+        if dev["list_mode"] is not None:
+            status._obj.list_mode = dev["list_mode"]
+        return 0
+
+    def sc5511a_get_rf_parameters(self, handle, rf_params):
+        self._count("sc5511a_get_rf_parameters")
+        dev = self._device(handle)
+        if dev is None:
+            return 1
+        for key in ("rf1_freq", "rf_level", "start_freq", "stop_freq", "step_freq", "sweep_dwell_time",
+                    "sweep_cycles"):
+            setattr(rf_params._obj, key, dev[key])
+        return 0
+
+    def sc5511a_get_temperature(self, handle, temperature):
+        self._count("sc5511a_get_temperature")
+        dev = self._device(handle)
+        if dev is None:
+            return 1
+        temperature._obj.device_temp = dev["temperature"]
+        return 0
+
+    def sc5511a_get_device_info(self, handle, device_info):
+        self._count("sc5511a_get_device_info")
+        dev = self._device(handle)
+        if dev is None:
+            return 1
+        device_info._obj.serial_number = int(self._handles[self._handle_value(handle)], 16)
+        device_info._obj.hardware_revision = 3.0
+        device_info._obj.firmware_revision = 4.0
+        device_info._obj.manufacture_date = (21 << 24) | (1 << 16) | (1 << 8)
+        return 0
+
+    def _setter(self, name, handle, key, value):
+        self._count(name)
+        dev = self._device(handle)
+        if dev is None:
+            return 1
+        dev[key] = value
+        return 0
+
+    def sc5511a_set_freq(self, handle, freq):
+        return self._setter("sc5511a_set_freq", handle, "rf1_freq", freq.value)
+
+    def sc5511a_set_level(self, handle, level):
+        return self._setter("sc5511a_set_level", handle, "rf_level", level.value)
+
+    def sc5511a_set_output(self, handle, enable):
+        return self._setter("sc5511a_set_output", handle, "rf1_out_enable", enable.value)
+
+    def sc5511a_set_auto_level_disable(self, handle, disable):
+        return self._setter("sc5511a_set_auto_level_disable", handle, "auto_pwr_disable", disable.value)
+
+    def sc5511a_set_clock_reference(self, handle, ref_out_sel, lock):
+        self._count("sc5511a_set_clock_reference")
+        dev = self._device(handle)
+        if dev is None:
+            return 1
+        dev["ref_out_select"] = ref_out_sel.value
+        dev["ext_ref_lock_enable"] = lock.value
+        return 0
+
+    def sc5511a_set_rf_mode(self, handle, mode):
+        return self._setter("sc5511a_set_rf_mode", handle, "rf1_mode", mode.value)
+
+    def sc5511a_list_mode_config(self, handle, list_mode):
+        list_mode = type(list_mode._obj).from_buffer_copy(list_mode._obj)
+        return self._setter("sc5511a_list_mode_config", handle, "list_mode", list_mode)
+
+    def sc5511a_list_start_freq(self, handle, freq):
+        return self._setter("sc5511a_list_start_freq", handle, "start_freq", freq.value)
+
+    def sc5511a_list_stop_freq(self, handle, freq):
+        return self._setter("sc5511a_list_stop_freq", handle, "stop_freq", freq.value)
+
+    def sc5511a_list_step_freq(self, handle, freq):
+        return self._setter("sc5511a_list_step_freq", handle, "step_freq", freq.value)
+
+    def sc5511a_list_dwell_time(self, handle, dwell_time):
+        return self._setter("sc5511a_list_dwell_time", handle, "sweep_dwell_time", dwell_time.value)
+
+    def sc5511a_list_cycle_count(self, handle, cycles):
+        return self._setter("sc5511a_list_cycle_count", handle, "sweep_cycles", cycles.value)
+
+    def sc5511a_list_buffer_points(self, handle, points):
+        return self._setter("sc5511a_list_buffer_points", handle, "list_buffer", [0] * points.value)
+
+    def sc5511a_list_buffer_write(self, handle, freqs, points):
+        return self._setter("sc5511a_list_buffer_write", handle, "list_buffer", list(freqs[:points.value]))
+
+    def sc5511a_list_soft_trigger(self, handle):
+        self._count("sc5511a_list_soft_trigger")
+        dev = self._device(handle)
+        if dev is None:
+            return 1
+        dev["list_triggers"] += 1
+        return 0
+
+
+class SC5511A_CtypesStub(SC5511A_StubDLL):
+    """
+    SC5511A_StubDLL behind ctypes function pointers, e.g.
+        from Hatlab_QCoDes_Drivers.SignalCore_SC5511A import SC5511A_PROTOTYPES
+        SC = SignalCore_SC5511A("SC", "10001C4A", dll=SC5511A_CtypesStub(SC5511A_PROTOTYPES))
+
+    Each function is a CFUNCTYPE(restype, *argtypes) around the python stub, so the
+    driver's arguments are converted to C and back like in a call to sc5511a.dll.
+    """
+    def __init__(self, prototypes, serial_numbers=("10001C4A",), open_latency=0.0, call_latency=0.0):
+        super().__init__(serial_numbers, open_latency, call_latency)
+        for func_name, (restype, argtypes) in prototypes.items():
+            func = ctypes.CFUNCTYPE(restype, *argtypes)(self._callback(func_name, argtypes))
+            func.__name__ = func_name
+            setattr(self, func_name, func)
+
+    def _callback(self, func_name, argtypes):
+        stub_func = getattr(SC5511A_StubDLL, func_name)
+
+        def callback(*args):
+            # back to the objects the python stub takes: byref() for structure pointers,
+            # ctypes instances for values, plain python objects for handles/strings/arrays
+            converted = []
+            for argtype, arg in zip(argtypes, args):
+                if hasattr(argtype, "_type_") and isinstance(argtype._type_, type) \
+                        and issubclass(argtype._type_, ctypes.Structure):
+                    converted.append(ctypes.byref(arg.contents))
+                elif argtype in (ctypes.c_void_p, ctypes.c_char_p) or not issubclass(argtype, ctypes._SimpleCData):
+                    converted.append(arg)
+                else:
+                    converted.append(argtype(arg))
+            return stub_func(self, *converted)
+        return callback
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Segment tables for segmented VNA sweeps, shared by the Keysight_P9374A and Agilent_ENA_5071C drivers.
+
+A segment is (start, stop, points, ifbw, power), frequencies in Hz, ifbw in Hz and power in dBm.
+ifbw/power can be None to use the channel setting for that segment.
+
+Sweeping a few narrow resonances with dense segments, and the dead band between them with sparse
+(or no) segments, takes a fraction of the points of a uniform sweep over the full span.
+"""
+from collections import namedtuple
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+Segment = namedtuple('Segment', ['start', 'stop', 'points', 'ifbw', 'power'], defaults = [None, None])
+
+
+def as_segments(segments) -> List[Segment]:
+    """
+    Converts a list of tuples to a list of Segment, checking the frequencies and points
+    """
+    segments = [Segment(*seg) for seg in segments]
+    if len(segments) == 0:
+        raise ValueError('at least one segment is needed')
+    for seg in segments:
+        if seg.stop < seg.start:
+            raise ValueError(f'segment stop frequency below start: {seg}')
+        if int(seg.points) < 1 or (int(seg.points) == 1 and seg.stop != seg.start):
+            raise ValueError(f'segment needs at least 2 points to span a range: {seg}')
+    return segments
+
+
+def segment_stimulus(segments) -> np.ndarray:
+    """
+    Frequencies (Hz) measured by a segmented sweep over segments, in sweep order
+    """
+    return np.concatenate([np.linspace(seg.start, seg.stop, int(seg.points)) for seg in as_segments(segments)])
+
+
+def segments_around(centers: Sequence[float], span: float, points: int, ifbw: Optional[float] = None,
+                    power: Optional[float] = None, fstart: Optional[float] = None, fstop: Optional[float] = None,
+                    background_points: int = 0, background_ifbw: Optional[float] = None) -> List[Segment]:
+    """
+    Builds a segment table with a dense segment of width span around every resonance center.
+    Segments that overlap are merged, keeping their point density.
+
+    :param centers: resonance frequencies (Hz)
+    :param span: width (Hz) of the segment around each resonance
+    :param points: number of points per resonance segment
+    :param ifbw: IF bandwidth of the resonance segments
+    :param power: power of the resonance segments
+    :param fstart: start of the full sweep, required for background segments. Windows are clipped to it
+    :param fstop: stop of the full sweep, required for background segments. Windows are clipped to it
+    :param background_points: if > 0, the gaps between fstart, the resonances and fstop are filled with
+        segments holding exactly this many points in total, spread proportionally to the gap widths
+        (a narrow gap can get none). Background segments stop one background step short of the resonance windows, so no frequency
+        is measured twice
+    :param background_ifbw: IF bandwidth of the background segments, wider is faster
+    """
+    density = (points - 1)/span
+    windows = []
+    for center in sorted(centers):
+        start, stop = center - span/2, center + span/2
+        if fstart is not None:
+            start = max(start, fstart)
+        if fstop is not None:
+            stop = min(stop, fstop)
+        if stop < start:
+            continue  # resonance outside of the sweep
+        if len(windows) > 0 and start <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], stop)
+        else:
+            windows.append([start, stop])
+    segments = [Segment(start, stop, int(round((stop - start)*density)) + 1, ifbw, power) for start, stop in windows]
+    if background_points <= 0:
+        return segments
+
+    if fstart is None or fstop is None:
+        raise ValueError('fstart and fstop are needed for background segments')
+    edges = [fstart] + [edge for window in windows for edge in window] + [fstop]
+    gaps = [(i, edges[i], edges[i + 1]) for i in range(0, len(edges), 2) if edges[i + 1] > edges[i]]
+    total_gap = sum(stop - start for i, start, stop in gaps)
+    # largest remainder split of background_points over the gaps
+    shares = np.array([background_points*(stop - start)/total_gap for i, start, stop in gaps])
+    counts = np.floor(shares).astype(int)
+    counts[np.argsort(counts - shares)[:background_points - counts.sum()]] += 1
+    background = []
+    for (i, start, stop), n in zip(gaps, counts):
+        if n == 0:
+            continue
+        if n == 1:
+            start = stop = (start + stop)/2
+        else:
+            # an edge shared with a resonance window is measured by the window
+            shared_start, shared_stop = i > 0, i + 1 < len(edges) - 1
+            step = (stop - start)/(n - 1 + shared_start + shared_stop)
+            start, stop = start + step*shared_start, stop - step*shared_stop
+        background.append(Segment(start, stop, int(n), background_ifbw, power))
+    return sorted(segments + background, key = lambda seg: seg.start)
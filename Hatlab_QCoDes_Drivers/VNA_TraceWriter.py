@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Session writer for VNA traces: keeps one DDH5 file open and appends every saved trace as a new record,
+so the session can be opened with plottr like the files written by DDH5Writer.
+
+Layout of the file (the DDH5 layout of plottr.data.datadict_storage):
+    /data/frequency, /data/power, /data/phase : float datasets of shape (records, points),
+        chunked one record per chunk and compressed, with the same axes and units as savetrace
+    /data/name : record names
+    /data/time : unix time of every record
+    /data attributes : the metadata passed to the writer, as DDH5 meta data ('__key__')
+
+Usage:
+    with TraceSessionWriter(path, metadata = {'vna': VNA.name}) as writer:
+        for ...:
+            VNA.savetrace(avgnum = 10, name = 'S11', writer = writer)
+"""
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import h5py
+import numpy as np
+
+DATAFILEXT = 'ddh5'
+TIMESTRFORMAT = "%Y-%m-%d %H:%M:%S"
+
+# axes and units of the trace fields, the same as the DataDict of the VNA savetrace functions
+FIELDS = {
+    'frequency': dict(axes = [], unit = 'Hz'),
+    'power': dict(axes = ['frequency'], unit = 'dB'),
+    'phase': dict(axes = ['frequency'], unit = 'Degrees'),
+}
+
+
+def _add_time_attr(h5obj, name = 'creation'):
+    # same attributes as plottr's add_cur_time_attr
+    t = time.localtime()
+    h5obj.attrs[f'__{name}_time_sec__'] = time.mktime(t)
+    h5obj.attrs[f'__{name}_time_str__'] = time.strftime(TIMESTRFORMAT, t)
+
+
+class TraceSessionWriter:
+    def __init__(self, filepath: str, compression: Optional[str] = 'lzf', metadata: Optional[Dict[str, Any]] = None):
+        """
+        :param filepath: DDH5 file to write to, appended to if it already exists. The .ddh5 extension is
+            added if missing, as plottr only opens files with that extension
+        :param compression: h5py compression filter of the trace datasets ('lzf', 'gzip' or None)
+        :param metadata: meta data written to the data group
+        """
+        path = Path(filepath)
+        if path.suffix != f'.{DATAFILEXT}':
+            path = path.with_name(path.name + f'.{DATAFILEXT}')
+        path.parent.mkdir(parents = True, exist_ok = True)
+        self.filepath = str(path)
+        self.compression = compression
+        self._file = h5py.File(self.filepath, 'a')
+        if 'data' not in self._file:
+            _add_time_attr(self._file.create_group('data'))
+        self._data = self._file['data']
+        for key, value in (metadata or {}).items():
+            self._data.attrs[f'__{key}__'] = value
+        self.bytes_written = 0
+        self.write_time = 0.0
+        logging.info(__name__ + f' : opened trace session {filepath}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def num_records(self) -> int:
+        return len(self._data['name']) if 'name' in self._data else 0
+
+    def _create_datasets(self, num_points):
+        for key, field in FIELDS.items():
+            dataset = self._data.create_dataset(key, shape = (0, num_points), maxshape = (None, num_points),
+                                                dtype = float, chunks = (1, num_points),
+                                                compression = self.compression)
+            if field['axes']:
+                dataset.attrs['axes'] = np.char.encode(np.array(field['axes']), encoding = 'utf8')
+            dataset.attrs['unit'] = field['unit']
+        self._data.create_dataset('name', shape = (0,), maxshape = (None,), dtype = h5py.string_dtype())
+        self._data.create_dataset('time', shape = (0,), maxshape = (None,), dtype = float)
+        self._data['time'].attrs['unit'] = 's'
+        for dataset in self._data.values():
+            _add_time_attr(dataset)
+
+    def add_trace(self, name: Optional[str], frequency, power, phase) -> int:
+        """
+        Appends one trace as a new record and returns its index.
+        The number of points has to be the same for every record of a file.
+        A record without a name is called trace_<index>.
+        """
+        t0 = time.perf_counter()
+        frequency = np.asarray(frequency, dtype = float)
+        if 'frequency' not in self._data:
+            self._create_datasets(len(frequency))
+        num_points = self._data['frequency'].shape[1]
+        if len(frequency) != num_points:
+            raise ValueError(f'trace has {len(frequency)} points, the records of {self.filepath} have {num_points}')
+        index = self.num_records
+        if name is None:
+            name = f'trace_{index}'
+        for key, values in (('frequency', frequency), ('power', power), ('phase', phase)):
+            dataset = self._data[key]
+            dataset.resize(index + 1, axis = 0)
+            dataset[index] = values
+        for key, value in (('name', name), ('time', time.time())):
+            dataset = self._data[key]
+            dataset.resize(index + 1, axis = 0)
+            dataset[index] = value
+        for dataset in self._data.values():
+            _add_time_attr(dataset, 'last_change')
+        self.bytes_written += 3*num_points*8
+        self.write_time += time.perf_counter() - t0
+        return index
+
+    def flush(self):
+        self._file.flush()
+
+    @property
+    def throughput(self) -> float:
+        """Average write throughput of the traces so far, in MB/s"""
+        return self.bytes_written/self.write_time/1e6 if self.write_time > 0 else 0.0
+
+    def close(self):
+        if self._file.id.valid:
+            records = self.num_records
+            self._file.close()
+            logging.info(__name__ + f' : closed {self.filepath}, {records} records, {self.throughput:.1f} MB/s')
@@ -0,0 +1 @@
+"""pyvisa-sim instrument files, for opening the drivers with pyvisa_sim_file='Hatlab_QCoDes_Drivers.sims:<file>'"""
@@ -2,4 +2,5 @@ from distutils.core import setup
 
 setup(name='Hatlab_QCoDes_Drivers',
       version='0.0.1',
-      packages=['Hatlab_QCoDes_Drivers'])
\ No newline at end of file
+      packages=['Hatlab_QCoDes_Drivers', 'Hatlab_QCoDes_Drivers.sims'],
+      package_data={'Hatlab_QCoDes_Drivers.sims': ['*.yaml']})
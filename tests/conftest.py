@@ -0,0 +1,3 @@
+# AnalogDevices_ADMV8818_test.py is a manual script for a board connected through the ACE software,
+# not a pytest module
+collect_ignore = ["AnalogDevices_ADMV8818_test.py"]
@@ -0,0 +1,149 @@
+"""
+ACE calls made by AnalogDevices_ADMV8818 per retune, recorded by AnalogDevices_ACE_fake.FakeACEClient.
+"""
+import time
+
+import pytest
+
+from Hatlab_QCoDes_Drivers.AnalogDevices_ADMV8818 import AnalogDevices_ADMV8818
+from Hatlab_QCoDes_Drivers.AnalogDevices_ACE_fake import FakeACEClient, default_settings
+from Hatlab_QCoDes_Drivers.AnalogDevices_ADMV8818_regmap import (WORD_REGISTERS, encode_registers, decode_registers,
+                                                                 format_hex)
+
+STATE = [2, 5, 3, 7]  # [HPF switch, HPF register, LPF switch, LPF register]
+
+
+@pytest.fixture
+def client():
+    return FakeACEClient()
+
+
+@pytest.fixture(params=["parameters", "registers"])
+def write_mode(request):
+    return request.param
+
+
+@pytest.fixture
+def filter(client, write_mode):
+    filter = AnalogDevices_ADMV8818("admv8818_test", client=client)
+    filter.write_mode(write_mode)
+    filter.refresh_mirror()
+    client.clear_calls()
+    yield filter
+    filter.close()
+
+
+@pytest.mark.parametrize("write_mode", ["registers"])
+@pytest.mark.parametrize("settle_mode, reads", [("none", 0), ("readback", 5)])
+def test_registers_retune(filter, client, settle_mode, reads):
+    filter.settle_mode(settle_mode)
+    filter.set_filter_state(STATE)
+    # WR0 leaves bypass, WR2 takes the HPF and WR3 the LPF: 3 switch and 2 filter registers change
+    assert client.count("WriteRegister") == 5
+    assert client.count("ReadRegister") == reads
+    assert client.count() == 5 + reads
+    assert dict(args for name, args in client.calls if name == "WriteRegister") == {
+        "0x20": "0x00", "0x24": "0x92", "0x25": "0x50", "0x26": "0x5B", "0x27": "0x07"}
+    assert filter.get_filter_state(verify=True) == STATE
+
+
+@pytest.mark.parametrize("write_mode", ["parameters"])
+def test_parameters_retune(filter, client):
+    filter.settle_mode("none")
+    filter.set_filter_state(STATE)
+    assert client.calls == [
+        ("SetBoolParameter", ("SW_IN_SET_WR0", "False", "-1")),
+        ("SetBoolParameter", ("SW_IN_SET_WR2", "True", "-1")),
+        ("SetByteParameter", ("HPF_WR2", "5", "-1")),
+        ("SetBoolParameter", ("SW_OUT_SET_WR0", "False", "-1")),
+        ("SetBoolParameter", ("SW_OUT_SET_WR3", "True", "-1")),
+        ("SetByteParameter", ("LPF_WR3", "7", "-1")),
+        ("ApplySettings", ()),
+    ]
+    assert client.count("WriteRegister") == 0
+    assert filter.get_filter_state(verify=True) == STATE
+
+
+def test_noop_retune(filter, client):
+    filter.set_filter_state(STATE)
+    client.clear_calls()
+    filter.set_filter_state(STATE)
+    assert client.calls == []
+
+
+def test_register_round_trip(client):
+    settings = default_settings()
+    settings.update(SW_IN_SET_WR0="False", SW_IN_SET_WR2="True", HPF_WR2="5",
+                    SW_OUT_SET_WR0="False", SW_OUT_SET_WR3="True", LPF_WR3="7")
+    registers = encode_registers(settings)
+    assert sorted(registers) == sorted(WORD_REGISTERS)
+    assert decode_registers(registers) == {k: (v == "True") if "SET" in k else int(v) for k, v in settings.items()}
+    assert encode_registers(decode_registers(registers)) == registers
+
+    # the fake board holds the same register values for the same settings
+    client.board = settings
+    assert {address: int(client.ReadRegister(format_hex(address)), 16) for address in WORD_REGISTERS} == registers
+
+
+@pytest.fixture
+def settling_filter():
+    client = FakeACEClient(settle_latency=5e-3)
+    filter = AnalogDevices_ADMV8818("admv8818_settle_test", client=client)
+    yield filter, client
+    filter.close()
+
+
+def test_settle_latency_stays_near_settle_time(settling_filter):
+    filter, client = settling_filter
+    for i in range(200):
+        filter.set_filter_state([1 + i % 4, i % 16, 1 + (i + 1) % 4, (i * 7) % 16])
+    report = filter.latency_report()
+    assert report["median"] < 3 * client.settle_latency
+    assert filter._settle_estimate < 2 * client.settle_latency
+
+
+def test_settle_timeout(settling_filter):
+    filter, client = settling_filter
+    client.settle_latency = 10.0
+    filter.settle_timeout(0.05)
+    t0 = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        filter.set_filter_state(STATE)
+    # the last readback is done at settle_timeout, not an interval before it
+    assert 0.05 <= time.perf_counter() - t0 < 0.5
+    assert filter._settle_estimate <= 0.5 * filter.settle_timeout()
+
+
+@pytest.fixture
+def two_boards():
+    client = FakeACEClient(hardware_ids=("456&B660&97B1B", "456&B660&97B5E"))
+    filters = [AnalogDevices_ADMV8818(f"admv8818_board{i}", hardware_id, client=client)
+               for i, hardware_id in enumerate(client.hardware_ids)]
+    yield client, filters
+    for filter in filters:
+        filter.close()
+
+
+def test_two_boards(two_boards):
+    client, (filter1, filter2) = two_boards
+    assert client.subsystems == {"456&B660&97B1B": "Subsystem_1", "456&B660&97B5E": "Subsystem_2"}
+    client.clear_calls()
+    filter1.set_filter_state(STATE)
+    filter1.set_filter_state([1, 2, 1, 3])  # already on the page of filter1
+    filter2.set_filter_state([4, 15, 4, 0])
+    assert client.count("NavigateToPath") == 2
+    assert filter1.get_filter_state(verify=True) == [1, 2, 1, 3]
+    assert filter2.get_filter_state(verify=True) == [4, 15, 4, 0]
+    assert client.board_settings("456&B660&97B1B")["HPF_WR1"] == "2"
+    assert client.board_settings("456&B660&97B5E")["HPF_WR4"] == "15"
+
+
+def test_refresh_mirror_navigates_again(two_boards):
+    client, (filter1, filter2) = two_boards
+    filter1.set_filter_state(STATE)
+    # the ACE GUI moves the server to the page of the other board
+    client.set_ContextPath(r"\System\Subsystem_2\ADMV8818 Board\ADMV8818")
+    assert filter1.refresh_mirror()["HPF_WR2"] == 5
+    filter1.set_filter_state([1, 2, 1, 3])
+    assert client.board_settings("456&B660&97B1B")["HPF_WR1"] == "2"
+    assert client.board_settings("456&B660&97B5E")["HPF_WR1"] == "0"
@@ -0,0 +1,51 @@
+"""
+Stitched scans of Hat_P9374A against the simulated PNA in Hatlab_QCoDes_Drivers/sims/Keysight_P9374A.yaml.
+Hat_P9374A_RK needs easygui and plottr.
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip("easygui")
+pytest.importorskip("plottr")
+
+from plottr.data.datadict_storage import datadict_from_hdf5
+
+from Hatlab_QCoDes_Drivers.Hat_P9374A_RK import Hat_P9374A, benchmark_scan
+from Hatlab_QCoDes_Drivers.Keysight_P9374A import SIM_FILE
+
+
+@pytest.fixture
+def vna():
+    vna = Hat_P9374A("pna_rk_test", "GPIB::1::INSTR", pyvisa_sim_file=SIM_FILE, data_format="ASCII")
+    yield vna
+    vna.close()
+
+
+@pytest.mark.parametrize("overlap", [False, True])
+def test_scan_stitches_windows(vna, tmp_path, overlap):
+    vna.ifbw(1234)
+    filepath = vna.scan(5e9, 8e9, 1e9, savedir=str(tmp_path), name="scan", overlap=overlap)
+    assert float(vna.ifbw()) == 1234  # kept, no ifbw given
+
+    freqs, mags, phases = vna.scan_data
+    np.testing.assert_array_equal(freqs, vna.scan_stimulus(5e9, 8e9, 1e9)[1].reshape(-1))
+    assert len(freqs) == 3 * int(vna.num_points())
+    # every window holds the simulated trace
+    mag, phase = vna.gettrace()
+    np.testing.assert_allclose(mags, np.tile(mag, 3))
+    np.testing.assert_allclose(phases, np.tile(phase, 3))
+
+    data = datadict_from_hdf5(filepath)
+    np.testing.assert_array_equal(data["frequency"]["values"], freqs)
+    np.testing.assert_allclose(data["power"]["values"], mags)
+    np.testing.assert_allclose(data["phase"]["values"], phases)
+
+
+def test_scan_sets_ifbw(vna, tmp_path):
+    vna.scan(5e9, 6e9, 1e9, ifbw=500, savedir=str(tmp_path), name="scan")
+    assert float(vna.ifbw()) == 500
+
+
+def test_benchmark_scan(vna, tmp_path):
+    sequential, overlapped = benchmark_scan(vna, 5e9, 8e9, 1e9, str(tmp_path))
+    assert sequential > 0 and overlapped > 0
@@ -0,0 +1,41 @@
+"""
+Keysight_P9374A against the simulated PNA in Hatlab_QCoDes_Drivers/sims/Keysight_P9374A.yaml (pyvisa-sim).
+"""
+import numpy as np
+import pytest
+
+from Hatlab_QCoDes_Drivers.Keysight_P9374A import Keysight_P9374A, SIM_FILE
+
+
+@pytest.fixture
+def vna():
+    vna = Keysight_P9374A("pna_test", "TCPIP::localhost::hislip0::INSTR", data_format="ASCII",
+                          pyvisa_sim_file=SIM_FILE)
+    yield vna
+    vna.close()
+
+
+def test_measure_sparams_restores_averaging(vna):
+    vna.averaging(1)
+    vna.average_type("SWE")
+    vna.avgnum(7)
+    vna.trigger_source("IMM")
+    vna._measurements = {"S21": 1}
+    data = vna.measure_sparams(avgnum=4)
+    np.testing.assert_array_equal(data["frequency"], np.linspace(5e9, 7e9, 5))
+    assert data["S21"][0] == pytest.approx(0.1)
+    assert (int(vna.averaging()), vna.average_type(), int(vna.avgnum()), vna.trigger_source()) == (1, "SWE", 7, "IMM")
+
+
+def test_set_segments_sends_one_list(vna, monkeypatch):
+    sent = []
+    monkeypatch.setattr(vna, "write_raw", sent.append)
+    vna.batching = False
+    freqs = vna.set_segments([(5e9, 5.1e9, 11, 100), (6e9, 6.2e9, 21)])
+    assert sent == ["SENS1:SEGM:LIST SSTOP,2,"
+                    "1,11,5000000000.0,5100000000.0,100.0,0,-20.0,"
+                    "1,21,6000000000.0,6200000000.0,1000.0,0,-20.0",
+                    "SENS1:SEGM:BWID:CONT 1",
+                    "SENS1:SEGM:POW:CONT 0",
+                    ":SENS1:SWE:TYPE SEGM"]
+    assert len(freqs) == 32
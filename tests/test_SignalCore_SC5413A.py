@@ -0,0 +1,61 @@
+"""
+Write skipping of SignalCore_SC5413A, with a minimal stand-in for sc5413a.dll.
+"""
+import time
+
+import pytest
+
+from Hatlab_QCoDes_Drivers.SignalCore_SC5413A import SignalCore_SC5413A
+
+
+class FakeSC5413A_DLL:
+    def __init__(self):
+        self.atten = [0, 0, 0, 0]
+        self.calls = []
+
+    def sc5413a_OpenDevice(self, serial_number):
+        return 1
+
+    def sc5413a_CloseDevice(self, handle):
+        return 0
+
+    def sc5413a_GetDeviceInfo(self, handle, device_info):
+        return 0
+
+    def sc5413a_FetchRfParams(self, handle, rf_params):
+        for i, atten in enumerate(self.atten):
+            setattr(rf_params._obj, f"atten{i}", bytes([atten]))
+        return 0
+
+    def sc5413a_SetRfAttenuation(self, handle, attenuator, value):
+        attenuator, value = ord(attenuator.value), ord(value.value)  # ctypes.c_char arguments
+        self.calls.append(("SetRfAttenuation", attenuator, value))
+        self.atten[attenuator] = value
+        return 0
+
+
+@pytest.fixture
+def dll():
+    return FakeSC5413A_DLL()
+
+
+@pytest.fixture
+def mod(dll):
+    mod = SignalCore_SC5413A("sc5413a_test", "1000ABCD", dll=dll, cache_ttl=0.05)
+    yield mod
+    mod.close()
+
+
+def test_write_of_fetched_value_is_skipped(mod, dll):
+    assert mod.attenuation() == [0, 0, 0, 0]
+    mod.attenuation([0, 0, 3, 0])
+    assert dll.calls == [("SetRfAttenuation", 2, 3)]
+
+
+def test_write_after_cache_ttl_is_sent(mod, dll):
+    assert mod.attenuation() == [0, 0, 0, 0]
+    dll.atten[0] = 5  # changed from the front panel or another process
+    time.sleep(0.1)
+    mod.attenuation([0, 0, 0, 0])
+    assert ("SetRfAttenuation", 0, 0) in dll.calls
+    assert dll.atten == [0, 0, 0, 0]
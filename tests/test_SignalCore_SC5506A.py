@@ -0,0 +1,49 @@
+"""
+Device sharing of SignalCore_SC5506A, with a minimal stand-in for sc5506a_usb.dll.
+"""
+import pytest
+
+from Hatlab_QCoDes_Drivers.SignalCore_sc5506a_seperate import SignalCore_SC5506A, SC5506A_Device
+
+SN = "10001A2B"
+
+
+class FakeSC5506A_DLL:
+    def __init__(self, firmware_revision):
+        self.firmware_revision = firmware_revision
+        self.open_handles = 0
+
+    def sc5506a_OpenDevice(self, serial_number, handle):
+        self.open_handles += 1
+        return 0
+
+    def sc5506a_CloseDevice(self, handle):
+        self.open_handles -= 1
+        return 0
+
+    def sc5506a_GetDeviceInfo(self, handle, device_info):
+        device_info._obj.firmware_revision = self.firmware_revision
+        return 0
+
+    def _ok(self, *args):
+        return 0
+
+    sc5506a_DisableAutoLevel = sc5506a_RegWrite = sc5506a_RegRead = _ok
+    sc5506a_SetFrequency = sc5506a_SetPowerLevel = _ok
+
+
+def test_failed_init_releases_device():
+    old_dll = FakeSC5506A_DLL(firmware_revision=3.0)
+    with pytest.raises(NotImplementedError):
+        SignalCore_SC5506A("sc5506a_test", SN, dll=old_dll)
+    assert SN not in SC5506A_Device._devices
+    assert old_dll.open_handles == 0
+
+    dll = FakeSC5506A_DLL(firmware_revision=4.0)
+    gen = SignalCore_SC5506A("sc5506a_test", SN, dll=dll)
+    try:
+        assert SC5506A_Device._devices[SN]._users == 1
+    finally:
+        gen.close()
+    assert SN not in SC5506A_Device._devices
+    assert dll.open_handles == 0
@@ -0,0 +1,127 @@
+"""
+List/sweep mode of SignalCore_SC5511A and the concurrent SignalCore_SC5511A_Group against SC5511A_CtypesStub,
+which takes the driver's calls through ctypes function pointers with the sc5511a.dll prototypes.
+"""
+import time
+
+import numpy as np
+import pytest
+
+from Hatlab_QCoDes_Drivers.SignalCore_SC5511A import (SignalCore_SC5511A, SignalCore_SC5511A_Group, SignalCoreGroupError,
+                                                      SC5511A_PROTOTYPES, SWEEP_DWELL_UNIT)
+from Hatlab_QCoDes_Drivers.SignalCore_stub import SC5511A_CtypesStub
+
+SN = "10001C4A"
+
+
+@pytest.fixture
+def stub():
+    return SC5511A_CtypesStub(SC5511A_PROTOTYPES, serial_numbers=(SN,))
+
+
+@pytest.fixture
+def gen(stub):
+    gen = SignalCore_SC5511A("sc5511a_test", SN, dll=stub, cache_ttl=0)
+    yield gen
+    gen.close()
+    gen.remove_instance(gen)
+
+
+def list_mode_fields(stub):
+    list_mode = stub._devices[SN]["list_mode"]
+    return {name: getattr(list_mode, name) for name, _ in list_mode._fields_}
+
+
+def test_configure_sweep_up(gen, stub):
+    gen.configure_sweep(5e9, 6e9, 1e6, dwell_time=2e-3, cycles=3, hw_trigger=True, trig_out=True)
+    assert list_mode_fields(stub) == dict(sss_mode=1, sweep_dir=0, tri_waveform=0, hw_trigger=1, step_on_hw_trig=0,
+                                          return_to_start=1, trig_out_enable=1, trig_out_on_cycle=0)
+    device = stub._devices[SN]
+    assert (device["start_freq"], device["stop_freq"], device["step_freq"]) == (int(5e9), int(6e9), int(1e6))
+    assert device["sweep_dwell_time"] == round(2e-3 / SWEEP_DWELL_UNIT)
+    assert device["sweep_cycles"] == 3
+    assert device["rf1_mode"] == 1
+
+    # read back through Device_rf_params_t
+    assert gen.sweep_dwell_time() == pytest.approx(2e-3)
+    assert gen.sweep_cycles() == 3
+    freqs = gen.sweep_frequencies()
+    assert freqs[0] == 5e9 and freqs[-1] == 6e9 and len(freqs) == 1001
+
+
+def test_configure_sweep_down(gen, stub):
+    gen.configure_sweep(6e9, 5e9, 1e6)
+    assert list_mode_fields(stub)["sweep_dir"] == 1
+    device = stub._devices[SN]
+    assert (device["start_freq"], device["stop_freq"]) == (int(5e9), int(6e9))
+    freqs = gen.sweep_frequencies()
+    assert freqs[0] == 6e9 and freqs[-1] == 5e9 and np.all(np.diff(freqs) == -1e6)
+
+
+def test_configure_list(gen, stub):
+    frequencies = np.linspace(4e9, 4.1e9, 1000)
+    gen.configure_list(frequencies, dwell_time=1e-3, step_on_hw_trig=True, hw_trigger=True, return_to_start=False)
+    assert list_mode_fields(stub) == dict(sss_mode=0, sweep_dir=0, tri_waveform=0, hw_trigger=1, step_on_hw_trig=1,
+                                          return_to_start=0, trig_out_enable=0, trig_out_on_cycle=0)
+    assert stub._devices[SN]["list_buffer"] == list(frequencies.astype(np.uint64))
+    np.testing.assert_array_equal(gen.sweep_frequencies(), frequencies)
+
+
+@pytest.mark.parametrize("configure", ["sweep", "list"])
+def test_1000_points_is_one_configuration(gen, stub, configure):
+    stub.calls.clear()
+    if configure == "sweep":
+        gen.configure_sweep(5e9, 5e9 + 999e6, 1e6, dwell_time=1e-3, cycles=1)
+    else:
+        gen.sweep_frequencies(np.linspace(5e9, 6e9, 1000))
+    # one device session, and no per-point calls
+    assert stub.calls["sc5511a_open_device"] == 1
+    assert stub.calls["sc5511a_close_device"] == 1
+    assert sum(stub.calls.values()) <= 10
+    assert "sc5511a_set_freq" not in stub.calls
+
+
+@pytest.fixture
+def group():
+    serial_numbers = ("10001C4A", "10001C4B", "10001C4C")
+    stub = SC5511A_CtypesStub(SC5511A_PROTOTYPES, serial_numbers=serial_numbers, open_latency=0.05)
+    gens = [SignalCore_SC5511A(f"sc5511a_group{i}", sn, dll=stub, cache_ttl=0) for i, sn in enumerate(serial_numbers)]
+    group = SignalCore_SC5511A_Group(gens)
+    yield group, stub, gens
+    group.close()
+    for gen in gens:
+        gen.close()
+        gen.remove_instance(gen)
+
+
+def test_group_runs_concurrently(group):
+    group, stub, gens = group
+    t0 = time.perf_counter()
+    with gens[0].session():
+        gens[0].frequency(6e9)
+        gens[0].power(-10)
+    single = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    group.set(frequency={"sc5511a_group1": 6.5e9, "sc5511a_group2": 7e9}, power=-20)
+    elapsed = time.perf_counter() - t0
+    assert elapsed < 0.6 * len(gens) * single  # not one generator after the other
+
+    readings = group.get()
+    assert {name: r["frequency"] for name, r in readings.items()} == {
+        "sc5511a_group0": 6e9, "sc5511a_group1": 6.5e9, "sc5511a_group2": 7e9}
+    assert all(r["power"] == -20 for r in readings.values())
+
+
+def test_group_error_lists_failed_generators(group):
+    group, stub, gens = group
+    with pytest.raises(SignalCoreGroupError) as excinfo:
+        group.set(frequency={"sc5511a_group0": 5.5e9, "sc5511a_group1": 30e9}, output_status=1)
+    error = excinfo.value
+    assert list(error.errors) == ["sc5511a_group1"]
+    assert isinstance(error.errors["sc5511a_group1"], ValueError)
+    assert "sc5511a_group1" in str(error)
+    # the other generators still completed
+    assert set(error.results) == {"sc5511a_group0", "sc5511a_group2"}
+    assert gens[0].frequency() == 5.5e9 and gens[0].output_status() == 1
+    assert gens[2].output_status() == 1
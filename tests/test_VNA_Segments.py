@@ -0,0 +1,18 @@
+"""
+Segment tables built by VNA_Segments.segments_around.
+"""
+import numpy as np
+import pytest
+
+from Hatlab_QCoDes_Drivers.VNA_Segments import segments_around, segment_stimulus
+
+
+@pytest.mark.parametrize("centers", [[], [5e9], [5e9, 6e9], [4e9 + 1e5, 8e9 - 1e5]])
+@pytest.mark.parametrize("background_points", [1, 2, 3, 100])
+def test_background_points_total(centers, background_points):
+    segments = segments_around(centers, 10e6, 101, fstart=4e9, fstop=8e9,
+                               background_points=background_points, background_ifbw=1e5)
+    assert sum(seg.points for seg in segments if seg.ifbw == 1e5) == background_points
+    freqs = segment_stimulus(segments)
+    assert np.all(np.diff(freqs) > 0)  # in order, no frequency measured twice
+    assert 4e9 <= freqs[0] and freqs[-1] <= 8e9